@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+backup.py
+Бэкап живой базы SQLite без остановки бота.
+
+- копия снимается online backup API (sqlite3.Connection.backup). В режиме WAL — за один шаг:
+  копия читается из одного снимка, а писатели WAL читателю не мешают и не ждут его.
+  В остальных режимах — порциями по BACKUP_PAGES страниц с паузой: писатели ждут не дольше
+  одной порции, но каждая запись в базу заставляет SQLite начать копию заново, поэтому
+  число перезапусков и общее время ограничены (BACKUP_MAX_RESTARTS, BACKUP_MAX_SECONDS),
+  после чего — BackupError;
+- копия проверяется PRAGMA integrity_check и потоком сжимается в .db.gz;
+- в каталоге бэкапов остаются последние BACKUP_KEEP файлов (и не старше BACKUP_MAX_DAYS);
+- файл больше лимита документа VK режется на части .001, .002, ...
+  (склеить обратно: cat name.gz.0* > name.gz).
+
+Запуск как скрипта — проверка на временной базе с параллельной записью:
+    python backup.py
+"""
+import os
+import sys
+import gzip
+import time
+import shutil
+import sqlite3
+import logging
+import datetime
+from typing import List
+
+logger = logging.getLogger("vk_moder_bot")
+
+BACKUP_DIR = os.getenv("BACKUP_DIR") or "backups"
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES") or 256)             # страниц за шаг backup API
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP") or 0.005)  # секунды между шагами
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS") or 20)    # перезапусков копии из-за записей
+BACKUP_MAX_SECONDS = float(os.getenv("BACKUP_MAX_SECONDS") or 300)   # предел времени пошаговой копии
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP") or 14)                 # сколько последних бэкапов хранить
+BACKUP_MAX_DAYS = int(os.getenv("BACKUP_MAX_DAYS") or 0)          # 0 — не удалять по возрасту
+DOC_MAX_BYTES = int(os.getenv("DOC_MAX_BYTES") or 200 * 1024 * 1024)    # лимит документа VK
+COPY_CHUNK = 1024 * 1024
+PREFIX = "moder_bot_backup_"
+
+class BackupError(Exception):
+    """Копия не снялась или не прошла проверку целостности."""
+
+def snapshot(db_path: str, dest: str, pages: int = BACKUP_PAGES, step_sleep: float = BACKUP_STEP_SLEEP,
+             max_restarts: int = BACKUP_MAX_RESTARTS, max_seconds: float = BACKUP_MAX_SECONDS) -> int:
+    """
+    Копирует базу в dest через backup API, возвращает число шагов.
+    BackupError — пошаговая копия не успела за max_restarts перезапусков или max_seconds.
+    """
+    steps = restarts = 0
+    last_remaining = None
+    deadline = time.monotonic() + max_seconds
+
+    def progress(status, remaining, total):
+        nonlocal steps, restarts, last_remaining
+        steps += 1
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1    # база изменилась — SQLite начал копию с начала
+        last_remaining = remaining
+        if restarts > max_restarts:
+            raise BackupError(f"копия перезапускалась {restarts} раз из-за записей в базу")
+        if time.monotonic() > deadline:
+            raise BackupError(f"копия не завершилась за {max_seconds:.0f} с (перезапусков: {restarts})")
+
+    src = sqlite3.connect(db_path, timeout=30)
+    dst = sqlite3.connect(dest)
+    try:
+        wal = str(src.execute("PRAGMA journal_mode").fetchone()[0]).lower() == "wal"
+        src.backup(dst, pages=-1 if wal else pages, progress=progress, sleep=step_sleep)
+    finally:
+        dst.close()
+        src.close()
+    return steps
+
+def check_integrity(path: str):
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        conn.close()
+    if [r[0] for r in rows] != ["ok"]:
+        raise BackupError("integrity_check: " + "; ".join(str(r[0]) for r in rows[:5]))
+
+def compress(src: str, dst: str):
+    with open(src, "rb") as fin, gzip.open(dst, "wb", compresslevel=6) as fout:
+        shutil.copyfileobj(fin, fout, COPY_CHUNK)
+
+def split_file(path: str, limit: int = DOC_MAX_BYTES) -> List[str]:
+    """Режет файл на части не больше limit байт; файл в пределах лимита возвращается как есть."""
+    size = os.path.getsize(path)
+    if size <= limit:
+        return [path]
+    parts = []
+    with open(path, "rb") as fin:
+        n = 0
+        while True:
+            n += 1
+            part = f"{path}.{n:03d}"
+            written = 0
+            with open(part, "wb") as fout:
+                while written < limit:
+                    data = fin.read(min(COPY_CHUNK, limit - written))
+                    if not data:
+                        break
+                    fout.write(data)
+                    written += len(data)
+            if not written:
+                os.remove(part)
+                break
+            parts.append(part)
+    os.remove(path)
+    return parts
+
+def list_backups(backup_dir: str = BACKUP_DIR) -> List[str]:
+    """Имена бэкапов (без суффикса части), от новых к старым."""
+    if not os.path.isdir(backup_dir):
+        return []
+    names = set()
+    for f in os.listdir(backup_dir):
+        if f.startswith(PREFIX):
+            names.add(f.split(".", 1)[0])
+    return sorted(names, reverse=True)
+
+def rotate(backup_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP, max_days: int = BACKUP_MAX_DAYS) -> int:
+    """Удаляет бэкапы сверх keep последних и старше max_days; возвращает число удалённых бэкапов."""
+    cutoff = time.time() - max_days * 86400 if max_days else None
+    removed = 0
+    for i, name in enumerate(list_backups(backup_dir)):
+        files = [os.path.join(backup_dir, f) for f in os.listdir(backup_dir) if f.split(".", 1)[0] == name]
+        too_old = cutoff is not None and all(os.path.getmtime(f) < cutoff for f in files)
+        if i < keep and not too_old:
+            continue
+        for f in files:
+            os.remove(f)
+        removed += 1
+    return removed
+
+def create_backup(db_path: str, backup_dir: str = BACKUP_DIR, limit: int = DOC_MAX_BYTES) -> List[str]:
+    """
+    Снимает, проверяет, сжимает бэкап и применяет ротацию.
+    Возвращает файлы для отправки: один .db.gz или его части, если он больше limit.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    raw = os.path.join(backup_dir, f"{PREFIX}{ts}.db.tmp")
+    packed = os.path.join(backup_dir, f"{PREFIX}{ts}.db.gz")
+    t0 = time.perf_counter()
+    try:
+        steps = snapshot(db_path, raw)
+        t_copy = time.perf_counter() - t0
+        check_integrity(raw)
+        compress(raw, packed)
+    finally:
+        if os.path.exists(raw):
+            os.remove(raw)
+    size = os.path.getsize(packed)
+    files = split_file(packed, limit)
+    removed = rotate(backup_dir)
+    logger.info("Бэкап %s: %s шагов копирования за %.0f мс, всего %.0f мс, %.1f КБ сжато, частей %s, удалено старых %s",
+                os.path.basename(packed), steps, t_copy * 1000, (time.perf_counter() - t0) * 1000,
+                size / 1024, len(files), removed)
+    return files
+
+# ----------------- Проверка -----------------
+def selftest():
+    import tempfile
+    import threading
+    workdir = tempfile.mkdtemp(prefix="vk_backup_")
+    db = os.path.join(workdir, "live.db")
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE warns (id INTEGER PRIMARY KEY, user_id INTEGER, reason TEXT)")
+    conn.executemany("INSERT INTO warns (user_id, reason) VALUES (?, ?)", [(i, "флуд " * 20) for i in range(50000)])
+    conn.close()
+
+    stop = threading.Event()
+    writes = 0
+
+    def writer(path):
+        nonlocal writes
+        w = sqlite3.connect(path, isolation_level=None, timeout=30)
+        while not stop.is_set():
+            w.execute("INSERT INTO warns (user_id, reason) VALUES (?, ?)", (writes, "во время бэкапа"))
+            writes += 1
+        w.close()
+
+    t = threading.Thread(target=writer, args=(db,))
+    t.start()
+    backups = os.path.join(workdir, "backups")
+    result = []
+    b = threading.Thread(target=lambda: result.append(create_backup(db, backups, limit=256 * 1024)), daemon=True)
+    t0 = time.monotonic()
+    b.start()
+    b.join(timeout=60)
+    stop.set()
+    t.join()
+    assert not b.is_alive(), "бэкап под записью не завершился за 60 с"
+    files = result[0]
+    print(f"записей во время бэкапа: {writes}, частей: {len(files)}, {time.monotonic() - t0:.1f} с")
+    assert len(files) > 1 and all(os.path.getsize(f) <= 256 * 1024 for f in files)
+
+    # без WAL пошаговая копия под постоянной записью перезапускается — должна упасть в срок, а не висеть
+    legacy = os.path.join(workdir, "legacy.db")
+    shutil.copyfile(db, legacy)
+    lc = sqlite3.connect(legacy, isolation_level=None)
+    lc.execute("PRAGMA journal_mode=DELETE")
+    lc.close()
+    stop.clear()
+    t = threading.Thread(target=writer, args=(legacy,))
+    t.start()
+    t0 = time.monotonic()
+    try:
+        snapshot(legacy, os.path.join(workdir, "legacy.copy"), pages=16, max_restarts=3, max_seconds=10)
+        outcome = "успела"
+    except BackupError as e:
+        outcome = f"BackupError: {e}"
+    finally:
+        stop.set()
+        t.join()
+    elapsed = time.monotonic() - t0
+    print(f"копия без WAL под записью: {outcome}, {elapsed:.1f} с")
+    assert elapsed < 15
+
+    joined = os.path.join(workdir, "restored.db.gz")
+    with open(joined, "wb") as out:
+        for f in files:
+            with open(f, "rb") as part:
+                shutil.copyfileobj(part, out)
+    restored = os.path.join(workdir, "restored.db")
+    with gzip.open(joined, "rb") as fin, open(restored, "wb") as fout:
+        shutil.copyfileobj(fin, fout)
+    check_integrity(restored)
+    n = sqlite3.connect(restored).execute("SELECT COUNT(*) FROM warns").fetchone()[0]
+    print(f"строк в восстановленной копии: {n}")
+    assert n >= 50000
+
+    for _ in range(3):
+        time.sleep(1.1)    # имена бэкапов — с точностью до секунды
+        create_backup(db, backups)
+    assert len(list_backups(backups)) == 4
+    assert rotate(backups, keep=2) == 2 and len(list_backups(backups)) == 2
+    print("ok")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", stream=sys.stdout)
+    selftest()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+bench_replay.py
+Офлайн-бенчмарк обработки событий: события MESSAGE_NEW из JSONL прогоняются через
+handle_event бота на фейковом VK API (fake_vk.py) и временной засеянной БД.
+
+Бот собирается через create_app() с сессией FakeSession вместо vk_api.VkApi.
+
+Формат строки JSONL — как у Callback API: {"type": "message_new", "object": {"message": {...}}}.
+Без --events генерируются типовые смеси:
+    chatter   — обычная переписка;
+    blacklist — часть сообщений с запрещёнными словами;
+    muted     — пишут пользователи в муте;
+    commands  — шквал команд модераторов (/warn, /mute, /info, /warns, /help);
+    all       — всё вперемешку.
+
+Отчёт: пропускная способность, задержка обработки события p50/p95/p99
+и число вызовов VK API на событие (по методам).
+
+--shards 1,2,4 — масштабирование по процессам (SHARDS, ShardRouter): та же смесь прогоняется
+через роутер с N процессами-шардами, время — от первого события до конца обработки всех.
+Прогон считается недействительным (выход с ошибкой), если хоть один шард обработал
+не столько событий, сколько ему отправлено.
+
+    python bench_replay.py [--mix all] [--count N] [--chats N] [--events FILE] [--write FILE] [--shards 1,2,4]
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+from typing import Dict, List
+
+from fake_vk import FakeVk
+
+MIXES = ("chatter", "blacklist", "muted", "commands")
+PEER_BASE = 2000000000
+OWNER = 1
+MODERS = list(range(10, 15))
+MUTED = list(range(100, 120))
+USERS = list(range(1000, 1500))
+BLACKLIST = ["спамслово", "казино", "запрещёнка", "scamlink"]
+WORDS = ("привет", "как", "дела", "кто", "в", "игре", "сегодня", "вечером", "го", "катку", "ок", "ну", "да", "нет")
+
+# ----------------- Фейковая сессия VK -----------------
+class FakeSession:
+    """Замена vk_api.VkApi для BotApp: get_api() и method() (им вызывается execute) идут в FakeVk."""
+    def __init__(self, api: FakeVk):
+        self.api = api
+
+    def get_api(self):
+        return self.api
+
+    def method(self, method, values=None, raw=False):
+        return self.api.call(method, values or {})
+
+class FakeUpload:
+    def document_message(self, *a, **kw):
+        return {"doc": {"owner_id": -1, "id": 1}}
+
+class ReplayEvent:
+    """Событие в том виде, в каком его отдаёт VkBotLongPoll: type, obj, message."""
+    def __init__(self, raw: dict, event_type):
+        self.raw = raw
+        self.type = event_type if raw.get("type") == "message_new" else raw.get("type")
+        self.obj = raw.get("object") or {}
+        self.message = self.obj.get("message")
+
+# ----------------- Генерация смесей -----------------
+def _message(rnd: random.Random, peer_id: int, from_id: int, text: str, cmid: int) -> dict:
+    return {"type": "message_new", "group_id": 1, "object": {"message": {
+        "peer_id": peer_id, "from_id": from_id, "text": text, "id": 0,
+        "conversation_message_id": cmid, "date": int(time.time())}}}
+
+def _chatter_text(rnd: random.Random) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 12)))
+
+def generate(mix: str, count: int, chats: int, seed: int = 42) -> List[dict]:
+    rnd = random.Random(seed)
+    kinds = MIXES if mix == "all" else (mix,)
+    events = []
+    for i in range(count):
+        kind = rnd.choice(kinds)
+        peer_id = PEER_BASE + rnd.randint(1, chats)
+        if kind == "chatter":
+            ev = _message(rnd, peer_id, rnd.choice(USERS), _chatter_text(rnd), i + 1)
+        elif kind == "blacklist":
+            # каждое пятое сообщение — с запрещённым словом, остальные — фон переписки
+            text = _chatter_text(rnd)
+            if rnd.random() < 0.2:
+                text += " " + rnd.choice(BLACKLIST)
+            ev = _message(rnd, peer_id, rnd.choice(USERS), text, i + 1)
+        elif kind == "muted":
+            ev = _message(rnd, peer_id, rnd.choice(MUTED), _chatter_text(rnd), i + 1)
+        else:
+            target = rnd.choice(USERS)
+            text = rnd.choice((f"/warn {target} флуд", f"/mute {target} 5 капс", f"/info {target}",
+                               f"/warns {target}", "/help", f"/варны {target}"))
+            ev = _message(rnd, peer_id, rnd.choice(MODERS), text, i + 1)
+        events.append(ev)
+    return events
+
+def load_events(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# ----------------- Засев БД -----------------
+def seed(bot, api: FakeVk, chats: int):
+    peers = [PEER_BASE + n for n in range(1, chats + 1)]
+    for peer_id in peers:
+        bot.add_chat(peer_id)
+        api.members[peer_id] = set(USERS[:50]) | set(MUTED) | set(MODERS)
+        for uid in MODERS:
+            bot.set_role_db(uid, "moder", peer_id)
+    for w in BLACKLIST:
+        bot.add_blacklist_db(w)
+    for uid in MUTED:
+        for peer_id in peers:
+            bot.add_mute_db(uid, OWNER, 24 * 60, "бенчмарк", peer_id)
+    bot.membership.sync()
+
+def bench_app(shard=None, serve_http=True):
+    """Фабрика BotApp для процесса-шарда: свой FakeVk с участниками бесед, общая засеянная БД."""
+    import vk_moder_bot as bot
+    api = FakeVk()
+    for n in range(1, int(os.environ["BENCH_CHATS"]) + 1):
+        api.members[PEER_BASE + n] = set(USERS[:50]) | set(MUTED) | set(MODERS)
+    return bot.BotApp(vk_session=FakeSession(api), upload=FakeUpload(), db_path=os.environ["BENCH_DB"],
+                      log_path=os.environ["BENCH_LOG"], shard=shard, serve_http=serve_http)
+
+# ----------------- Прогон -----------------
+def _pct(values: List[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+def replay(bot, api: FakeVk, events: List[dict]) -> Dict:
+    event_type = bot.VkBotEventType.MESSAGE_NEW
+    wrapped = [ReplayEvent(raw, event_type) for raw in events]
+    calls_before = len(api.calls)
+    latencies = []
+    t0 = time.perf_counter()
+    for ev in wrapped:
+        s = time.perf_counter()
+        bot.handle_event(ev)
+        latencies.append(time.perf_counter() - s)
+    handled = time.perf_counter() - t0
+    bot.outbox.flush(timeout=60)
+    elapsed = time.perf_counter() - t0
+    by_method: Dict[str, int] = {}
+    for method, _ in api.calls[calls_before:]:
+        by_method[method] = by_method.get(method, 0) + 1
+    latencies.sort()
+    n = max(1, len(wrapped))
+    return {"events": len(wrapped), "handled_s": handled, "elapsed_s": elapsed,
+            "throughput": len(wrapped) / handled if handled else 0.0,
+            "p50_ms": _pct(latencies, 0.50), "p95_ms": _pct(latencies, 0.95), "p99_ms": _pct(latencies, 0.99),
+            "api_calls_per_event": sum(by_method.values()) / n,
+            "api_by_method": {m: c / n for m, c in sorted(by_method.items())}}
+
+def replay_sharded(bot, events: List[dict], shards: int) -> Dict:
+    event_type = bot.VkBotEventType.MESSAGE_NEW
+    wrapped = [ReplayEvent(raw, event_type) for raw in events]
+    router = bot.ShardRouter(shards, app_factory=bench_app)
+    t_start = time.perf_counter()
+    router.start()
+    started = time.perf_counter() - t_start
+    t0 = time.perf_counter()
+    for ev in wrapped:
+        router.submit(ev)
+    router.stop(timeout=300)
+    elapsed = time.perf_counter() - t0
+    if router.processed != router.routed:
+        raise SystemExit(f"шарды обработали {router.processed}, отправлено {router.routed} — результат недействителен")
+    return {"shards": shards, "events": len(wrapped), "start_s": started, "elapsed_s": elapsed,
+            "throughput": len(wrapped) / elapsed if elapsed else 0.0, "routed": router.routed}
+
+def print_report(name: str, r: Dict):
+    print(f"{name:>9} | {r['events']:>6} | {r['throughput']:>10.0f} | {r['p50_ms']:>7.2f} | {r['p95_ms']:>7.2f} | "
+          f"{r['p99_ms']:>7.2f} | {r['api_calls_per_event']:>8.2f}")
+    for m, c in r["api_by_method"].items():
+        print(f"{'':>9}   {m}: {c:.3f}/событие")
+
+def main():
+    argv = sys.argv
+    opt = lambda name, default: argv[argv.index(name) + 1] if name in argv else default
+    mix = opt("--mix", "all")
+    count = int(opt("--count", 5000))
+    chats = int(opt("--chats", 20))
+    events_path = opt("--events", None)
+    write_path = opt("--write", None)
+    shards = [int(n) for n in opt("--shards", "").split(",") if n]
+
+    workdir = tempfile.mkdtemp(prefix="vk_bench_")
+    db_path = os.path.join(workdir, "bench.db")
+    # читаются при импорте модуля бота
+    os.environ.update({"GROUP_ID": "1", "OWNER_ID": str(OWNER), "OUTBOX_RATE": "1000000"})
+    import vk_moder_bot as bot
+    api = FakeVk()
+    app = bot.create_app(vk_session=FakeSession(api), upload=FakeUpload(), db_path=db_path,
+                         log_path=os.path.join(workdir, "bench.log"))
+    seed(bot, api, chats)
+
+    if events_path:
+        runs = [(os.path.basename(events_path), load_events(events_path))]
+    else:
+        names = MIXES + ("all",) if mix == "all" else (mix,)
+        runs = [(name, generate(name, count, chats)) for name in names]
+    if write_path:
+        with open(write_path, "w", encoding="utf-8") as f:
+            for _, events in runs:
+                for ev in events:
+                    f.write(json.dumps(ev, ensure_ascii=False) + "\n")
+
+    if shards:
+        # процессы-шарды открывают ту же БД и собирают бота через bench_app()
+        os.environ.update({"BENCH_DB": db_path, "BENCH_LOG": os.path.join(workdir, "bench.log"),
+                           "BENCH_CHATS": str(chats)})
+        bot.outbox.flush(timeout=60)
+        print(f"БД: {db_path}, бесед: {chats}, CPU: {os.cpu_count()}")
+        print(f"{'смесь':>9} | {'шардов':>6} | {'событий':>7} | {'старт, с':>8} | {'событий/с':>10} | {'ускорение':>9} | по шардам")
+        for name, events in runs:
+            base = None
+            for n in shards:
+                r = replay_sharded(bot, events, n)
+                base = base or r["throughput"]
+                print(f"{name:>9} | {n:>6} | {r['events']:>7} | {r['start_s']:>8.2f} | {r['throughput']:>10.0f} | "
+                      f"{r['throughput'] / base:>8.2f}x | {r['routed']}")
+        return
+
+    print(f"БД: {db_path}, бесед: {chats}, старт бота: "
+          + ", ".join(f"{k}={v * 1000:.0f}мс" for k, v in app.timings.items()))
+    print(f"{'смесь':>9} | {'событий':>6} | {'событий/с':>10} | {'p50, мс':>7} | {'p95, мс':>7} | {'p99, мс':>7} | {'API/соб.':>8}")
+    for name, events in runs:
+        print_report(name, replay(bot, api, events))
+
+if __name__ == "__main__":
+    main()
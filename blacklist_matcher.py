@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+blacklist_matcher.py
+Автомат Ахо-Корасик для поиска запрещённых слов за один проход по тексту.
+
+Стоимость поиска — O(длина текста + число совпадений) и не зависит от размера ЧС.
+Автомат неизменяем после построения: бот пересобирает его только при изменении ЧС
+и подменяет ссылку целиком, поэтому читать его можно из любого потока без блокировок.
+
+Запуск как скрипта — бенчмарк против старого цикла `w in text`:
+    python blacklist_matcher.py [--messages N]
+"""
+import sys
+import time
+import random
+import string
+from collections import deque
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# до этого размера ЧС встроенный str.find (C) быстрее обхода автомата в Python
+SMALL_SET = 32
+
+class AhoCorasick:
+    def __init__(self, words: Iterable[str]):
+        self.words: List[str] = []
+        # состояние -> {символ: состояние}; fail — суффиксная ссылка;
+        # out — индекс слова, заканчивающегося в состоянии (-1 если нет);
+        # dict_link — ближайшее по суффиксным ссылкам состояние с out != -1
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [-1]
+        self._dict_link = [0]
+        seen = set()
+        for w in words:
+            if not w or w in seen:
+                continue
+            seen.add(w)
+            self._insert(w, len(self.words))
+            self.words.append(w)
+        self._build_links()
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def _insert(self, word: str, idx: int):
+        s = 0
+        for ch in word:
+            nxt = self._goto[s].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(-1)
+                self._dict_link.append(0)
+                self._goto[s][ch] = nxt
+            s = nxt
+        self._out[s] = idx
+
+    def _build_links(self):
+        goto, fail, out, dict_link = self._goto, self._fail, self._out, self._dict_link
+        q = deque(goto[0].values())
+        while q:
+            s = q.popleft()
+            for ch, t in goto[s].items():
+                q.append(t)
+                f = fail[s]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(ch, 0)
+                fail[t] = f if f != t else 0
+                dict_link[t] = f if out[f] != -1 else dict_link[f]
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, str]]:
+        """Все вхождения в порядке окончания: (позиция начала, слово)."""
+        if len(self.words) <= SMALL_SET:
+            yield from self._finditer_small(text)
+            return
+        goto, fail, out, dict_link, words = self._goto, self._fail, self._out, self._dict_link, self.words
+        s = 0
+        for i, ch in enumerate(text):
+            while s and ch not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(ch, 0)
+            t = s if out[s] != -1 else dict_link[s]
+            while t:
+                w = words[out[t]]
+                yield i - len(w) + 1, w
+                t = dict_link[t]
+
+    def _finditer_small(self, text: str) -> Iterator[Tuple[int, str]]:
+        found = []
+        for w in self.words:
+            i = text.find(w)
+            while i != -1:
+                found.append((i + len(w), i, w))
+                i = text.find(w, i + 1)
+        found.sort()
+        for _, i, w in found:
+            yield i, w
+
+    def search(self, text: str) -> Optional[Tuple[int, str]]:
+        """
+        Какое-нибудь вхождение или None — останавливается на первом найденном.
+        В малом ЧС это первое по порядку слово, которое есть в тексте (как в старом цикле),
+        в большом — вхождение с самым ранним концом.
+        """
+        if len(self.words) <= SMALL_SET:
+            for w in self.words:
+                if w in text:
+                    return text.find(w), w
+            return None
+        for m in self.finditer(text):
+            return m
+        return None
+
+# ----------------- Бенчмарк -----------------
+def _naive(words: List[str], low: str) -> Optional[str]:
+    for w in words:
+        if not w:
+            continue
+        if w in low:
+            return w
+    return None
+
+def _random_word(rnd: random.Random) -> str:
+    return "".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(4, 10)))
+
+def _best_of(fn, texts: List[str], repeat: int = 3) -> Tuple[float, list]:
+    """Лучшее из repeat время прогона, мкс на сообщение, и результаты."""
+    best, hits = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        hits = [fn(t) is not None for t in texts]
+        took = (time.perf_counter() - t0) / len(texts) * 1e6
+        best = took if best is None else min(best, took)
+    return best, hits
+
+def benchmark(sizes=(10, 1000, 50000), messages: int = 2000, tolerance: float = 1.15):
+    """
+    Автомат должен совпадать с циклом по результатам и не уступать ему по скорости
+    ни на каком размере ЧС (tolerance — запас на шум таймера для малых наборов).
+    """
+    rnd = random.Random(42)
+    texts = [" ".join(_random_word(rnd) for _ in range(rnd.randint(3, 30))) for _ in range(messages)]
+    print(f"{'слов':>7} | {'построение, мс':>14} | {'цикл, мкс/сообщ':>16} | {'автомат, мкс/сообщ':>19} | ускорение")
+    for n in sizes:
+        words = sorted({_random_word(rnd) for _ in range(n)})
+        t0 = time.perf_counter()
+        ac = AhoCorasick(words)
+        build = (time.perf_counter() - t0) * 1000
+        naive, naive_hits = _best_of(lambda t: _naive(words, t), texts)
+        fast, ac_hits = _best_of(ac.search, texts)
+        assert naive_hits == ac_hits, "результаты автомата и цикла расходятся"
+        print(f"{n:>7} | {build:>14.1f} | {naive:>16.1f} | {fast:>19.1f} | x{naive / fast:.1f}")
+        assert fast <= naive * tolerance, f"{n} слов: автомат медленнее цикла"
+
+if __name__ == "__main__":
+    n_msgs = 2000
+    if "--messages" in sys.argv:
+        n_msgs = int(sys.argv[sys.argv.index("--messages") + 1])
+    benchmark(messages=n_msgs)
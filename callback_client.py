@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+callback_client.py
+Локальный клиент для проверки режима Callback API (BOT_MODE=callback): шлёт боту
+запрос подтверждения и события в формате VK, печатает ответы и время до "ok".
+
+Сообщения берутся из JSONL (формат bench_replay.py) или генерируются смесью оттуда же.
+Каждому событию выдаётся event_id; --repeat N повторяет каждое событие N раз
+(как VK, не получивший ответ) — бот должен обработать его один раз.
+
+    python callback_client.py [--url http://127.0.0.1:8080/callback] [--secret S] [--group ID]
+                              [--events FILE | --mix chatter --count N] [--repeat N]
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import urllib.error
+import urllib.request
+
+from bench_replay import generate, load_events
+
+def post(url: str, payload: dict):
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status, resp.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode("utf-8")
+
+def main():
+    argv = sys.argv
+    opt = lambda name, default: argv[argv.index(name) + 1] if name in argv else default
+    url = opt("--url", f"http://127.0.0.1:{os.getenv('PORT') or 8080}{os.getenv('CALLBACK_PATH') or '/callback'}")
+    secret = opt("--secret", os.getenv("CALLBACK_SECRET", ""))
+    group_id = int(opt("--group", os.getenv("GROUP_ID") or 1))
+    repeat = int(opt("--repeat", 1))
+    if "--events" in argv:
+        events = load_events(opt("--events", ""))
+    else:
+        events = generate(opt("--mix", "chatter"), int(opt("--count", 20)), chats=5)
+
+    code, text = post(url, {"type": "confirmation", "group_id": group_id})
+    print(f"confirmation -> {code} {text!r}")
+
+    statuses = {}
+    acks = []
+    for raw in events:
+        payload = dict(raw, group_id=group_id, event_id=uuid.uuid4().hex, v="5.199")
+        if secret:
+            payload["secret"] = secret
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            code, text = post(url, payload)
+            acks.append(time.perf_counter() - t0)
+            statuses[(code, text)] = statuses.get((code, text), 0) + 1
+    acks.sort()
+    p = lambda q: acks[min(len(acks) - 1, int(len(acks) * q))] * 1000 if acks else 0.0
+    print(f"отправлено: {len(acks)} запросов ({len(events)} событий x{repeat})")
+    for (code, text), n in sorted(statuses.items()):
+        print(f"  {code} {text!r}: {n}")
+    print(f"время ответа: p50={p(0.5):.1f}мс p95={p(0.95):.1f}мс p99={p(0.99):.1f}мс")
+
+    # неверный secret должен отклоняться
+    if secret:
+        code, text = post(url, dict(events[0], group_id=group_id, event_id=uuid.uuid4().hex, secret=secret + "x"))
+        print(f"неверный secret -> {code} {text!r}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+fake_vk.py
+Локальный фейк VK API для прогонов без сети.
+
+Повторяет интерфейс vk_api (`api.messages.send(**params)`), записывает все вызовы,
+умеет имитировать лимит запросов (ошибка 6 "Too many requests") и точечные отказы.
+"""
+import json
+import re
+import time
+import random
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+class FakeApiError(Exception):
+    """Аналог vk_api.exceptions.ApiError: код ошибки VK в атрибуте code."""
+    def __init__(self, code: int, msg: str = ""):
+        super().__init__(f"[{code}] {msg}")
+        self.code = code
+
+class _Method:
+    def __init__(self, api: "FakeVk", name: str):
+        self._api = api
+        self._name = name
+
+    def __getattr__(self, item):
+        return _Method(self._api, f"{self._name}.{item}")
+
+    def __call__(self, **params):
+        return self._api.call(self._name, params)
+
+class FakeVk:
+    def __init__(self, rate_limit: Optional[float] = None, latency: float = 0.0):
+        self.rate_limit = rate_limit        # запросов в секунду, None — без лимита
+        self.latency = latency              # имитация сетевой задержки на вызов
+        self.calls: List[Tuple[str, dict]] = []
+        self.rate_limited = 0
+        self.fail_methods: Dict[str, int] = {}    # метод -> код ошибки
+        self.fail_peers: Dict[int, int] = {}      # peer_id -> код ошибки messages.send
+        self.flaky: Dict[str, float] = {}         # метод -> доля вызовов, отклонённых ошибкой 6
+        self._rnd = random.Random(0)
+        self.profiles: Dict[int, Tuple[str, str]] = {}    # uid -> (имя, фамилия) для users.get
+        self.members: Dict[int, Set[int]] = {}    # peer_id -> участники беседы
+        self.screen_names: Dict[str, Tuple[str, int]] = {}    # короткое имя -> (type, object_id)
+        self._window = deque()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, item):
+        if item.startswith("_"):
+            raise AttributeError(item)
+        return _Method(self, item)
+
+    def calls_of(self, method: str) -> List[Tuple[str, dict]]:
+        return [c for c in self.calls if c[0] == method]
+
+    def call(self, method: str, params: dict):
+        with self._lock:
+            if self.rate_limit:
+                now = time.monotonic()
+                while self._window and now - self._window[0] >= 1.0:
+                    self._window.popleft()
+                if len(self._window) >= self.rate_limit:
+                    self.rate_limited += 1
+                    raise FakeApiError(6, "Too many requests per second")
+                self._window.append(now)
+            if self._rnd.random() < self.flaky.get(method, 0.0):
+                self.rate_limited += 1
+                raise FakeApiError(6, "Too many requests per second")
+            self.calls.append((method, dict(params)))
+        if self.latency:
+            time.sleep(self.latency)
+        if method in self.fail_methods:
+            raise FakeApiError(self.fail_methods[method], f"{method} failed")
+        return self._dispatch(method, params)
+
+    def _dispatch(self, method: str, params: dict):
+        handler = getattr(self, "_" + method.replace(".", "_"), None)
+        return handler(params) if handler else 1
+
+    # ----------------- Методы -----------------
+    def _messages_send(self, params: dict):
+        code = self.fail_peers.get(int(params.get("peer_id") or 0))
+        if code:
+            raise FakeApiError(code, "Can't send messages to this peer")
+        return len(self.calls)
+
+    def _messages_removeChatUser(self, params: dict):
+        peer_id = 2000000000 + int(params["chat_id"])
+        uid = int(params.get("user_id") or params.get("member_id"))
+        members = self.members.get(peer_id, set())
+        if uid not in members:
+            raise FakeApiError(935, "User not found in chat")
+        members.discard(uid)
+        return 1
+
+    def _messages_getConversationMembers(self, params: dict):
+        peer_id = int(params["peer_id"])
+        if peer_id not in self.members:
+            raise FakeApiError(917, "You don't have access to this chat")
+        members = sorted(self.members[peer_id])
+        offset = int(params.get("offset") or 0)
+        count = int(params.get("count") or 20)
+        items = [{"member_id": m} for m in members[offset:offset + count]]
+        return {"count": len(members), "items": items}
+
+    _CALL_RE = re.compile(r"API\.([A-Za-z.]+)\(")
+
+    def _execute(self, params: dict):
+        """
+        Разбирает код вида `return [API.method({...}),...];` (так его строит vk_batch)
+        и возвращает сырой ответ как VK: false на месте неудачных вызовов + execute_errors.
+        """
+        code = params.get("code", "")
+        decoder = json.JSONDecoder()
+        response, errors = [], []
+        pos = 0
+        while True:
+            m = self._CALL_RE.search(code, pos)
+            if not m:
+                break
+            sub_params, end = decoder.raw_decode(code, m.end())
+            pos = end
+            method = m.group(1)
+            try:
+                response.append(self._dispatch(method, sub_params))
+            except FakeApiError as e:
+                response.append(False)
+                errors.append({"method": method, "error_code": e.code, "error_msg": str(e)})
+        raw = {"response": response}
+        if errors:
+            raw["execute_errors"] = errors
+        return raw
+
+    def _utils_resolveScreenName(self, params: dict):
+        found = self.screen_names.get(str(params.get("screen_name", "")).lower())
+        if not found:
+            return []    # VK отвечает пустым массивом на несуществующее имя
+        return {"type": found[0], "object_id": found[1]}
+
+    def _users_get(self, params: dict):
+        res = []
+        for raw in str(params.get("user_ids", "")).split(","):
+            raw = raw.strip()
+            if not raw.lstrip("-").isdigit():
+                continue
+            uid = int(raw)
+            first, last = self.profiles.get(uid, (f"User{uid}", "Test"))
+            res.append({"id": uid, "first_name": first, "last_name": last})
+        return res
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+logstore.py
+Хранилище логов бота: активный файл + сжатые сегменты с индексом по времени.
+
+- SegmentHandler пишет в активный файл (LOG_PATH) и закрывает сегмент по размеру
+  (LOG_SEGMENT_BYTES) или возрасту (LOG_SEGMENT_SECONDS): файл сжимается в
+  logs/<имя>_<начало>.log.gz, а в logs/<имя>.index.jsonl добавляется строка
+  {"file", "start", "end", "lines", "levels"}; хранятся последние LOG_KEEP_SEGMENTS сегментов;
+- setup_queue_logging() вешает на корневой логгер QueueHandler: запись в лог — это
+  put в очередь, диск и сжатие — в потоке QueueListener;
+- export_logs() по индексу выбирает только сегменты, пересекающиеся с интервалом и
+  содержащие записи нужного уровня, и потоком пишет подходящие строки в .log.gz.
+
+Запуск как скрипта — проверка на временном каталоге:
+    python logstore.py
+"""
+import os
+import re
+import json
+import gzip
+import atexit
+import time
+import queue
+import shutil
+import logging
+import logging.handlers
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("vk_moder_bot")
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+LOG_SEGMENT_BYTES = int(os.getenv("LOG_SEGMENT_BYTES") or 5 * 1024 * 1024)
+LOG_SEGMENT_SECONDS = int(os.getenv("LOG_SEGMENT_SECONDS") or 24 * 3600)
+LOG_KEEP_SEGMENTS = int(os.getenv("LOG_KEEP_SEGMENTS") or 60)
+SEGMENTS_SUBDIR = "logs"
+COPY_CHUNK = 1024 * 1024
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+LEVELS = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARNING": logging.WARNING,
+          "ERROR": logging.ERROR, "CRITICAL": logging.CRITICAL}
+_LINE_RE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d+ \[([A-Z]+)\]")
+
+def parse_line(line: str) -> Optional[Tuple[float, str]]:
+    """(время, уровень) для первой строки записи; None — строка-продолжение (traceback)."""
+    m = _LINE_RE.match(line)
+    if not m:
+        return None
+    ts = datetime.datetime.strptime(m.group(1), "%Y-%m-%d %H:%M:%S").timestamp()
+    return ts, m.group(2)
+
+def segments_dir(log_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(log_path)), SEGMENTS_SUBDIR)
+
+def _stem(log_path: str) -> str:
+    return os.path.splitext(os.path.basename(log_path))[0]
+
+def read_index(index_path: str) -> List[dict]:
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# ----------------- Запись -----------------
+class SegmentHandler(logging.Handler):
+    """Активный файл лога с ротацией в сжатые сегменты; вызывается из потока QueueListener."""
+    def __init__(self, log_path: str, max_bytes: int = LOG_SEGMENT_BYTES, max_age: int = LOG_SEGMENT_SECONDS,
+                 keep: int = LOG_KEEP_SEGMENTS):
+        super().__init__()
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self.dir = segments_dir(log_path)
+        self.index_path = os.path.join(self.dir, f"{_stem(log_path)}.index.jsonl")
+        os.makedirs(self.dir, exist_ok=True)
+        # лог прошлого запуска закрывается сегментом при первой записи (сканирование — не в потоке старта)
+        self._adopt = os.path.exists(log_path) and os.path.getsize(log_path) > 0
+        self._stream = open(log_path, "a", encoding="utf-8")
+        self._reset()
+        self.rotations = 0
+
+    def _reset(self):
+        self.start = None
+        self.end = None
+        self.lines = 0
+        self.levels: Dict[str, int] = {}
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self._adopt:
+                self._adopt = False
+                self._adopt_existing()
+            msg = self.format(record) + "\n"
+            self._stream.write(msg)
+            self._stream.flush()
+            if self.start is None:
+                self.start = record.created
+            self.end = record.created
+            self.lines += msg.count("\n")
+            self.levels[record.levelname] = self.levels.get(record.levelname, 0) + 1
+            if self._stream.tell() >= self.max_bytes or record.created - self.start >= self.max_age:
+                self.rotate()
+        except Exception:
+            self.handleError(record)
+
+    def _adopt_existing(self):
+        with open(self.log_path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                self.lines += 1
+                parsed = parse_line(line)
+                if parsed:
+                    ts, level = parsed
+                    self.start = ts if self.start is None else self.start
+                    self.end = ts
+                    self.levels[level] = self.levels.get(level, 0) + 1
+        if self.start is None:
+            self.start = self.end = os.path.getmtime(self.log_path)
+        self.rotate()
+
+    def rotate(self):
+        """Закрывает активный файл сегментом и начинает новый."""
+        with self.lock:
+            self._stream.close()
+            name = f"{_stem(self.log_path)}_{datetime.datetime.fromtimestamp(self.start or time.time()):%Y%m%d_%H%M%S}"
+            seg = os.path.join(self.dir, name + ".log.gz")
+            n = 1
+            while os.path.exists(seg):
+                n += 1
+                seg = os.path.join(self.dir, f"{name}_{n}.log.gz")
+            with open(self.log_path, "rb") as fin, gzip.open(seg, "wb", compresslevel=6) as fout:
+                shutil.copyfileobj(fin, fout, COPY_CHUNK)
+            entry = {"file": os.path.basename(seg), "start": self.start, "end": self.end,
+                     "lines": self.lines, "levels": self.levels}
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._stream = open(self.log_path, "w", encoding="utf-8")
+            self._reset()
+            self.rotations += 1
+            self._retain()
+
+    def _retain(self):
+        entries = read_index(self.index_path)
+        if len(entries) <= self.keep:
+            return
+        drop, keep = entries[:-self.keep], entries[-self.keep:]
+        for e in drop:
+            try:
+                os.remove(os.path.join(self.dir, e["file"]))
+            except FileNotFoundError:
+                pass
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for e in keep:
+                f.write(json.dumps(e, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.index_path)
+
+    def close(self):
+        with self.lock:
+            if self._stream and not self._stream.closed:
+                self._stream.close()
+        super().close()
+
+def setup_queue_logging(log_path: Optional[str], level: int = logging.INFO) -> logging.handlers.QueueListener:
+    """
+    Корневой логгер -> QueueHandler -> (поток) SegmentHandler + консоль.
+    Повторный вызов заменяет прежнюю настройку. Возвращает запущенный QueueListener.
+    """
+    global _listener
+    root = logging.getLogger()
+    if _listener is None:
+        atexit.register(stop_logging)    # дописать то, что осталось в очереди
+    stop_logging()
+    for h in list(root.handlers):
+        if isinstance(h, logging.handlers.QueueHandler):
+            root.removeHandler(h)
+    fmt = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_path:
+        handlers.insert(0, SegmentHandler(log_path))
+    for h in handlers:
+        h.setFormatter(fmt)
+    q = queue.SimpleQueue()    # без ограничения: put из потоков бота никогда не ждёт
+    root.addHandler(logging.handlers.QueueHandler(q))
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for h in _listener.handlers:
+            h.close()
+        _listener = None
+
+def segment_handler() -> Optional[SegmentHandler]:
+    for h in (_listener.handlers if _listener else ()):
+        if isinstance(h, SegmentHandler):
+            return h
+    return None
+
+# ----------------- Экспорт -----------------
+def _filter_lines(lines, start: Optional[float], end: Optional[float], min_level: int, out) -> int:
+    """Пишет в out строки записей из интервала с уровнем >= min_level (с их продолжениями)."""
+    written = 0
+    keep = False
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed:
+            ts, level = parsed
+            keep = ((start is None or ts >= start) and (end is None or ts <= end)
+                    and LEVELS.get(level, logging.INFO) >= min_level)
+        if keep:
+            out.write(line)
+            written += 1
+    return written
+
+def _segment_matches(e: dict, start: Optional[float], end: Optional[float], min_level: int) -> bool:
+    if start is not None and e["end"] is not None and e["end"] < start - 1:
+        return False
+    if end is not None and e["start"] is not None and e["start"] > end + 1:
+        return False
+    return any(LEVELS.get(lv, logging.INFO) >= min_level and n for lv, n in e["levels"].items())
+
+def export_logs(log_path: str, dest_dir: str, start: Optional[float] = None, end: Optional[float] = None,
+                min_level: int = logging.DEBUG) -> Tuple[Optional[str], dict]:
+    """
+    Экспорт в dest_dir/moder_bot_log_<время>.log.gz. Берутся сегменты всех логов с тем же
+    базовым именем (moder_bot.log и логи шардов moder_bot.shardN.log), затем активные файлы.
+    Возвращает (путь или None, если ничего не подошло; статистика).
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    sdir = segments_dir(log_path)
+    stem = _stem(log_path)
+    stores = [stem]
+    if os.path.isdir(sdir):
+        stores += sorted(f[:-len(".index.jsonl")] for f in os.listdir(sdir)
+                         if f.endswith(".index.jsonl") and f.startswith(stem + ".") and f != f"{stem}.index.jsonl")
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    dst = os.path.join(dest_dir, f"moder_bot_log_{ts}.log.gz")
+    n = 1
+    while os.path.exists(dst):
+        n += 1
+        dst = os.path.join(dest_dir, f"moder_bot_log_{ts}_{n}.log.gz")
+    stats = {"segments": 0, "skipped": 0, "lines": 0}
+    own = segment_handler()
+    with gzip.open(dst, "wt", encoding="utf-8", compresslevel=6) as out:
+        for name in stores:
+            for e in read_index(os.path.join(sdir, f"{name}.index.jsonl")):
+                if not _segment_matches(e, start, end, min_level):
+                    stats["skipped"] += 1
+                    continue
+                try:
+                    with gzip.open(os.path.join(sdir, e["file"]), "rt", encoding="utf-8", errors="replace") as f:
+                        stats["lines"] += _filter_lines(f, start, end, min_level, out)
+                    stats["segments"] += 1
+                except FileNotFoundError:
+                    pass    # сегмент удалён ротацией во время экспорта
+            active = os.path.join(os.path.dirname(os.path.abspath(log_path)), name + ".log")
+            if not os.path.exists(active):
+                continue
+            # свой активный файл читаем под замком обработчика, чтобы он не ушёл в сегмент посреди чтения
+            lock = own.lock if own is not None and os.path.abspath(own.log_path) == active else None
+            if lock:
+                lock.acquire()
+                current = {"start": own.start, "end": own.end, "levels": own.levels}
+                if not own._adopt and (own.start is None or not _segment_matches(current, start, end, min_level)):
+                    lock.release()
+                    stats["skipped"] += 1
+                    continue
+            try:
+                with open(active, encoding="utf-8", errors="replace") as f:
+                    stats["lines"] += _filter_lines(f, start, end, min_level, out)
+                stats["segments"] += 1
+            finally:
+                if lock:
+                    lock.release()
+    if not stats["lines"]:
+        os.remove(dst)
+        return None, stats
+    return dst, stats
+
+# ----------------- Аргументы /exportlogs -----------------
+_DURATION_RE = re.compile(r"^(\d+)(m|h|d|м|ч|д)$")
+_DURATION_UNITS = {"m": 60, "м": 60, "h": 3600, "ч": 3600, "d": 86400, "д": 86400}
+_LEVEL_ALIASES = {"debug": "DEBUG", "info": "INFO", "инфо": "INFO", "warn": "WARNING", "warning": "WARNING",
+                  "предупреждения": "WARNING", "error": "ERROR", "ошибки": "ERROR", "critical": "CRITICAL"}
+_DATE_FORMATS = ("%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d", "%d.%m.%Y %H:%M", "%d.%m.%Y")
+
+def _parse_dt(text: str) -> Optional[float]:
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            continue
+    return None
+
+def parse_export_args(args: List[str], now: Optional[float] = None) -> Tuple[Optional[float], Optional[float], int]:
+    """
+    [длительность | начало [конец]] [уровень]:
+      2h / 30м / 1д — за последние N;  2026-10-17 [10:00] / 17.10.2026 — начало и конец интервала;
+      error / warning / ошибки — только записи этого уровня и выше.
+    Возвращает (start, end, min_level); ValueError с текстом для пользователя.
+    """
+    now = time.time() if now is None else now
+    start = end = None
+    min_level = logging.DEBUG
+    i = 0
+    while i < len(args):
+        tok = args[i].lower()
+        m = _DURATION_RE.match(tok)
+        if tok in _LEVEL_ALIASES:
+            min_level = LEVELS[_LEVEL_ALIASES[tok]]
+        elif m:
+            start = now - int(m.group(1)) * _DURATION_UNITS[m.group(2)]
+        else:
+            # дата и время могут прийти отдельными аргументами
+            ts = None
+            if i + 1 < len(args) and re.match(r"^\d\d?:\d\d$", args[i + 1]):
+                ts = _parse_dt(f"{args[i]} {args[i + 1]}")
+                if ts is not None:
+                    i += 1
+            if ts is None:
+                ts = _parse_dt(args[i])
+            if ts is None:
+                raise ValueError(f"не понял «{args[i]}»: ожидается 2h/30m/1d, дата ГГГГ-ММ-ДД [ЧЧ:ММ] или уровень")
+            if start is None:
+                start = ts
+            elif end is None:
+                end = ts + (59 if ":" in args[i] else 86399)    # конец указанной минуты/дня
+            else:
+                raise ValueError("укажите не больше двух дат")
+        i += 1
+    if start is not None and end is not None and end < start:
+        raise ValueError("конец интервала раньше начала")
+    return start, end, min_level
+
+# ----------------- Проверка -----------------
+def selftest():
+    import tempfile
+    workdir = tempfile.mkdtemp(prefix="vk_logs_")
+    log_path = os.path.join(workdir, "moder_bot.log")
+    with open(log_path, "w", encoding="utf-8") as f:
+        f.write("2020-01-01 10:00:00,000 [INFO] лог прошлого запуска\n")
+    setup_queue_logging(log_path)
+    h = segment_handler()
+    h.max_bytes = 20 * 1024
+    log = logging.getLogger("vk_moder_bot")
+    t0 = time.perf_counter()
+    for i in range(3000):
+        if i % 500 == 0:
+            try:
+                raise RuntimeError(f"сбой {i}")
+            except RuntimeError:
+                log.exception("ошибка обработки %s", i)
+        else:
+            log.info("событие %s %s", i, "x" * 40)
+    put = time.perf_counter() - t0
+    stop_logging()
+    entries = read_index(h.index_path)
+    print(f"3000 записей в очередь за {put * 1000:.1f} мс, сегментов: {len(entries)}, ротаций: {h.rotations}")
+    assert entries[0]["start"] == datetime.datetime(2020, 1, 1, 10).timestamp()
+    assert len(entries) > 5
+
+    dst, stats = export_logs(log_path, os.path.join(workdir, "export"), min_level=logging.ERROR)
+    with gzip.open(dst, "rt", encoding="utf-8") as f:
+        text = f.read()
+    print(f"ошибки: {stats}")
+    assert text.count("[ERROR]") == 6 and "Traceback" in text and "[INFO]" not in text
+    assert stats["skipped"] > 0
+
+    dst, stats = export_logs(log_path, os.path.join(workdir, "export"), *parse_export_args(["2020-01-01", "2020-01-01"])[:2])
+    with gzip.open(dst, "rt", encoding="utf-8") as f:
+        assert f.read() == "2020-01-01 10:00:00,000 [INFO] лог прошлого запуска\n"
+    print(f"2020-01-01: {stats}")
+
+    s, e, lv = parse_export_args(["2h", "ошибки"], now=10000.0)
+    assert (s, e, lv) == (2800.0, None, logging.ERROR)
+    s, e, _ = parse_export_args(["2026-10-17", "10:00", "2026-10-17", "12:30"])
+    assert e - s == 2.5 * 3600 + 59
+    h._retain()
+    h.keep = 2
+    h._retain()
+    assert len(read_index(h.index_path)) == 2 and len([f for f in os.listdir(h.dir) if f.endswith(".gz")]) == 2
+    print("ok")
+
+if __name__ == "__main__":
+    selftest()
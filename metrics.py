@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+metrics.py
+Метрики в текстовом формате Prometheus и встроенный HTTP-сервер для них.
+
+- Counter и Histogram обновляются в момент события (с метками);
+- collect() регистрирует значения, которые вычисляются при запросе /metrics:
+  глубина очередей, счётчики из уже существующих объектов, доли попаданий кэшей;
+- MetricsServer отдаёт /metrics и /health (liveness в JSON, 503 если проверка не прошла);
+  на нём же можно повесить POST-обработчики (приём Callback API бота).
+
+Без внешних зависимостей: http.server из стандартной библиотеки.
+
+Запуск как скрипта — проверка формата вывода:
+    python metrics.py
+"""
+import json
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("vk_moder_bot")
+
+# секунды; подходят и для команд бота, и для вызовов VK API
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# секунды; запросы SQLite обычно укладываются в доли миллисекунды
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Iterable[str], values: Iterable, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labels, k)} {_num(v)}" for k, v in items]
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}    # метки -> [счётчики по корзинам..., +Inf, сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(label_values)
+            if s is None:
+                s = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        lines = []
+        for key, s in items:
+            acc = 0
+            for le, n in zip(self.buckets + (float("inf"),), s[:-1]):
+                acc += n
+                le_label = 'le="%s"' % _num(le)
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le_label)} {acc}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_num(s[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {acc}")
+        return lines
+
+class Collected:
+    """Значение, вычисляемое при запросе: fn() -> число или {значения меток: число}."""
+    def __init__(self, name: str, help_text: str, kind: str, fn: Callable, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.fn = fn
+        self.labels = labels
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.debug("metric %s collect error: %s", self.name, e)
+            return []
+        if not isinstance(value, dict):
+            return [f"{self.name} {_num(value)}"]
+        out = []
+        for key, v in sorted(value.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            out.append(f"{self.name}{_labels(self.labels, key)} {_num(v)}")
+        return out
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def collect(self, name: str, help_text: str, fn: Callable, kind: str = "gauge", labels: Tuple[str, ...] = ()):
+        """Регистрирует (или заменяет) вычисляемую метрику kind = gauge | counter."""
+        return self._add(Collected(name, help_text, kind, fn, labels))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        out = []
+        for m in metrics:
+            kind = m.kind if isinstance(m, Collected) else ("counter" if isinstance(m, Counter) else "histogram")
+            out.append(f"# HELP {m.name} {m.help_text}")
+            out.append(f"# TYPE {m.name} {kind}")
+            out.extend(m.render())
+        return "\n".join(out) + "\n"
+
+# ----------------- HTTP-сервер -----------------
+class MetricsServer:
+    """
+    GET /metrics — текст Prometheus; GET /health и / — liveness:
+    health_fn() -> (ok, подробности); при ok=False ответ 503.
+    POST — обработчики из add_post(path, fn), fn(тело запроса) -> (код, текст ответа).
+    """
+    def __init__(self, registry: Registry, port: int, health_fn: Optional[Callable[[], Tuple[bool, dict]]] = None,
+                 host: str = "0.0.0.0"):
+        self.registry = registry
+        self.health_fn = health_fn or (lambda: (True, {}))
+        self.port = port
+        self.host = host
+        self._post_routes: Dict[str, Callable[[bytes], Tuple[int, str]]] = {}
+        self._httpd = None
+
+    def add_post(self, path: str, fn: Callable[[bytes], Tuple[int, str]]):
+        self._post_routes[path] = fn
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/metrics":
+                    self._reply(200, server.registry.render(), "text/plain; version=0.0.4; charset=utf-8")
+                elif path in ("/", "/health"):
+                    ok, info = server.health_fn()
+                    body = json.dumps(dict(info, status="ok" if ok else "stale"), ensure_ascii=False)
+                    self._reply(200 if ok else 503, body + "\n", "application/json; charset=utf-8")
+                else:
+                    self._reply(404, "not found\n", "text/plain; charset=utf-8")
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_POST(self):
+                fn = server._post_routes.get(self.path.split("?", 1)[0])
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if fn is None:
+                    return self._reply(404, "not found\n", "text/plain; charset=utf-8")
+                try:
+                    code, text = fn(body)
+                except Exception as e:
+                    logger.exception("POST %s error: %s", self.path, e)
+                    code, text = 500, "error"
+                self._reply(code, text, "text/plain; charset=utf-8")
+
+            def _reply(self, code: int, body: str, ctype: str):
+                data = body.encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(data)
+
+            def log_message(self, fmt, *args):
+                pass    # запросы Prometheus и health-check не засоряют лог
+
+        return Handler
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.host, self.port), self._handler())
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info("Метрики: http://%s:%s/metrics", self.host, self.port)
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+# ----------------- Проверка формата -----------------
+def selftest():
+    import urllib.request
+    reg = Registry()
+    c = reg.counter("demo_calls_total", "Вызовы", ("method",))
+    h = reg.histogram("demo_seconds", "Время", ("method",), buckets=(0.1, 1.0))
+    reg.collect("demo_depth", "Глубина очереди", lambda: 3)
+    reg.collect("demo_hit_ratio", "Попадания", lambda: {"names": 0.5}, labels=("cache",))
+    c.inc("messages.send")
+    c.inc("messages.send")
+    h.observe(0.05, 'a"b')
+    h.observe(2.0, 'a"b')
+    srv = MetricsServer(reg, 0, lambda: (False, {"age": 1}), host="127.0.0.1")
+    srv.start()
+    port = srv._httpd.server_address[1]
+    text = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics").read().decode()
+    print(text)
+    assert 'demo_calls_total{method="messages.send"} 2' in text
+    assert 'demo_seconds_bucket{method="a\\"b",le="0.1"} 1' in text
+    assert 'demo_seconds_bucket{method="a\\"b",le="+Inf"} 2' in text
+    assert 'demo_seconds_count{method="a\\"b"} 2' in text
+    assert "demo_depth 3" in text and 'demo_hit_ratio{cache="names"} 0.5' in text
+    try:
+        urllib.request.urlopen(f"http://127.0.0.1:{port}/health")
+        raise AssertionError("health должен вернуть 503")
+    except urllib.error.HTTPError as e:
+        assert e.code == 503
+    srv.stop()
+    print("ok")
+
+if __name__ == "__main__":
+    selftest()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+migrations.py
+Версионированные миграции схемы БД модератор-бота.
+
+Каждая миграция — (версия, имя, функция(conn)). Применённые версии записываются
+в таблицу schema_version, каждая миграция выполняется в своей транзакции.
+Используется и ботом (init_db), и отдельным скриптом create_db.py, поэтому
+схема описана ровно в одном месте.
+"""
+import sqlite3
+import logging
+import datetime
+from typing import Callable, Iterable, List, Tuple
+
+logger = logging.getLogger("vk_moder_bot")
+
+# ----------------- Каноническая схема -----------------
+TABLES = {
+    "warns": """CREATE TABLE IF NOT EXISTS warns (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    issued_by INTEGER,
+                    reason TEXT,
+                    timestamp TEXT,
+                    peer_id INTEGER NOT NULL DEFAULT 0
+                )""",
+    "mutes": """CREATE TABLE IF NOT EXISTS mutes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    issued_by INTEGER,
+                    until TEXT,
+                    reason TEXT,
+                    peer_id INTEGER NOT NULL DEFAULT 0
+                )""",
+    "roles": """CREATE TABLE IF NOT EXISTS roles (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    role TEXT,
+                    peer_id INTEGER NOT NULL DEFAULT 0
+                )""",
+    "blacklist": """CREATE TABLE IF NOT EXISTS blacklist (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    word TEXT UNIQUE
+                )""",
+    "bans": """CREATE TABLE IF NOT EXISTS bans (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    issued_by INTEGER,
+                    until TEXT,
+                    reason TEXT,
+                    peer_id INTEGER NOT NULL DEFAULT 0
+                )""",
+    "chats": """CREATE TABLE IF NOT EXISTS chats (
+                    peer_id INTEGER PRIMARY KEY
+                )""",
+}
+
+# колонки канонических таблиц (кроме id) — по ним переносим данные при пересборке
+TABLE_COLUMNS = {
+    "warns": ["user_id", "issued_by", "reason", "timestamp", "peer_id"],
+    "mutes": ["user_id", "issued_by", "until", "reason", "peer_id"],
+    "roles": ["user_id", "role", "peer_id"],
+    "blacklist": ["word"],
+    "bans": ["user_id", "issued_by", "until", "reason", "peer_id"],
+}
+
+# ----------------- Вспомогательные функции -----------------
+def _columns(conn: sqlite3.Connection, table: str) -> List[Tuple]:
+    return conn.execute(f"PRAGMA table_info({table})").fetchall()
+
+def _has_int_pk(conn: sqlite3.Connection, table: str, col: str = "id") -> bool:
+    # (cid, name, type, notnull, dflt_value, pk)
+    for c in _columns(conn, table):
+        if c[1] == col and c[5] == 1 and (c[2] or "").upper() == "INTEGER":
+            return True
+    return False
+
+def _rebuild_table(conn: sqlite3.Connection, table: str):
+    """
+    Пересобирает таблицу по канонической схеме: id становится INTEGER PRIMARY KEY
+    (значения берутся из rowid, порядок вставки сохраняется), отсутствующий peer_id = 0.
+    """
+    old_cols = {c[1] for c in _columns(conn, table)}
+    tmp = f"{table}__old"
+    conn.execute(f"ALTER TABLE {table} RENAME TO {tmp}")
+    conn.execute(TABLES[table])
+    select = []
+    for col in TABLE_COLUMNS[table]:
+        if col == "peer_id":
+            select.append("COALESCE(peer_id, 0)" if "peer_id" in old_cols else "0")
+        elif col in old_cols:
+            select.append(col)
+        else:
+            select.append("NULL")
+    cols = ", ".join(TABLE_COLUMNS[table])
+    conn.execute(f"INSERT INTO {table} (id, {cols}) SELECT rowid, {', '.join(select)} FROM {tmp} ORDER BY rowid")
+    conn.execute(f"DROP TABLE {tmp}")
+    logger.info("Таблица %s пересобрана по канонической схеме", table)
+
+# ----------------- Миграции -----------------
+def m001_base_tables(conn: sqlite3.Connection):
+    for ddl in TABLES.values():
+        conn.execute(ddl)
+
+def m002_reconcile_schemas(conn: sqlite3.Connection):
+    """
+    Сводит две исторические схемы (create_db.py и старый init_db) к одной:
+    - id без PRIMARY KEY (старый init_db не заполнял его при INSERT) -> INTEGER PRIMARY KEY;
+    - chats(chat_id) из create_db.py -> chats(peer_id).
+    """
+    for t in TABLE_COLUMNS:
+        if not _has_int_pk(conn, t):
+            _rebuild_table(conn, t)
+    cols = {c[1] for c in _columns(conn, "chats")}
+    if "peer_id" not in cols:
+        conn.execute("ALTER TABLE chats RENAME TO chats__old")
+        conn.execute(TABLES["chats"])
+        src = "chat_id" if "chat_id" in cols else "rowid"
+        conn.execute(f"""INSERT OR IGNORE INTO chats (peer_id)
+                         SELECT CASE WHEN {src} < 2000000000 THEN {src} + 2000000000 ELSE {src} END
+                         FROM chats__old WHERE {src} IS NOT NULL""")
+        conn.execute("DROP TABLE chats__old")
+        logger.info("Таблица chats переведена на колонку peer_id")
+
+def m003_hot_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_roles_user_peer ON roles(user_id, peer_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_roles_peer ON roles(peer_id, role)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mutes_user_peer ON mutes(user_id, peer_id, until)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mutes_until ON mutes(until)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bans_user_peer ON bans(user_id, peer_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_warns_user_peer ON warns(user_id, peer_id)")
+
+def m004_broadcast_jobs(conn: sqlite3.Connection):
+    conn.execute("""CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        author_id INTEGER,
+                        origin_peer INTEGER,
+                        message TEXT,
+                        status TEXT NOT NULL DEFAULT 'running',
+                        created_at TEXT,
+                        finished_at TEXT
+                    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                        job_id INTEGER NOT NULL,
+                        peer_id INTEGER NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        error TEXT,
+                        PRIMARY KEY (job_id, peer_id)
+                    ) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status ON broadcast_deliveries(job_id, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+
+def m005_screen_names(conn: sqlite3.Connection):
+    # user_id NULL — отрицательный кэш (такого короткого имени нет)
+    conn.execute("""CREATE TABLE IF NOT EXISTS screen_names (
+                        name TEXT PRIMARY KEY,
+                        user_id INTEGER,
+                        expires_at INTEGER NOT NULL
+                    ) WITHOUT ROWID""")
+
+def m006_audit_log(conn: sqlite3.Connection):
+    # журнал только дописывается; ts — unix-время в секундах, details — JSON с подробностями действия
+    conn.execute("""CREATE TABLE IF NOT EXISTS audit_log (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        ts INTEGER NOT NULL,
+                        action TEXT NOT NULL,
+                        actor_id INTEGER,
+                        target_id INTEGER,
+                        peer_id INTEGER NOT NULL DEFAULT 0,
+                        reason TEXT,
+                        details TEXT
+                    )""")
+    # в индексе неявно лежит id (rowid), поэтому ORDER BY ts DESC, id DESC тоже идёт по индексу
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_actor ON audit_log(actor_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_target ON audit_log(target_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_peer ON audit_log(peer_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_ts ON audit_log(ts)")
+
+def m007_punishment_counts(conn: sqlite3.Connection):
+    # (user_id, peer_id, kind) -> выдано / действует / истекло; -1 в user_id или peer_id — строка-итог
+    conn.execute("""CREATE TABLE IF NOT EXISTS punishment_counts (
+                        user_id INTEGER NOT NULL,
+                        peer_id INTEGER NOT NULL,
+                        kind TEXT NOT NULL,
+                        issued INTEGER NOT NULL DEFAULT 0,
+                        active INTEGER NOT NULL DEFAULT 0,
+                        expired INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (user_id, peer_id, kind)
+                    ) WITHOUT ROWID""")
+    # заполняем по текущим строкам: всё, что лежит в таблицах, считается действующим
+    # (истёкшие, но ещё не снятые муты планировщик переведёт в expired после старта)
+    for table, kind in (("warns", "warn"), ("mutes", "mute"), ("bans", "ban")):
+        for group, cols in (("user_id, peer_id", "user_id, peer_id"), ("user_id", "user_id, -1"), ("", "-1, -1")):
+            conn.execute(f"""INSERT INTO punishment_counts (user_id, peer_id, kind, issued, active, expired)
+                             SELECT {cols}, '{kind}', COUNT(*), COUNT(*), 0 FROM {table}
+                             {'GROUP BY ' + group if group else ''} HAVING COUNT(*) > 0""")
+
+def m008_warn_ladder(conn: sqlite3.Connection):
+    # правила эскалации: peer_id = 0 — правила по умолчанию для бесед без своих; window_days = 0 — без окна
+    conn.execute("""CREATE TABLE IF NOT EXISTS warn_rules (
+                        peer_id INTEGER NOT NULL,
+                        threshold INTEGER NOT NULL,
+                        window_days INTEGER NOT NULL DEFAULT 0,
+                        action TEXT NOT NULL,
+                        minutes INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (peer_id, threshold, window_days)
+                    ) WITHOUT ROWID""")
+    # счёт варнов в беседе за окно времени и пакетное снятие истёкших
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_warns_user_peer_ts ON warns(user_id, peer_id, timestamp)")
+    conn.execute("DROP INDEX IF EXISTS idx_warns_user_peer")    # префикс нового индекса
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_warns_ts ON warns(timestamp)")
+
+def m009_screen_names_expiry(conn: sqlite3.Connection):
+    # периодическая чистка истёкших коротких имён
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_screen_names_expires ON screen_names(expires_at)")
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "base_tables", m001_base_tables),
+    (2, "reconcile_schemas", m002_reconcile_schemas),
+    (3, "hot_indexes", m003_hot_indexes),
+    (4, "broadcast_jobs", m004_broadcast_jobs),
+    (5, "screen_names", m005_screen_names),
+    (6, "audit_log", m006_audit_log),
+    (7, "punishment_counts", m007_punishment_counts),
+    (8, "warn_ladder", m008_warn_ladder),
+    (9, "screen_names_expiry", m009_screen_names_expiry),
+]
+
+# ----------------- Запуск -----------------
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT,
+                        applied_at TEXT
+                    )""")
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return int(row[0] or 0)
+
+def run_migrations(conn: sqlite3.Connection) -> int:
+    """
+    Применяет по порядку все миграции новее текущей версии.
+    Соединение должно быть в autocommit (isolation_level=None): транзакциями управляем сами.
+    Возвращает итоговую версию схемы.
+    """
+    version = get_schema_version(conn)
+    for ver, name, fn in MIGRATIONS:
+        if ver <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            fn(conn)
+            ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?,?,?)", (ver, name, ts))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            logger.exception("Миграция %s (%s) не применена", ver, name)
+            raise
+        version = ver
+        logger.info("Применена миграция %s: %s", ver, name)
+    return version
+
+# ----------------- Проверка планов запросов -----------------
+# Список запросов не ведётся вручную: бот записывает SQL, который действительно выполняет
+# (vk_moder_bot.executed_queries), и tests/test_query_plans.py проверяет их планы на свежей базе.
+def _plan_problem(sql: str, detail: str) -> bool:
+    """Полный проход по таблице в запросе с условием — проблема; загрузка таблицы целиком (без WHERE) — нет."""
+    if not detail.startswith("SCAN") or detail.startswith(("SCAN (subquery", "SCAN CONSTANT ROW")):
+        return False
+    return " WHERE " in " ".join(sql.upper().split())
+
+def check_query_plans(conn: sqlite3.Connection, queries: Iterable[str]) -> List[str]:
+    """
+    Прогоняет EXPLAIN QUERY PLAN для каждого запроса (параметры — NULL).
+    Возвращает список проблем (пустой — все запросы с условием идут по индексам).
+    """
+    problems = []
+    for sql in sorted(set(queries)):
+        if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+            continue
+        label = " ".join(sql.split())[:100]
+        try:
+            plan = conn.execute("EXPLAIN QUERY PLAN " + sql, (None,) * sql.count("?")).fetchall()
+        except Exception as e:
+            problems.append(f"{label}: {e}")
+            continue
+        for row in plan:
+            if _plan_problem(sql, row[-1]):
+                problems.append(f"{label}: {row[-1]}")
+    return problems
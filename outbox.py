@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+outbox.py
+Очередь исходящих сообщений с ограничением частоты запросов к VK API.
+
+- token bucket под лимит группы (по умолчанию 15 запросов/с из 20 допустимых —
+  запас под messages.delete / users.get и прочие вызовы бота);
+- приоритетные полосы: уведомления модерации уходят раньше рассылок;
+  в полосе у каждой беседы своя очередь, беседы обслуживаются по кругу;
+- повтор с экспоненциальной паузой при "Too many requests" и временных ошибках:
+  сообщение ждёт своего времени (not_before) в очереди беседы, поток отправки не спит,
+  остальные беседы и полосы продолжают уходить; random_id сохраняется между попытками,
+  поэтому VK не продублирует сообщение;
+- несколько ожидающих подряд текстов в одну беседу склеиваются в один messages.send
+  (склейка останавливается на первом сообщении, которое склеить нельзя, — порядок не меняется).
+
+Модуль не зависит от vk_api: отправка передаётся функцией send_fn(params) -> result,
+а ошибка VK распознаётся по атрибуту code.
+
+Запуск как скрипта — прогон на фейковом VK API (fake_vk.py):
+    python outbox.py [--messages N] [--peers N]
+"""
+import sys
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from collections import deque
+from typing import Callable, List, Optional
+
+logger = logging.getLogger("vk_moder_bot")
+
+PRIORITY_HIGH = 0     # уведомления модерации (наказания, ЧС, снятие мутов)
+PRIORITY_NORMAL = 1   # ответы на команды
+PRIORITY_LOW = 2      # массовые рассылки
+
+# коды ошибок VK, после которых имеет смысл повторить запрос
+RETRY_CODES = {1, 6, 10}     # неизвестная ошибка, слишком много запросов, внутренняя ошибка сервера
+RATE_LIMIT_CODE = 6
+MAX_MESSAGE_LEN = 4096
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Блокирует, пока не появится токен."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self):
+        """После ответа "слишком много запросов" — обнуляем запас, чтобы притормозить."""
+        with self._lock:
+            self._tokens = 0
+            self._ts = time.monotonic()
+
+class OutMessage:
+    __slots__ = ("peer_id", "text", "attachment", "priority", "callbacks", "random_id", "attempts", "not_before")
+
+    def __init__(self, peer_id: int, text: str, attachment: Optional[str], priority: int, callback):
+        self.peer_id = peer_id
+        self.text = text
+        self.attachment = attachment
+        self.priority = priority
+        self.callbacks = [callback] if callback else []
+        self.random_id = None
+        self.attempts = 0
+        self.not_before = 0.0    # monotonic: раньше этого времени повтор не отправляется
+
+class Outbox:
+    def __init__(self, send_fn: Callable[[dict], object], rate: float = 15, burst: Optional[float] = None,
+                 max_retries: int = 5, base_delay: float = 0.5, coalesce: bool = True):
+        self.send_fn = send_fn
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.coalesce = coalesce
+        self._lanes = [deque(), deque(), deque()]    # (приоритет, peer_id) бесед, готовых к отправке
+        self._queues = {}                              # (приоритет, peer_id) -> deque[OutMessage]
+        self._delayed = []                             # heap (not_before, seq, ключ) бесед, ждущих повтора
+        self._seq = itertools.count()
+        self._count = 0                                # сообщений в очередях (без отправляемого)
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._thread = None
+        self.sent = 0          # вызовов messages.send, завершившихся успешно
+        self.coalesced = 0     # сообщений, склеенных с предыдущим
+        self.retries = 0
+        self.failed = 0
+        self.errors_by_code = {}
+
+    # ----------------- Публичный API -----------------
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+            self._thread.start()
+
+    def send(self, peer_id: int, text: str, attachment: Optional[str] = None,
+             priority: int = PRIORITY_NORMAL, callback=None):
+        """
+        Ставит сообщение в очередь. callback(ok: bool, result) вызывается после отправки
+        или окончательной ошибки (у склеенных сообщений — с общим результатом).
+        """
+        priority = max(0, min(priority, len(self._lanes) - 1))
+        m = OutMessage(int(peer_id), str(text), attachment, priority, callback)
+        key = (priority, m.peer_id)
+        with self._cond:
+            q = self._queues.get(key)
+            if q is None:
+                # новой беседы нет ни в полосе, ни в отправке, ни в ожидании повтора
+                q = self._queues[key] = deque()
+                self._lanes[priority].append(key)
+            q.append(m)
+            self._count += 1
+            self._cond.notify()
+
+    def acquire(self, priority: int = PRIORITY_NORMAL):
+        """
+        Токен лимитера для запроса мимо очереди (пакеты execute): пока в более приоритетных
+        полосах есть готовые к отправке беседы, запрос ждёт — рассылка (PRIORITY_LOW)
+        не отнимает токены у уведомлений модерации.
+        """
+        with self._cond:
+            while self._thread is not None and any(self._lanes[:priority]):
+                self._cond.wait(timeout=0.5)
+        self.bucket.acquire()
+
+    def depth(self) -> int:
+        return self._count
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Ждёт, пока очередь опустеет. False — не успели за timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.depth() or self._inflight:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(timeout=left if left is not None else 0.5)
+        return True
+
+    def stats(self) -> dict:
+        with self._cond:
+            lanes = [0] * len(self._lanes)
+            for (priority, _), q in self._queues.items():
+                lanes[priority] += len(q)
+        return {"depth": self.depth(), "lanes": lanes, "sent": self.sent,
+                "coalesced": self.coalesced, "retries": self.retries, "failed": self.failed,
+                "errors_by_code": dict(self.errors_by_code)}
+
+    # ----------------- Отправка -----------------
+    def _take(self) -> OutMessage:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, key = heapq.heappop(self._delayed)
+                    self._lanes[key[0]].appendleft(key)    # повтор — первым в своей полосе
+                lane = next((l for l in self._lanes if l), None)
+                if lane is not None:
+                    break
+                self._cond.wait(timeout=self._delayed[0][0] - now if self._delayed else None)
+            key = lane.popleft()
+            q = self._queues[key]
+            m = q.popleft()
+            self._count -= 1
+            if self.coalesce and m.attachment is None and m.random_id is None:
+                self._merge_same_peer(m, q)
+            # беседа вернётся в полосу в _done/_retry: пока сообщение отправляется, следующее не уйдёт
+            self._inflight += 1
+            return m
+
+    def _merge_same_peer(self, m: OutMessage, q: deque):
+        """Склеивает следующие тексты беседы, пока они склеиваемые и влезают в лимит длины."""
+        while q:
+            other = q[0]
+            if (other.attachment is not None or other.random_id is not None
+                    or len(m.text) + 2 + len(other.text) > MAX_MESSAGE_LEN):
+                break
+            q.popleft()
+            self._count -= 1
+            m.text = f"{m.text}\n\n{other.text}"
+            m.callbacks.extend(other.callbacks)
+            self.coalesced += 1
+
+    def _release(self, key):
+        """Беседа снова в полосе, если у неё остались сообщения (вызывается под _cond)."""
+        if self._queues[key]:
+            self._lanes[key[0]].append(key)
+        else:
+            del self._queues[key]
+
+    def _done(self, m: OutMessage, ok: bool, result):
+        with self._cond:
+            self._inflight -= 1
+            self._release((m.priority, m.peer_id))
+            self._cond.notify_all()
+        for cb in m.callbacks:
+            try:
+                cb(ok, result)
+            except Exception as e:
+                logger.exception("outbox callback error: %s", e)
+
+    def _retry(self, m: OutMessage, delay: float):
+        """Сообщение — обратно в начало очереди беседы; беседа ждёт not_before, остальные уходят."""
+        key = (m.priority, m.peer_id)
+        m.not_before = time.monotonic() + delay
+        with self._cond:
+            self._inflight -= 1
+            self._queues[key].appendleft(m)
+            self._count += 1
+            heapq.heappush(self._delayed, (m.not_before, next(self._seq), key))
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            m = self._take()
+            if m.random_id is None:
+                m.random_id = random.randint(1, 2**31 - 1)
+            params = {"peer_id": m.peer_id, "message": m.text, "random_id": m.random_id}
+            if m.attachment:
+                params["attachment"] = m.attachment
+            self.bucket.acquire()
+            try:
+                result = self.send_fn(params)
+            except Exception as e:
+                code = getattr(e, "code", None)
+                self.errors_by_code[code] = self.errors_by_code.get(code, 0) + 1
+                if code == RATE_LIMIT_CODE:
+                    self.bucket.drain()
+                if code in RETRY_CODES and m.attempts < self.max_retries:
+                    delay = self.base_delay * (2 ** m.attempts)
+                    m.attempts += 1
+                    self.retries += 1
+                    logger.warning("messages.send peer=%s: %s — повтор %s через %.1fс", m.peer_id, e, m.attempts, delay)
+                    self._retry(m, delay)
+                    continue
+                self.failed += 1
+                logger.warning("messages.send peer=%s не доставлено: %s", m.peer_id, e)
+                self._done(m, False, e)
+                continue
+            self.sent += 1
+            self._done(m, True, result)
+
+# ----------------- Прогон на фейковом API -----------------
+def simulate(messages: int = 300, peers: int = 5, limit_rps: float = 20, flaky: float = 0.2):
+    """
+    Прогон с лимитом API и случайными отказами "Too many requests" (доля flaky); каждое седьмое
+    сообщение с вложением — его нельзя склеить, и оно разрывает склейку текстов своей беседы.
+    Проверяет: всё доставлено, были повторы, LOW не уходит, пока есть готовое к отправке HIGH
+    (обгоняет только HIGH, ждущие повтора), порядок текстов каждой беседы в полосе сохранён.
+    """
+    from fake_vk import FakeVk
+    api = FakeVk(rate_limit=limit_rps)
+    api.flaky["messages.send"] = flaky
+    delivered: List[bool] = []
+    overtaken = []    # попытки LOW, когда в полосе HIGH были готовые беседы
+
+    def send(params):
+        if priority_of[params["message"].split("\n\n")[0]] == PRIORITY_LOW and box._lanes[PRIORITY_HIGH]:
+            overtaken.append(params["peer_id"])
+        return api.messages.send(**params)
+
+    box = Outbox(send, rate=limit_rps, base_delay=0.2)
+    priority_of = {}
+    for i in range(messages):
+        prio = PRIORITY_LOW if i % 3 == 0 else PRIORITY_HIGH
+        priority_of[f"сообщение {i}"] = prio
+        box.send(2000000000 + i % peers, f"сообщение {i}", attachment="doc1_1" if i % 7 == 0 else None,
+                 priority=prio, callback=lambda ok, r: delivered.append(ok))
+    t0 = time.perf_counter()
+    box.start()
+    box.flush()
+    elapsed = time.perf_counter() - t0
+    calls = api.calls_of("messages.send")
+    texts = sum(len(c[1]["message"].split("\n\n")) for c in calls)
+    print(f"отправлено текстов: {texts}/{messages}, вызовов API: {box.sent}, склеено: {box.coalesced}, "
+          f"повторов: {box.retries}, потеряно: {box.failed}, ошибок лимита от API: {api.rate_limited}, "
+          f"время: {elapsed:.2f}с")
+    assert texts == messages and box.failed == 0 and all(delivered), "сообщения потеряны"
+    assert api.rate_limited and box.retries, "путь повтора не проверен"
+
+    # приоритет проверяется в момент отправки, а не по времени доставки: HIGH, ждущее повтора,
+    # LOW обгонять может (см. описание модуля)
+    assert not overtaken, "LOW ушло раньше готового HIGH"
+
+    order = {}
+    for _, params in calls:
+        for t in params["message"].split("\n\n"):
+            order.setdefault((params["peer_id"], priority_of[t]), []).append(int(t.split()[1]))
+    assert all(seq == sorted(seq) for seq in order.values()), "нарушен порядок сообщений беседы"
+    print("ok")
+    return box
+
+if __name__ == "__main__":
+    n = int(sys.argv[sys.argv.index("--messages") + 1]) if "--messages" in sys.argv else 300
+    p = int(sys.argv[sys.argv.index("--peers") + 1]) if "--peers" in sys.argv else 5
+    simulate(n, p)
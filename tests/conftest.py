@@ -0,0 +1,43 @@
+# coding: utf-8
+"""
+Общие фикстуры: бот собирается через create_app() на временной базе и фейковом VK API
+(как в bench_replay.py), фоновые потоки не запускаются.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("GROUP_ID", "1")
+os.environ.setdefault("OWNER_ID", "1")
+os.environ.setdefault("OUTBOX_RATE", "1000000")
+
+@pytest.fixture(scope="session")
+def bot(tmp_path_factory):
+    """Модуль бота с применёнными миграциями и засеянной базой (один на прогон: состояние в глобалях модуля)."""
+    import bench_replay as br
+    import vk_moder_bot
+    from fake_vk import FakeVk
+
+    workdir = tmp_path_factory.mktemp("bot")
+    vk_moder_bot.executed_queries = set()
+    api = FakeVk()
+    vk_moder_bot.create_app(vk_session=br.FakeSession(api), upload=br.FakeUpload(), background=False,
+                            serve_http=False, db_path=str(workdir / "bot.db"), log_path=None)
+    br.seed(vk_moder_bot, api, 3)
+    vk_moder_bot.test_api = api
+    return vk_moder_bot
+
+@pytest.fixture
+def send(bot):
+    """send(from_id, text, peer_id=...) — прогон сообщения через handle_event."""
+    import bench_replay as br
+
+    def _send(from_id: int, text: str, peer_id: int = br.PEER_BASE + 1, reply_to: int = None):
+        raw = br._message(None, peer_id, from_id, text, 1)
+        if reply_to:
+            raw["object"]["message"]["reply_message"] = {"from_id": reply_to}
+        bot.handle_event(br.ReplayEvent(raw, bot.VkBotEventType.MESSAGE_NEW))
+    return _send
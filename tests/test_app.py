@@ -0,0 +1,22 @@
+# coding: utf-8
+"""BotApp: импорт модуля ничего не создаёт, очередь отправки и рассылки появляются вместе с приложением."""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_import_has_no_side_effects():
+    code = ("import threading, vk_moder_bot as b; "
+            "assert b.outbox is None and b.broadcasts is None and b.vk is None; "
+            "assert threading.active_count() == 1, threading.enumerate()")
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT),
+                   check=True, timeout=60)
+
+def test_app_binds_outbox_and_broadcasts(bot, monkeypatch):
+    # monkeypatch вернёт очередь и рассылки приложения из фикстуры bot
+    monkeypatch.setattr(bot, "outbox", bot.outbox)
+    monkeypatch.setattr(bot, "broadcasts", bot.broadcasts)
+    app = bot.BotApp(vk_session=object(), shard=(1, 4), background=False, serve_http=False)
+    assert bot.outbox is app.outbox and bot.broadcasts is app.broadcasts
+    assert app.outbox.bucket.rate == bot.OUTBOX_RATE / 4
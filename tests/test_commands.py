@@ -0,0 +1,54 @@
+# coding: utf-8
+"""Команды через handle_event: журнал пишется только после того, как действие состоялось."""
+import bench_replay as br
+
+def _event(bot, text, reply=None, from_id=br.OWNER):
+    raw = br._message(None, br.PEER_BASE + 1, from_id, text, 1)
+    if reply:
+        raw["object"]["message"]["reply_message"] = reply
+    return br.ReplayEvent(raw, bot.VkBotEventType.MESSAGE_NEW)
+
+def test_clear_deletes_replied_message(bot):
+    before = len(bot.test_api.calls_of("messages.delete"))
+    bot.handle_event(_event(bot, "/clear", {"from_id": 1000, "conversation_message_id": 77}))
+    calls = bot.test_api.calls_of("messages.delete")[before:]
+    assert calls and 77 in calls[-1][1]["conversation_message_ids"]
+    assert any(r[1] == "message_delete" and r[3] == 1000 for r in bot.audit_log.buffered([1000]))
+
+def test_moderator_clears_only_junior_messages(bot):
+    moder = br.MODERS[0]
+    assert bot.role_key(moder, br.PEER_BASE + 1) == "moder" and not bot.is_owner(moder)
+    before = len(bot.test_api.calls_of("messages.delete"))
+    bot.handle_event(_event(bot, "/clear", {"from_id": 1001, "conversation_message_id": 78}, from_id=moder))
+    calls = bot.test_api.calls_of("messages.delete")[before:]
+    assert calls and 78 in calls[-1][1]["conversation_message_ids"]
+
+    bot.handle_event(_event(bot, "/clear", {"from_id": br.MODERS[1], "conversation_message_id": 79}, from_id=moder))
+    assert len(bot.test_api.calls_of("messages.delete")) == before + 1
+
+def test_failed_warn_is_not_audited(bot, monkeypatch):
+    audited, sent = [], []
+    monkeypatch.setattr(bot, "add_warn_db", lambda *a: None)
+    monkeypatch.setattr(bot, "audit", lambda action, *a, **kw: audited.append(action))
+    monkeypatch.setattr(bot, "safe_send", lambda peer_id, text, *a, **kw: sent.append(text))
+    bot.handle_event(_event(bot, "/warn 1007 флуд"))
+    assert audited == []
+    assert sent and sent[-1].startswith("❌")
+
+def test_admins_lists_chat_staff(bot, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, "safe_send", lambda peer_id, text, *a, **kw: sent.append(text))
+    bot.handle_event(_event(bot, "/admins"))
+    assert sent and "Модераторы" in sent[-1]
+    assert all(f"id{uid}|" in sent[-1] for uid in br.MODERS)
+
+def test_add_by_id_and_reply(bot, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, "safe_send", lambda peer_id, text, *a, **kw: sent.append(text))
+    before = len(bot.test_api.calls_of("messages.addChatUser"))
+    bot.handle_event(_event(bot, "/add 1020", from_id=br.MODERS[0]))
+    bot.handle_event(_event(bot, "/add", {"from_id": 1021, "conversation_message_id": 80}))
+    calls = bot.test_api.calls_of("messages.addChatUser")[before:]
+    assert [c[1]["user_id"] for c in calls] == [1020, 1021]
+    assert all(c[1]["chat_id"] == 1 for c in calls)
+    assert len(sent) == 2 and all(t.startswith("✅") for t in sent)
@@ -0,0 +1,10 @@
+# coding: utf-8
+"""Очередь отправки: прогон simulate на размерах, где повторы перемешивают время доставки полос."""
+import pytest
+
+import outbox
+
+@pytest.mark.parametrize("messages", [200, 300])
+def test_simulate(messages):
+    box = outbox.simulate(messages=messages)
+    assert box.retries and box.failed == 0
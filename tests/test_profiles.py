@@ -0,0 +1,41 @@
+# coding: utf-8
+"""/info: последние действия в верном порядке, пока часть журнала ещё в буфере и во время его сброса."""
+import pytest
+
+import bench_replay as br
+
+PEER = br.PEER_BASE + 1
+
+def _actions(bot, uid):
+    return [a[1] for a in bot.get_profiles([uid], PEER)[0].actions]
+
+def test_buffered_actions_newest_first(bot, send, monkeypatch):
+    monkeypatch.setattr(bot.audit_log, "batch", 10 ** 6)
+    bot.audit_log.flush()
+    for text in ("/warn 1011 a", "/warn 1011 b", "/warn 1011 c", "/unwarn 1011"):
+        send(br.OWNER, text)
+    buffered = _actions(bot, 1011)
+    bot.audit_log.flush()
+    assert buffered == _actions(bot, 1011)
+    assert buffered[0] == "unwarn"
+
+@pytest.mark.parametrize("when", ["before_query", "after_query"])
+def test_flush_during_read_loses_nothing(bot, send, monkeypatch, when):
+    uid = 1012 if when == "before_query" else 1013
+    monkeypatch.setattr(bot.audit_log, "batch", 10 ** 6)
+    bot.audit_log.flush()
+    send(br.OWNER, f"/warn {uid} a")
+    bot.audit_log.flush()
+    send(br.OWNER, f"/unwarn {uid}")
+    db_execute = bot.db_execute
+
+    def racing(query, *a, **kw):
+        # фоновый сброс журнала в момент чтения профиля
+        if "UNION ALL" in query and when == "before_query":
+            bot.audit_log.flush()
+        rows = db_execute(query, *a, **kw)
+        if "UNION ALL" in query and when == "after_query":
+            bot.audit_log.flush()
+        return rows
+    monkeypatch.setattr(bot, "db_execute", racing)
+    assert _actions(bot, uid) == ["unwarn", "warn"]
@@ -0,0 +1,44 @@
+# coding: utf-8
+"""Запросы, которые бот реально выполняет, идут по индексам (EXPLAIN QUERY PLAN на свежей базе)."""
+import sqlite3
+
+import bench_replay as br
+import migrations
+
+COMMANDS = [
+    "/warn 1000 флуд", "/warn 1000 флуд", "/warns 1000", "/unwarn 1000", "/info 1000 1001",
+    "/mute 1001 5 капс", "/unmute 1001", "/kick 1002", "/ban 1003 реклама", "/unban 1003",
+    "/sban 1004 бот", "/sunban 1004", "/skick 1005", "/setmoder 1006", "/removerole 1006",
+    "/admins", "/warnrules 2:mute:30 3:kick", "/warnrules", "/warnrules reset", "/help",
+    "/blacklist add тестслово", "/blacklist remove тестслово",
+]
+
+def test_executed_queries_use_indexes(bot, send, monkeypatch):
+    monkeypatch.setattr(bot, "WARN_TTL_DAYS", 90)    # сгорание варнов по умолчанию выключено
+    for raw in br.generate("all", 600, chats=3):
+        bot.handle_event(br.ReplayEvent(raw, bot.VkBotEventType.MESSAGE_NEW))
+    for text in COMMANDS:
+        send(br.OWNER, text)
+    bot.expire_mutes([r[0] for r in bot.db_connect().execute("SELECT id FROM mutes LIMIT 5")])
+    bot.compact_expired_warns()
+    bot.resolve_screen_name("durov")
+    bot.purge_screen_names()
+    bot.get_profiles([1000, 1001, 1002], br.PEER_BASE + 1)
+    bot.audit_log.flush()
+
+    queries = set(bot.executed_queries)
+    assert len(queries) > 30
+    conn = sqlite3.connect(bot.DB_PATH)
+    try:
+        problems = migrations.check_query_plans(conn, queries)
+    finally:
+        conn.close()
+    assert problems == []
+
+def test_check_query_plans_reports_scan(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "fresh.db"), isolation_level=None)
+    migrations.run_migrations(conn)
+    problems = migrations.check_query_plans(conn, ["SELECT id FROM warns WHERE reason=?",
+                                                   "SELECT user_id, peer_id, role FROM roles"])
+    conn.close()
+    assert len(problems) == 1 and "warns" in problems[0]
@@ -0,0 +1,80 @@
+# coding: utf-8
+"""Ссылки на пользователей (parse_user_ref) и кэш коротких имён: TTL, база как второй уровень, наказания без кэша."""
+import time
+
+import pytest
+
+@pytest.mark.parametrize("ref, expected", [
+    ("[id123|Вася]", (123, None)),
+    ("123", (123, None)),
+    ("id123", (123, None)),
+    ("@id123", (123, None)),
+    ("https://vk.com/id123", (123, None)),
+    ("vk.com/id123/", (123, None)),
+    ("@Durov", (None, "durov")),
+    ("https://vk.com/durov?w=wall1_1", (None, "durov")),
+    ("durov", (None, "durov")),
+    ("", (None, None)),
+    ("не-имя!", (None, None)),
+])
+def test_parse_user_ref(bot, ref, expected):
+    assert bot.parse_user_ref(ref) == expected
+
+def _reset(bot, name):
+    bot.screen_cache._data.pop(name, None)
+    bot.db_execute("DELETE FROM screen_names WHERE name=?", (name,))
+
+def _resolves(bot):
+    return len(bot.test_api.calls_of("utils.resolveScreenName"))
+
+def test_positive_ttl_and_db_fallback(bot, monkeypatch):
+    _reset(bot, "alice")
+    bot.test_api.screen_names["alice"] = ("user", 501)
+    assert bot.resolve_screen_name("Alice") == 501
+    calls = _resolves(bot)
+    assert bot.resolve_screen_name("alice") == 501          # память
+    bot.screen_cache._data.pop("alice")
+    db_hits = bot.screen_cache.db_hits
+    assert bot.resolve_screen_name("alice") == 501          # база после рестарта/вытеснения
+    assert bot.screen_cache.db_hits == db_hits + 1
+    assert _resolves(bot) == calls
+
+    now = time.time()
+    monkeypatch.setattr(bot.time, "time", lambda: now + bot.SCREEN_CACHE_TTL + 1)
+    bot.test_api.screen_names["alice"] = ("user", 502)      # имя перешло к другому
+    assert bot.resolve_screen_name("alice") == 502
+    assert _resolves(bot) == calls + 1
+
+def test_negative_ttl(bot, monkeypatch):
+    _reset(bot, "nobody")
+    bot.test_api.screen_names.pop("nobody", None)
+    assert bot.resolve_screen_name("nobody") is None
+    calls = _resolves(bot)
+    assert bot.resolve_screen_name("nobody") is None
+    assert _resolves(bot) == calls
+
+    now = time.time()
+    monkeypatch.setattr(bot.time, "time", lambda: now + bot.SCREEN_NEGATIVE_TTL + 1)
+    bot.test_api.screen_names["nobody"] = ("user", 503)
+    assert bot.resolve_screen_name("nobody") == 503
+
+def test_fresh_resolve_ignores_cache(bot):
+    _reset(bot, "bob")
+    bot.test_api.screen_names["bob"] = ("user", 601)
+    assert bot.resolve_screen_name("bob") == 601
+    bot.test_api.screen_names["bob"] = ("user", 602)
+    assert bot.resolve_screen_name("bob") == 601            # чтение — из кэша
+    assert bot.parse_user_id(None, ["@bob"], fresh=True) == 602
+    assert bot.resolve_screen_name("bob") == 602            # свежий ответ попал в кэш
+
+def test_purge_removes_expired_rows(bot):
+    past = int(time.time()) - 10
+    bot.db_execute("INSERT OR REPLACE INTO screen_names (name, user_id, expires_at) VALUES (?,?,?)", ("stale", 1, past))
+    bot.screen_cache._remember("stale", 1, past)
+    _reset(bot, "carol")
+    bot.test_api.screen_names["carol"] = ("user", 701)
+    bot.resolve_screen_name("carol")
+    assert bot.purge_screen_names() >= 1
+    names = {r[0] for r in bot.db_execute("SELECT name FROM screen_names", fetch=True)}
+    assert "stale" not in names and "carol" in names
+    assert "stale" not in bot.screen_cache._data
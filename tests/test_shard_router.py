@@ -0,0 +1,48 @@
+# coding: utf-8
+"""ShardRouter: каждое отправленное событие обработано, умерший шард не подвешивает роутер."""
+import os
+import time
+
+import pytest
+
+import bench_replay as br
+
+def crashing_app(shard=None, serve_http=True):
+    """Фабрика шарда, который умирает на первом событии."""
+    import vk_moder_bot
+    app = br.bench_app(shard, serve_http)
+    vk_moder_bot.make_event = lambda raw: os._exit(3)
+    return app
+
+@pytest.fixture
+def bench_env(bot, tmp_path, monkeypatch):
+    monkeypatch.setenv("BENCH_DB", bot.DB_PATH)
+    monkeypatch.setenv("BENCH_LOG", str(tmp_path / "shard.log"))
+    monkeypatch.setenv("BENCH_CHATS", "3")
+    return bot
+
+def _events(bot, n):
+    return [br.ReplayEvent(raw, bot.VkBotEventType.MESSAGE_NEW) for raw in br.generate("chatter", n, chats=3)]
+
+def test_every_routed_event_is_processed(bench_env):
+    bot = bench_env
+    router = bot.ShardRouter(2, app_factory=br.bench_app, maxsize=20)
+    router.start()
+    for ev in _events(bot, 300):
+        router.submit(ev)
+    router.stop(timeout=60)
+    assert router.processed == router.routed and sum(router.routed) == 300
+
+def test_dead_shard_raises_instead_of_hanging(bench_env):
+    bot = bench_env
+    router = bot.ShardRouter(2, app_factory=crashing_app, maxsize=20)
+    router.start()
+    t0 = time.monotonic()
+    with pytest.raises(bot.ShardError):
+        for ev in _events(bot, 2000):
+            router.submit(ev)
+        router.stop(timeout=30)
+    assert time.monotonic() - t0 < 20
+    with pytest.raises(bot.ShardError):
+        router.stop(timeout=5)
+    assert not any(p.is_alive() for p in router._procs)
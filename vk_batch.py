@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+vk_batch.py
+Пакетные вызовы VK API через метод execute: до 25 вызовов за один HTTP-запрос.
+
+execute возвращает массив ответов, где у неудачного вызова стоит false, а подробности
+ошибок лежат по порядку в execute_errors. execute_batch сопоставляет их обратно
+и возвращает результат для каждого исходного вызова.
+
+Запуск как скрипта — проверка на фейковом execute (fake_vk.py):
+    python vk_batch.py
+"""
+import json
+import logging
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger("vk_moder_bot")
+
+EXECUTE_MAX_CALLS = 25    # лимит VK на число API-вызовов внутри одного execute
+
+class BatchError(Exception):
+    """Ошибка отдельного вызова внутри execute."""
+    def __init__(self, method: str, code: Optional[int], msg: str):
+        super().__init__(f"{method}: [{code}] {msg}")
+        self.method = method
+        self.code = code
+
+def build_execute_code(calls: List[Tuple[str, dict]]) -> str:
+    parts = [f"API.{method}({json.dumps(params, ensure_ascii=False)})" for method, params in calls]
+    return "return [" + ",".join(parts) + "];"
+
+def execute_batch(execute_fn: Callable[[str], dict], calls: List[Tuple[str, dict]],
+                  before_request: Optional[Callable[[], None]] = None) -> List[Tuple[bool, object]]:
+    """
+    Выполняет calls пачками по EXECUTE_MAX_CALLS.
+    execute_fn(code) -> сырой ответ VK ({"response": [...], "execute_errors": [...]}).
+    before_request — например, захват токена лимитера перед каждым HTTP-запросом.
+    Возвращает [(ok, ответ или BatchError/исключение)] в порядке calls.
+    """
+    results: List[Tuple[bool, object]] = []
+    for i in range(0, len(calls), EXECUTE_MAX_CALLS):
+        chunk = calls[i:i + EXECUTE_MAX_CALLS]
+        if before_request:
+            before_request()
+        try:
+            raw = execute_fn(build_execute_code(chunk)) or {}
+        except Exception as e:
+            # упал весь запрос (ошибка самого execute приходит исключением ApiError с кодом) —
+            # все вызовы пачки считаются неудачными
+            logger.warning("execute (%s вызовов) не выполнен: %s", len(chunk), e)
+            results.extend((False, e) for _ in chunk)
+            continue
+        response = raw.get("response") or []
+        errors = iter(raw.get("execute_errors") or [])
+        for j, (method, _) in enumerate(chunk):
+            value = response[j] if j < len(response) else False
+            if value is False:
+                err = next(errors, {})
+                results.append((False, BatchError(err.get("method", method), err.get("error_code"), err.get("error_msg", ""))))
+            else:
+                results.append((True, value))
+    return results
+
+# ----------------- Проверка на фейковом API -----------------
+def selftest(chats: int = 60):
+    from fake_vk import FakeVk
+    api = FakeVk()
+    user = 42
+    for n in range(1, chats + 1):
+        if n % 3 == 0:
+            api.members.setdefault(2000000000 + n, set()).add(user)
+    calls = [("messages.removeChatUser", {"chat_id": n, "user_id": user}) for n in range(1, chats + 1)]
+    res = execute_batch(lambda code: api.execute(code=code), calls)
+    ok = sum(1 for r in res if r[0])
+    http = len(api.calls_of("execute"))
+    print(f"вызовов: {len(calls)}, HTTP-запросов: {http}, успешно: {ok}, с ошибкой: {len(res) - ok}")
+    assert http == (chats + EXECUTE_MAX_CALLS - 1) // EXECUTE_MAX_CALLS
+    assert [r[0] for r in res] == [n % 3 == 0 for n in range(1, chats + 1)], "результаты сопоставлены неверно"
+    assert all(isinstance(r[1], BatchError) and r[1].code == 935 for r in res if not r[0])
+    print("ok")
+
+if __name__ == "__main__":
+    selftest()
@@ -1,1305 +1,3454 @@
-#!/usr/bin/env python3
-# coding: utf-8
-"""
-vk_moder_bot.py
-Полный рабочий скрипт модератор-бота для ВК — расширенная версия с миграциями, автозадачами,
-экспортом логов, бэкапом и множеством команд (рус/англ алиасы).
-"""
-import os
-import sys
-import time
-import shutil
-import sqlite3
-import logging
-import random
-import threading
-import datetime
-from typing import List, Optional, Tuple
-
-import vk_api
-from vk_api.bot_longpoll import VkBotLongPoll, VkBotEventType
-from vk_api import VkUpload
-from dotenv import load_dotenv
-
-# ----------------- Загрузка .env -----------------
-load_dotenv()
-GROUP_TOKEN = os.getenv("GROUP_TOKEN", "").strip()
-GROUP_ID = int(os.getenv("GROUP_ID") or 0)
-OWNER_ID = int(os.getenv("OWNER_ID") or 0)
-DB_PATH = os.getenv("DB_PATH") or "moder_bot.db"
-LOG_PATH = os.getenv("LOG_PATH") or "moder_bot.log"
-
-if not GROUP_TOKEN:
-    print("Ошибка: GROUP_TOKEN не задан в .env", file=sys.stderr)
-    sys.exit(1)
-if GROUP_ID == 0:
-    print("Ошибка: GROUP_ID не задан в .env", file=sys.stderr)
-    sys.exit(1)
-
-# ----------------- Логирование -----------------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_PATH, encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger("vk_moder_bot")
-
-# ----------------- Инициализация VK -----------------
-vk_session = vk_api.VkApi(token=GROUP_TOKEN)
-vk = vk_session.get_api()
-longpoll = VkBotLongPoll(vk_session, GROUP_ID)
-upload = VkUpload(vk_session)
-
-# ----------------- Роли и права -----------------
-ROLE_PRIORITY = {
-    "owner": 100,
-    "admin": 80,
-    "moder": 60,
-    "helper": 40,
-    "user": 0
-}
-
-PERMS = {
-    "owner":   {"warn","unwarn","warns","mute","unmute","kick","skick","ban","unban","sban","sunban","blacklist","add","role","removerole","wipe","gzov","ss","admins","setowner","setadmin","setmoder","sethelper","allowner","alladmin","allmoder","allhelper","report","backup","info","help","clear","exportlogs"},
-    "admin":   {"warn","unwarn","warns","mute","unmute","kick","skick","ban","unban","add","role","removerole","gzov","ss","setmoder","sethelper","allmoder","allhelper","report","info","help","allremoverole"},
-    "moder":   {"warn","warns","mute","unmute","kick","report","info","help","unwarn"},
-    "helper":  {"warn","warns","mute","add","ss","report","info","help"},
-    "user":    {"info","report","help","warns"}
-}
-
-# ----------------- База данных -----------------
-def db_connect():
-    return sqlite3.connect(DB_PATH)
-
-def db_execute(query: str, params: tuple = (), fetch: bool = False):
-    try:
-        conn = db_connect()
-        c = conn.cursor()
-        c.execute(query, params)
-        if fetch:
-            rows = c.fetchall()
-            conn.commit()
-            conn.close()
-            return rows
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.exception("DB error: %s | query: %s | params: %s", e, query, params)
-        return None
-
-def migrate_db_schema():
-    """
-    Простые миграции: если нет колонок id / peer_id, добавляем их.
-    Это помогает при старых БД, где структура была иной.
-    """
-    try:
-        conn = db_connect()
-        c = conn.cursor()
-        tables = ["warns","mutes","roles","blacklist","bans","chats"]
-        for t in tables:
-            try:
-                c.execute(f"PRAGMA table_info({t})")
-                cols = c.fetchall()
-                colnames = [col[1] for col in cols]
-                # добавить peer_id если отсутствует и таблица его подразумевает
-                if t in ("warns","mutes","roles","bans") and "peer_id" not in colnames:
-                    try:
-                        c.execute(f"ALTER TABLE {t} ADD COLUMN peer_id INTEGER DEFAULT 0")
-                        logger.info("Добавлена колонка peer_id в таблицу %s", t)
-                    except Exception:
-                        pass
-                # добавить id если отсутствует (не идеальное PK, но делает совместимость)
-                if "id" not in colnames and t != "chats":
-                    try:
-                        c.execute(f"ALTER TABLE {t} ADD COLUMN id INTEGER")
-                        # заполнить id = rowid
-                        c.execute(f"UPDATE {t} SET id = rowid")
-                        logger.info("Добавлена колонка id в таблицу %s и проставлены значения", t)
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.exception("migrate_db_schema error: %s", e)
-
-def init_db():
-    # создаём таблицы (если уже есть — не трогаем)
-    db_execute("""CREATE TABLE IF NOT EXISTS warns (
-                    id INTEGER,
-                    user_id INTEGER,
-                    issued_by INTEGER,
-                    reason TEXT,
-                    timestamp TEXT,
-                    peer_id INTEGER DEFAULT 0
-                )""")
-    db_execute("""CREATE TABLE IF NOT EXISTS mutes (
-                    id INTEGER,
-                    user_id INTEGER,
-                    issued_by INTEGER,
-                    until TEXT,
-                    reason TEXT,
-                    peer_id INTEGER DEFAULT 0
-                )""")
-    db_execute("""CREATE TABLE IF NOT EXISTS roles (
-                    id INTEGER,
-                    user_id INTEGER,
-                    role TEXT,
-                    peer_id INTEGER DEFAULT 0
-                )""")
-    db_execute("""CREATE TABLE IF NOT EXISTS blacklist (
-                    id INTEGER,
-                    word TEXT UNIQUE
-                )""")
-    db_execute("""CREATE TABLE IF NOT EXISTS bans (
-                    id INTEGER,
-                    user_id INTEGER,
-                    issued_by INTEGER,
-                    until TEXT,
-                    reason TEXT,
-                    peer_id INTEGER DEFAULT 0
-                )""")
-    db_execute("""CREATE TABLE IF NOT EXISTS chats (
-                    peer_id INTEGER PRIMARY KEY
-                )""")
-    # пробуем привести старые таблицы к схеме — добавим недостающие колонки
-    migrate_db_schema()
-    logger.info("init_db done")
-
-init_db()
-
-# ----------------- Утилиты VK -----------------
-def safe_send(peer_id: int, text: str):
-    try:
-        vk.messages.send(peer_id=int(peer_id), message=str(text), random_id=random.randint(1, 2**31-1))
-    except Exception as e:
-        logger.debug("safe_send failed: %s", e)
-
-def safe_send_with_attachment(peer_id: int, attachments: List[str], text: str = ""):
-    try:
-        vk.messages.send(peer_id=int(peer_id), message=str(text), attachment=",".join(attachments), random_id=random.randint(1, 2**31-1))
-    except Exception as e:
-        logger.debug("safe_send_with_attachment failed: %s", e)
-
-def mention(uid: int) -> str:
-    try:
-        res = vk.users.get(user_ids=uid)
-        if isinstance(res, list) and res:
-            n = res[0]
-            name = f"{n.get('first_name','')} {n.get('last_name','')}".strip()
-            return f"[id{uid}|{name}]"
-    except Exception:
-        pass
-    return f"[id{uid}|{uid}]"
-
-def add_chat(peer_id: int):
-    try:
-        db_execute("INSERT OR IGNORE INTO chats (peer_id) VALUES (?)", (int(peer_id),))
-    except Exception:
-        pass
-
-def get_chats() -> List[int]:
-    rows = db_execute("SELECT peer_id FROM chats", fetch=True) or []
-    return [r[0] for r in rows]
-
-# ----------------- Парсинг user id (reply / id / vk.com / @screenname) -----------------
-def parse_user_id(event, args: List[str]) -> Optional[int]:
-    """
-    Возвращает user_id:
-    - reply (если ответ)
-    - [id123|..]
-    - просто число
-    - vk.com/id...
-    - @screenname
-    """
-    msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
-    if msg:
-        try:
-            reply = msg.get("reply_message") if isinstance(msg, dict) else getattr(msg, "reply_message", None)
-            if reply:
-                rid = reply.get("from_id") if isinstance(reply, dict) else getattr(reply, "from_id", None)
-                if not rid:
-                    rid = reply.get("user_id") if isinstance(reply, dict) else getattr(reply, "user_id", None)
-                if rid:
-                    return int(rid)
-        except Exception:
-            pass
-    # args
-    if not args:
-        return None
-    a = args[0].strip()
-    if a.startswith("[id") and "|" in a:
-        try:
-            return int(a[3:a.index("|")])
-        except Exception:
-            pass
-    if a.isdigit():
-        return int(a)
-    if "vk.com/" in a:
-        try:
-            screen = a.rstrip("/").split("/")[-1]
-            res = vk.utils.resolveScreenName(screen_name=screen)
-            if res and res.get("object_id"):
-                return int(res["object_id"])
-        except Exception:
-            pass
-    short = a[1:] if a.startswith("@") else a
-    try:
-        if short:
-            users = vk.users.get(user_ids=short)
-            if users and isinstance(users, list) and users:
-                return int(users[0]["id"])
-    except Exception:
-        pass
-    return None
-
-# ----------------- Роли — запись, чтение, удаление -----------------
-def set_role_db(user_id: int, role: str, peer_id: Optional[int] = None):
-    if peer_id is None:
-        peer_id = 0
-    db_execute("DELETE FROM roles WHERE user_id=? AND peer_id=?", (user_id, peer_id))
-    db_execute("INSERT INTO roles (user_id, role, peer_id) VALUES (?,?,?)", (user_id, role, peer_id))
-    return True
-
-def remove_roles_db(user_id: int, peer_id: Optional[int] = None):
-    if peer_id is None:
-        return db_execute("DELETE FROM roles WHERE user_id=?", (user_id,))
-    return db_execute("DELETE FROM roles WHERE user_id=? AND peer_id=?", (user_id, peer_id))
-
-def get_role_db(user_id: int, peer_id: Optional[int] = None) -> str:
-    if OWNER_ID and int(user_id) == int(OWNER_ID):
-        return "owner"
-    if peer_id is None:
-        peer_id = 0
-    rows = db_execute("SELECT role FROM roles WHERE user_id=? AND peer_id=? ORDER BY id DESC LIMIT 1", (user_id, peer_id), fetch=True) or []
-    if rows:
-        return rows[0][0]
-    if peer_id != 0:
-        rows2 = db_execute("SELECT role FROM roles WHERE user_id=? AND peer_id=0 ORDER BY id DESC LIMIT 1", (user_id,), fetch=True) or []
-        if rows2:
-            return rows2[0][0]
-    return "user"
-
-# ----------------- Warns / Mutes / Bans -----------------
-def add_warn_db(user_id: int, issued_by: int, reason: str, peer_id: int):
-    ts = datetime.datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") if False else None  # placeholder (overwritten)
-def add_warn_db(user_id: int, issued_by: int, reason: str, peer_id: int):
-    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    return db_execute("INSERT INTO warns (user_id, issued_by, reason, timestamp, peer_id) VALUES (?,?,?,?,?)", (user_id, issued_by, reason, ts, peer_id))
-
-def get_warns_db(user_id: int):
-    rows = db_execute("SELECT id, issued_by, reason, timestamp, peer_id FROM warns WHERE user_id=? ORDER BY id ASC", (user_id,), fetch=True) or []
-    return rows
-
-def remove_last_warn_db(user_id: int):
-    rows = db_execute("SELECT id FROM warns WHERE user_id=? ORDER BY id DESC LIMIT 1", (user_id,), fetch=True) or []
-    if not rows:
-        return None
-    wid = rows[0][0]
-    return db_execute("DELETE FROM warns WHERE id=?", (wid,))
-
-def add_mute_db(user_id: int, issued_by: int, minutes: int, reason: str, peer_id: int):
-    until = (datetime.datetime.now() + datetime.timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M:%S")
-    return db_execute("INSERT INTO mutes (user_id, issued_by, until, reason, peer_id) VALUES (?,?,?,?,?)", (user_id, issued_by, until, reason, peer_id))
-
-def get_mutes_db(user_id: int):
-    rows = db_execute("SELECT id, user_id, issued_by, until, reason, peer_id FROM mutes WHERE user_id=?", (user_id,), fetch=True) or []
-    return rows
-
-def delete_mute_db(mute_id: int):
-    return db_execute("DELETE FROM mutes WHERE id=?", (mute_id,))
-
-def delete_mutes_for_user_in_peer_db(user_id: int, peer_id: int):
-    return db_execute("DELETE FROM mutes WHERE user_id=? AND peer_id=?", (user_id, peer_id))
-
-def add_blacklist_db(word: str):
-    return db_execute("INSERT OR IGNORE INTO blacklist (word) VALUES (?)", (word.lower(),))
-
-def remove_blacklist_db(word: str):
-    return db_execute("DELETE FROM blacklist WHERE word=?", (word.lower(),))
-
-def get_blacklist_db() -> List[str]:
-    rows = db_execute("SELECT word FROM blacklist", fetch=True) or []
-    return [r[0] for r in rows]
-
-def add_ban_db(user_id: int, issued_by: int, reason: str, peer_id: int = 0):
-    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    return db_execute("INSERT INTO bans (user_id, issued_by, until, reason, peer_id) VALUES (?,?,?,?,?)", (user_id, issued_by, ts, reason, peer_id))
-
-def remove_bans_db(user_id: int, peer_id: Optional[int] = None):
-    if peer_id is None:
-        return db_execute("DELETE FROM bans WHERE user_id=?", (user_id,))
-    return db_execute("DELETE FROM bans WHERE user_id=? AND peer_id=?", (user_id, peer_id))
-
-def get_bans_db(user_id: int):
-    rows = db_execute("SELECT id, issued_by, until, reason, peer_id FROM bans WHERE user_id=?", (user_id,), fetch=True) or []
-    return rows
-
-# ----------------- Утилиты чата (кик/добавление) -----------------
-def kick_from_chat_peer(peer_peer_id: int, user_id: int) -> bool:
-    try:
-        if int(peer_peer_id) < 2000000000:
-            return False
-        chat_id = int(peer_peer_id) - 2000000000
-        vk.messages.removeChatUser(chat_id=chat_id, user_id=user_id)
-        return True
-    except Exception as e:
-        logger.debug("kick_from_chat_peer failed: %s", e)
-        return False
-
-def add_user_to_chat(peer_peer_id: int, user_id: int) -> bool:
-    try:
-        if int(peer_peer_id) < 2000000000:
-            return False
-        chat_id = int(peer_peer_id) - 2000000000
-        try:
-            vk.messages.addChatUser(chat_id=chat_id, user_id=user_id)
-            return True
-        except Exception:
-            return False
-    except Exception as e:
-        logger.debug("add_user_to_chat failed: %s", e)
-        return False
-
-def global_kick_user(user_id: int) -> List[Tuple[int, bool]]:
-    results = []
-    chats = get_chats()
-    for p in chats:
-        ok = kick_from_chat_peer(p, user_id)
-        results.append((p, ok))
-        time.sleep(0.02)
-    return results
-
-# ----------------- Blacklist enforcement -----------------
-def handle_blacklist_on_message(event):
-    try:
-        msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
-        if not msg:
-            return False
-        peer_id = msg.get("peer_id") if isinstance(msg, dict) else getattr(msg, "peer_id", None)
-        from_id = msg.get("from_id") if isinstance(msg, dict) else getattr(msg, "from_id", None)
-        text = (msg.get("text") if isinstance(msg, dict) else getattr(msg, "text", "")) or ""
-        words = get_blacklist_db()
-        if not words:
-            return False
-        low = text.lower()
-        for w in words:
-            if not w:
-                continue
-            if w in low:
-                conv_id = msg.get("conversation_message_id") if isinstance(msg, dict) else getattr(msg, "conversation_message_id", None)
-                mid = msg.get("id") if isinstance(msg, dict) else getattr(msg, "id", None)
-                try:
-                    if conv_id:
-                        vk.messages.delete(conversation_message_ids=[conv_id], peer_id=peer_id, delete_for_all=1)
-                    elif mid:
-                        vk.messages.delete(message_ids=[mid], delete_for_all=1)
-                except Exception:
-                    pass
-                try:
-                    remove_roles_db(from_id, None)
-                except Exception:
-                    pass
-                res = global_kick_user(from_id)
-                ok = sum(1 for _, v in res if v)
-                add_ban_db(from_id, OWNER_ID or 0, f"Blacklisted word: {w}", 0)
-                ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                notify = f"🚨 BLACKLIST TRIGGER\nUser: {mention(from_id)}\nWord: «{w}»\nDate: {ts}\nRoles removed and attempted kicks: {ok} successful."
-                if OWNER_ID:
-                    safe_send(OWNER_ID, notify)
-                safe_send(peer_id, f"🚫 Сообщение удалено: запрещённое слово «{w}». Пользователь {mention(from_id)} кикнут/заблокирован.")
-                return True
-    except Exception as e:
-        logger.exception("handle_blacklist_on_message error: %s", e)
-    return False
-
-# ----------------- Invite handling -----------------
-def handle_invite_action(event):
-    try:
-        msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
-        if not msg:
-            return
-        action = msg.get("action") if isinstance(msg, dict) else getattr(msg, "action", None)
-        if not action:
-            return
-        act_type = action.get("type") if isinstance(action, dict) else getattr(action, "type", None)
-        if act_type not in ("chat_invite_user", "chat_invite_user_by_link"):
-            return
-        invited = None
-        if isinstance(action, dict):
-            invited = action.get("member_id") or (action.get("users") and action.get("users")[0])
-        actor = msg.get("from_id") if isinstance(msg, dict) else getattr(msg, "from_id", None)
-        peer_id = msg.get("peer_id") if isinstance(msg, dict) else getattr(msg, "peer_id", None)
-        if not invited:
-            return
-        invited = int(invited)
-        if peer_id and peer_id >= 2000000000:
-            add_chat(peer_id)
-        bans = get_bans_db(invited) or []
-        if bans:
-            reason = bans[-1][3] if len(bans[-1])>3 else "Ban"
-            kick_from_chat_peer(peer_id, invited)
-            safe_send(peer_id, f"❌ {mention(invited)} приглашён — но он в бане. Кикнут. Причина: {reason}")
-            return
-        actor_role = get_role_db(actor, peer_id)
-        rank = ROLE_PRIORITY.get(actor_role, 0)
-        if rank < ROLE_PRIORITY.get("helper", 40):
-            add_ban_db(actor, OWNER_ID or 0, "Unauthorized invite", peer_id)
-            kick_from_chat_peer(peer_id, invited)
-            safe_send(peer_id, f"🚨 {mention(actor)} пытался добавить {mention(invited)}. Пригласивший локально забанен, добавленный кикнут.")
-            return
-    except Exception as e:
-        logger.exception("handle_invite_action error: %s", e)
-
-def handle_new_member(event, vk):
-    peer_id = event["peer_id"]
-    inviter_id = event["action"]["member_id"]
-    adder_id = event["from_id"]
-
-    role_adder = get_role_db(adder_id, peer_id)
-
-    if role_adder in ["helper", "moderator", "admin", "owner"]:
-        safe_send(peer_id, f"✅ [id{inviter_id}|Пользователь] добавлен в чат.")
-    else:
-        # Кикаем того, кого добавили
-        try:
-            vk.messages.removeChatUser(chat_id=peer_id-2000000000, member_id=inviter_id)
-            safe_send(peer_id, f"❌ [id{inviter_id}|Пользователь] не может быть добавлен.")
-        except:
-            pass
-
-        # Баним того, кто добавил
-        ban_user(adder_id, peer_id, reason="Нарушение: попытка добавить в чат без прав")
-
-# ----------------- Helpers: проверки -----------------
-def is_owner(uid: int) -> bool:
-    return OWNER_ID and int(uid) == int(OWNER_ID)
-
-def has_perm(uid: int, cmd_key: str, peer_id: Optional[int] = None) -> bool:
-    if is_owner(uid):
-        return True
-    role = get_role_db(uid, peer_id)
-    key_role = role.lower() if role else "user"
-    key_role_map = {
-        "владелец": "owner", "owner": "owner",
-        "админ": "admin", "admin": "admin",
-        "модер": "moder", "moder": "moder",
-        "помощник": "helper", "helper": "helper",
-    }
-    key_role = key_role_map.get(key_role, key_role)
-    if key_role not in PERMS:
-        key_role = "user"
-    return cmd_key in PERMS.get(key_role, set())
-
-# ----------------- Алиасы и help описания -----------------
-ALIASES = {
-    "warn": ["!warn","/warn","!варн","/варн","!пред","/пред"],
-    "warns": ["!warns","/warns","!варны","/варны","!предупреждения","/предупреждения"],
-    "unwarn": ["!unwarn","/unwarn","!снятьварн","/снятьварн","!унварн","/унварн"],
-    "mute": ["!mute","/mute","!мут","/мут","!заткнуть","/заткнуть"],
-    "unmute": ["!unmute","/unmute","!анмут","/анмут","!размут","/размут"],
-    "kick": ["!kick","/kick","!кик","/кик","!исключить","/исключить"],
-    "skick": ["!скик","/скик"],
-    "ban": ["!ban","/ban","!бан","/бан"],
-    "unban": ["!unban","/unban","!унбан","/унбан"],
-    "sban": ["!sban","/sban","!сбан","/сбан"],
-    "sunban": ["!sunban","/sunban","!сунбан","/сунбан"],
-    "info": ["!info","/info","!инфо","/инфо","/я","!я","/q","!q"],
-    "blacklist": ["!blacklist","/blacklist","!чс","/чс","!блэклист","/блэклист"],
-    "add": ["!add","/add","!добавить","/добавить","!добавитьвгруппу","/добавитьвгруппу"],
-    "help": ["!help","/help","!помощь","/помощь"],
-    "wipe": ["!wipe","/wipe","!вайп","/вайп"],
-    "gzov": ["!gzov","/gzov","!гзов","/гзов"],
-    "ss": ["!ss","/ss","!сс","/сс"],
-    "report": ["!report","/report","!репорт","/репорт"],
-    "admins": ["/админы","!админы","/admins","!admins"],
-    "setowner": ["/owner","/назначитьвладельцем","!owner","!назначитьвладельцем","/setowner"],
-    "allowner": ["/allowner","/всемвладельцем","!allowner"],
-    "setadmin": ["/admin","/назначитьадминистратором","!admin","!назначитьадминистратором","/setadmin"],
-    "setmoder": ["/moder","/назначитьмодератором","!moder","!назначитьмодератором","/setmoder"],
-    "sethelper": ["/helper","/назначитьпомощником","!helper","!назначитьпомощником","/sethelper"],
-    "alladmin": ["/alladmin","!alladmin"],
-    "allmoder": ["/allmoder","!allmoder"],
-    "allhelper": ["/allhelper","!allhelper"],
-    "removerole": ["/снять","/разжаловать","/removerole","/ремувроль"],
-    "allremoverole": ["/аллснять","/аллразжаловать","/allremoverole","/аллремувроль"],
-    "backup": ["/backup","!backup","/бэкап","!бэкап"],
-    "exportlogs": ["/exportlogs","/экспортлогов","/export_logs","/экспорт_логов"],
-    "clear": ["/clear","!clear","/удалить","!удалить"]
-}
-
-HELP_TEXTS = {
-    "info": "/info [id] - Показать информацию о пользователе.",
-    "report": "Отправить репорт владельцу (/report <текст>)",
-    "help": "Показать это сообщение",
-    "warn": "Выдать предупреждение (/warn [id|reply] [причина])",
-    "warns": "Показать предупреждения пользователя (/warns [id|reply])",
-    "unwarn": "Снять последний варн (/unwarn [id|reply])",
-    "mute": "Выдать мут на X минут (/mute [id|reply] <минуты> [причина]) — сообщения удаляются",
-    "unmute": "Снять мут (/unmute [id|reply])",
-    "kick": "Кикнуть из беседы (/kick [id|reply] [причина])",
-    "skick": "Попытаться кикнуть пользователя из всех известных боту бесед (/skick [id|reply])",
-    "ban": "Забанить в текущей беседе (/ban [id|reply] [причина])",
-    "unban": "Снять бан в текущей беседе (/unban [id|reply])",
-    "sban": "Глобальный бан (владелец) (/sban [id|reply] [причина])",
-    "sunban": "Снять глобальный бан (владелец) (/sunban [id|reply])",
-    "add": "Добавить пользователя в беседу (helper+) (/add [id|reply])",
-    "blacklist": "Управление черным списком слов (владелец) (/blacklist add/remove/list слово)",
-    "wipe": "Очистка таблиц (владелец) (/wipe warns/bans/roles/blacklist/chats)",
-    "gzov": "Разослать сообщение по всем сохранённым чатам (admin+) (/gzov <текст>)",
-    "ss": "Сообщение: @all Старший состав в игру! (/ss)",
-    "admins": "Показать владельца/админов/модеров/помощников в беседе (/админы)",
-    "setowner": "Назначить владельцем в текущей беседе (владелец) (/owner [id|reply])",
-    "allowner": "Назначить владельцем во всех беседах (владелец) (/allowner [id|reply])",
-    "backup": "Создать бэкап БД и отправить владельцу (владелец) (/backup)",
-    "clear": "Удалить сообщение, на которое дан reply; модераторы+"
-}
-
-def resolve_alias(cmd_text: str) -> Optional[str]:
-    ct = cmd_text.lower()
-    for key, vals in ALIASES.items():
-        if ct in vals:
-            return key
-    return None
-
-# ----------------- Реализация команд -----------------
-def cmd_help(peer_id: int, from_id: int, event, args: List[str]):
-    role = get_role_db(from_id, peer_id)
-    hierarchy = ["user", "helper", "moderator", "admin", "owner"]
-
-    help_text = "📖 Доступные команды для вашей роли:\n\n"
-
-    if role in hierarchy:
-        help_text += "👤 Пользователь:\n\n"
-        help_text += "/репорт [текст] (/report) - пожаловаться на игрока владельцу.\n\n"
-        help_text += "/инфо [id] (/инфо или /я) - информация о пользователе.\n\n"
-        help_text += "/помощь [id] - информация о командах.\n\n"
-        help_text += "/варны [id] - информация о варнов у пользователя.\n\n"
-
-    if role in ["helper", "moderator", "admin", "owner"]:
-        help_text += "🤝 Помощник:\n\n"
-        help_text += "/warn [id] [причина] (/варн) - выдать варн пользователю чата.\n\n"
-        help_text += "/mute [id] [время (в минутах)] [причина] (/мут) - выдать мут пользователю чата.\n\n"
-        help_text += "/ss (/cc) - вызвать старший состав в игру.\n\n"
-
-    if role in ["moderator", "admin", "owner"]:
-        help_text += "🔨 Модератор:\n\n"
-        help_text += "/unwarn [id] (/унварн) - снять предупреждение.\n\n"
-        help_text += "/unmute [id] (/унмут) - снять мут.\n\n"
-        help_text += "/kick [id] [причина] (/кик) - исключить пользователя из беседы.\n\n"
-
-    if role in ["admin", "owner"]:
-        help_text += "🛡 Админ:\n\n"
-        help_text += "/ban [id] [срок (в днях)] [причина] (/бан) — выдать бан пользователю.\n\n"
-        help_text += "/unban [id] (/унбан) — снять бан пользователю в группе.\n\n"
-        help_text += "/skick [id] [причина] (/cкик) - исключить пользователя из всех привязанных беседы.\n\n"
-        help_text += "/removerole [id] (/снять) - снять роль в беседе у пользователя.\n\n"
-        help_text += "/allremoverole [id] (/аллснять) - снять роль во всех беседах у пользователя.\n\n"
-        help_text += "/gzov [текст] (/gzov) - разослать сообщение по всем приявязанным чатам.\n\n"
-        help_text += "/sethelper [id] (/helper или /назначитьхелпером) - выдать роль хелпера (помощника) пользователю группы. (следящий)\n\n"
-        help_text += "/setmoder [id] (/moder или /назначитьмодератором) - выдать роль модератора пользователю группы. (лидер)\n\n"
-        help_text += "/allmoder [id] - выдать роль модератора во всех группах пользователю.\n\n"
-        help_text += "/allhelper [id] - выдать роль хелпера (помощника) во всех группах пользователю.\n\n"
-
-    if role == "owner":
-        help_text += "👑 Владелец:\n\n"
-        help_text += "/sban [id] [причина] (/сбан) — выдать бан пользователю во всех привязанных группах.\n\n"
-        help_text += "/sunban [id] (/сунбан) — снять бан пользователю во всех привязанных группах.\n\n"
-        help_text += "/setadmin [id] (/admin или /назначитьадминистратором) - выдать роль администратора пользователю группы.\n\n"
-        help_text += "/setowner [id] (/owner или /назначитьвладельцем) - выдать роль владельца пользователю группы.\n\n"
-        help_text += "/alladmin [id] - выдать роль администратора во всех группах пользователю.\n\n"
-        help_text += "/allowner [id] - выдать роль владельца во всех группах пользователю.\n\n"
-        help_text += "/blacklist remove (/чс remove) — удалить слово из списка запрещенных слов.\n\n"
-        help_text += "/blacklist add (/чс add) — добавить в список запрещенное слово.\n\n"
-        help_text += "/blacklist list (/чс list) — список запрещенных слов.\n\n"
-        help_text += "/exportlogs (/экспортлогов) — экспорт логов.\n\n"
-        help_text += "/backup (/бэкап) — сделать бэкап.\n\n"
-        help_text += "/wipe chats — отчитить таблицу чатов.\n\n"
-        help_text += "/wipe blacklist — отчитить таблицу запрещенных слов.\n\n"
-        help_text += "/wipe roles — отчитить таблицу ролей.\n\n"
-        help_text += "/wipe bans — отчитить таблицу банов.\n\n"
-        help_text += "/wipe warns — отчитить таблицу варнов.\n\n"
-
-
-    safe_send(peer_id, help_text.strip())
-
-def cmd_info(peer_id: int, from_id: int, event, args: List[str]):
-    target = parse_user_id(event, args) or from_id
-    role = get_role_db(target, peer_id)
-    warns = get_warns_db(target) or []
-    mutes = get_mutes_db(target) or []
-    bans = get_bans_db(target) or []
-    active_mutes = []
-    for m in mutes:
-        try:
-            until = datetime.datetime.strptime(m[3], "%Y-%m-%d %H:%M:%S")
-            if until > datetime.datetime.now():
-                active_mutes.append(m)
-        except Exception:
-            pass
-    text = (f"📌 Инфо: {mention(target)}\n"
-            f"Роль (локально): {role}\n"
-            f"Всего варнов: {len(warns)}\nАктивных мутов: {len(active_mutes)}\nЗаписей о банах: {len(bans)}")
-    safe_send(peer_id, text)
-
-def cmd_warn(peer_id: int, from_id: int, event, args: List[str]):
-    if not has_perm(from_id, "warn", peer_id):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя (reply или id).")
-    reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
-    add_warn_db(target, from_id, reason, peer_id)
-    warns = get_warns_db(target) or []
-    safe_send(peer_id, (f"⚠️ Варн выдан {mention(target)}.\nПричина: {reason}\nВыдал: {mention(from_id)}\n"
-                        f"Дата: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\nВсего варнов: {len(warns)}"))
-    if len(warns) >= 3:
-        kick_from_chat_peer(peer_id, target)
-        safe_send(peer_id, f"❌ {mention(target)} исключён из беседы (3/3).")
-
-def cmd_warns(peer_id: int, from_id: int, event, args: List[str]):
-    target = parse_user_id(event, args) or from_id
-    warns = get_warns_db(target) or []
-    if not warns:
-        return safe_send(peer_id, f"✅ У {mention(target)} нет варнов.")
-    text = f"📜 Варны {mention(target)} ({len(warns)}):\n"
-    for w in warns:
-        text += f"- {w[3]} | от {mention(w[1])} | причина: {w[2]}\n"
-    safe_send(peer_id, text)
-
-def cmd_unwarn(peer_id: int, from_id: int, event, args: List[str]):
-    if not has_perm(from_id, "unwarn", peer_id):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    res = remove_last_warn_db(target)
-    if res is None:
-        return safe_send(peer_id, "❌ У пользователя нет варнов.")
-    safe_send(peer_id, f"✅ Последний варн снят у {mention(target)}")
-
-def cmd_mute(peer_id: int, from_id: int, event, args: List[str]):
-    if not has_perm(from_id, "mute", peer_id):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    minutes = 10
-    reason = "Не указана"
-    if len(args) >= 2 and args[1].isdigit():
-        minutes = int(args[1])
-        reason = " ".join(args[2:]) if len(args) > 2 else "Не указана"
-    else:
-        reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
-    add_mute_db(target, from_id, minutes, reason, peer_id)
-    until = (datetime.datetime.now() + datetime.timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M:%S")
-    safe_send(peer_id, f"🔇 Мут выдан {mention(target)} на {minutes} минут.\nПричина: {reason}\nДо: {until}")
-
-def cmd_unmute(peer_id: int, from_id: int, event, args: List[str]):
-    if not has_perm(from_id, "unmute", peer_id):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    delete_mutes_for_user_in_peer_db(target, peer_id)
-    safe_send(peer_id, f"🔔 Мут снят с {mention(target)}")
-
-def cmd_kick(peer_id: int, from_id: int, event, args: List[str]):
-    if not has_perm(from_id, "kick", peer_id):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
-    ok = kick_from_chat_peer(peer_id, target)
-    if ok:
-        safe_send(peer_id, f"👢 {mention(target)} кикнут.\nПричина: {reason}\nВыдал: {mention(from_id)}")
-    else:
-        safe_send(peer_id, "❌ Не удалось кикнуть (возможно у бота нет прав).")
-
-def cmd_skick(peer_id: int, from_id: int, event, args: List[str]):
-    if not (has_perm(from_id, "skick", peer_id) or is_owner(from_id)):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    res = global_kick_user(target)
-    ok = sum(1 for _, v in res if v)
-    safe_send(peer_id, f"👢 Попытка исключить {mention(target)} из всех бесед. Успешно: {ok}/{len(res)}")
-
-def cmd_ban(peer_id: int, from_id: int, event, args: List[str]):
-    if not has_perm(from_id, "ban", peer_id):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
-    add_ban_db(target, from_id, reason, peer_id)
-    remove_roles_db(target, peer_id)
-    kick_from_chat_peer(peer_id, target)
-    safe_send(peer_id, f"🔒 {mention(target)} забанен в этой беседе. Причина: {reason}")
-
-def cmd_unban_local(peer_id: int, from_id: int, event, args: List[str]):
-    if not has_perm(from_id, "unban", peer_id) and not has_perm(from_id, "ban", peer_id):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    remove_bans_db(target, peer_id)
-    safe_send(peer_id, f"🔓 Бан снят с {mention(target)} в этой беседе.")
-
-def cmd_sban(peer_id: int, from_id: int, event, args: List[str]):
-    if not is_owner(from_id):
-        return safe_send(peer_id, "❌ Только владелец может выдавать глобальный бан.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
-    add_ban_db(target, from_id, reason, 0)
-    remove_roles_db(target, None)
-    res = global_kick_user(target)
-    ok = sum(1 for _, v in res if v)
-    safe_send(peer_id, f"🚫 {mention(target)} глобально забанен. Удалён из {ok}/{len(res)} бесед. Причина: {reason}")
-
-def cmd_sunban(peer_id: int, from_id: int, event, args: List[str]):
-    if not is_owner(from_id):
-        return safe_send(peer_id, "❌ Только владелец.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    remove_bans_db(target, None)
-    safe_send(peer_id, f"🔓 Глобальный бан снят с {mention(target)}")
-
-def cmd_add(peer_id: int, from_id: int, event, args: List[str]):
-    role = get_role_db(from_id, peer_id)
-
-    if role not in ["helper", "moderator", "admin", "owner"]:
-        safe_send(peer_id, "⛔ У вас нет прав для использования этой команды.")
-        return
-
-    target_id = None
-
-    if args:
-        target_id = parse_user_id(args[0])
-    elif event.get("reply_message"):
-        target_id = event["reply_message"]["from_id"]
-
-    if not target_id:
-        safe_send(peer_id, "⚠ Укажите пользователя через @id или ответом на сообщение.")
-        return
-
-    try:
-        vk.messages.addChatUser(chat_id=peer_id-2000000000, user_id=target_id)
-        safe_send(peer_id, f"✅ [id{target_id}|Пользователь] добавлен в чат.")
-    except Exception as e:
-        safe_send(peer_id, f"⚠ Ошибка: {e}")
-
-def cmd_role_local(peer_id: int, from_id: int, event, args: List[str], role_name: str):
-    if not (has_perm(from_id, "role", peer_id) or is_owner(from_id)):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    set_role_db(target, role_name, peer_id)
-    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    safe_send(peer_id, f"✅ {mention(target)} назначен(а) {role_name} в этой беседе.\nВыдал: {mention(from_id)}\nДата: {ts}")
-
-def cmd_role_global(peer_id: int, from_id: int, event, args: List[str], role_name: str):
-    if not is_owner(from_id):
-        return safe_send(peer_id, "❌ Только владелец может назначать роли во всех беседах.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    set_role_db(target, role_name, 0)
-    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    safe_send(peer_id, f"🌍 {mention(target)} назначен(а) {role_name} глобально.\nВыдал: {mention(from_id)}\nДата: {ts}")
-
-def cmd_remove_role_local(peer_id: int, from_id: int, event, args: List[str]):
-    if not (has_perm(from_id, "removerole", peer_id) or is_owner(from_id)):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    remove_roles_db(target, peer_id)
-    safe_send(peer_id, f"✅ С {mention(target)} сняты роли в этой беседе.")
-
-def cmd_remove_role_global(peer_id: int, from_id: int, event, args: List[str]):
-    if not is_owner(from_id):
-        return safe_send(peer_id, "❌ Только владелец.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    remove_roles_db(target, None)
-    safe_send(peer_id, f"🌍 С {mention(target)} сняты все роли глобально.")
-
-def cmd_blacklist(peer_id: int, from_id: int, event, args: List[str]):
-    if not is_owner(from_id):
-        return safe_send(peer_id, "❌ Только владелец может управлять ЧС.")
-    if not args:
-        return safe_send(peer_id, "Использование: /blacklist add/remove/list <слово>")
-    action = args[0].lower()
-    if action in ("add","добавить"):
-        if len(args) < 2:
-            return safe_send(peer_id, "❌ Укажите слово.")
-        add_blacklist_db(args[1])
-        safe_send(peer_id, f"✅ Слово '{args[1]}' добавлено в список запретных слов.")
-    elif action in ("remove","удалить","rm"):
-        if len(args) < 2:
-            return safe_send(peer_id, "❌ Укажите слово.")
-        remove_blacklist_db(args[1])
-        safe_send(peer_id, f"✅ Слово '{args[1]}' удалено из списка запретных слов.")
-    elif action in ("list","список"):
-        bl = get_blacklist_db()
-        safe_send(peer_id, "📜 ЧС слов:\n" + (", ".join(bl) if bl else "ЧС пуст."))
-    else:
-        safe_send(peer_id, "❌ Неизвестное действие.")
-
-def cmd_wipe(peer_id: int, from_id: int, event, args: List[str]):
-    if not is_owner(from_id):
-        return safe_send(peer_id, "❌ Только владелец.")
-    if not args:
-        return safe_send(peer_id, "Использование: /wipe warns/bans/roles/blacklist/chats")
-    t = args[0].lower()
-    if t == "warns":
-        db_execute("DELETE FROM warns")
-        safe_send(peer_id, "🧹 Все варны очищены.")
-    elif t == "bans":
-        db_execute("DELETE FROM bans")
-        safe_send(peer_id, "🧹 Все баны очищены.")
-    elif t == "roles":
-        db_execute("DELETE FROM roles")
-        safe_send(peer_id, "🧹 Все роли очищены.")
-    elif t == "blacklist":
-        db_execute("DELETE FROM blacklist")
-        safe_send(peer_id, "🧹 ЧС очищен.")
-    elif t == "chats":
-        db_execute("DELETE FROM chats")
-        safe_send(peer_id, "🧹 Список чатов очищен.")
-    else:
-        safe_send(peer_id, "❌ Неверный параметр.")
-
-def cmd_report(peer_id: int, from_id: int, event, args: List[str]):
-    if not args:
-        return safe_send(peer_id, "❌ Напишите текст репорта.")
-    text = " ".join(args)
-    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    payload = f"📣 Репорт от {mention(from_id)}\n{text}\n{ts}"
-    if OWNER_ID:
-        safe_send(OWNER_ID, payload)
-    safe_send(peer_id, "✅ Репорт отправлен владельцу.")
-
-def cmd_gzov(peer_id: int, from_id: int, event, args: List[str]):
-    if not (has_perm(from_id, "gzov", peer_id) or is_owner(from_id)):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    if not args:
-        return safe_send(peer_id, "❌ Укажите текст для рассылки.")
-    try:
-        u = vk.users.get(user_ids=from_id)[0]
-        name = f"{u.get('first_name','')} {u.get('last_name','')}"
-    except Exception:
-        name = str(from_id)
-    msg = f"@all Внимание! Информация от {name}!\n\n" + " ".join(args) + "\n\nСпасибо за внимание!"
-    chats = get_chats()
-    if not chats:
-        return safe_send(peer_id, "❌ Бот не состоит ни в одной беседе.")
-    ok = 0
-    for p in chats:
-        try:
-            safe_send(p, msg)
-            ok += 1
-            time.sleep(0.02)
-        except Exception:
-            pass
-    safe_send(peer_id, f"✅ Рассылка отправлена в {ok} бесед(ы).")
-
-def cmd_ss(peer_id: int, from_id: int, event, args: List[str]):
-    if not (has_perm(from_id, "ss", peer_id) or is_owner(from_id)):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    safe_send(peer_id, "@all Старший состав в игру! Даю 5 минут.")
-
-def cmd_admins(peer_id: int, from_id: int, event, args: List[str]):
-    roles = db_select("SELECT user_id, role FROM roles WHERE peer_id=?", (peer_id,))
-    if not roles:
-        safe_send(peer_id, "⚠ В этом чате пока нет администраторов.")
-        return
-
-    grouped = {"owner": [], "admin": [], "moderator": [], "helper": []}
-    for user_id, role in roles:
-        if role in grouped:
-            grouped[role].append(user_id)
-
-    msg = "👑 Список администрации чата:\n\n"
-    if grouped["owner"]:
-        msg += "👑 Владельцы:\n" + "\n".join([f"[id{uid}|Пользователь]" for uid in grouped["owner"]]) + "\n\n"
-    if grouped["admin"]:
-        msg += "🛡 Админы:\n" + "\n".join([f"[id{uid}|Пользователь]" for uid in grouped["admin"]]) + "\n\n"
-    if grouped["moderator"]:
-        msg += "🔨 Модераторы:\n" + "\n".join([f"[id{uid}|Пользователь]" for uid in grouped["moderator"]]) + "\n\n"
-    if grouped["helper"]:
-        msg += "🤝 Помощники:\n" + "\n".join([f"[id{uid}|Пользователь]" for uid in grouped["helper"]]) + "\n\n"
-
-    safe_send(peer_id, msg.strip())
-
-# ----------------- Команды владельца (лок/глоб) -----------------
-def cmd_setowner_local(peer_id: int, from_id: int, event, args: List[str]):
-    if not is_owner(from_id):
-        return safe_send(peer_id, "❌ Только владелец может назначать владельцев.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    set_role_db(target, "owner", peer_id)
-    safe_send(peer_id, f"✅ {mention(target)} назначен(а) владельцем в этой беседе.")
-
-def cmd_setowner_global(peer_id: int, from_id: int, event, args: List[str]):
-    if not is_owner(from_id):
-        return safe_send(peer_id, "❌ Только владелец.")
-    target = parse_user_id(event, args)
-    if not target:
-        return safe_send(peer_id, "❌ Укажите пользователя.")
-    set_role_db(target, "owner", 0)
-    safe_send(peer_id, f"🌍 {mention(target)} назначен(а) владельцем глобально.")
-
-# ----------------- Бэкап и экспорт логов -----------------
-def create_backup_file() -> Optional[str]:
-    try:
-        os.makedirs("backups", exist_ok=True)
-        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        fname = os.path.join("backups", f"moder_bot_backup_{ts}.db")
-        shutil.copyfile(DB_PATH, fname)
-        return fname
-    except Exception as e:
-        logger.exception("create_backup_file error: %s", e)
-        return None
-
-def cmd_backup(peer_id: int, from_id: int, event, args: List[str]):
-    if not is_owner(from_id):
-        return safe_send(peer_id, "❌ Только владелец может делать бэкап.")
-    fname = create_backup_file()
-    if not fname:
-        return safe_send(peer_id, "❌ Ошибка при создании бэкапа.")
-    try:
-        doc = upload.document_message(fname, title=os.path.basename(fname), peer_id=from_id)
-        attach = f"doc{doc['doc']['owner_id']}_{doc['doc']['id']}"
-        vk.messages.send(peer_id=from_id, random_id=random.randint(1, 2**31-1), attachment=attach, message="✅ Бэкап базы")
-        safe_send(peer_id, "✅ Бэкап создан и отправлен владельцу в ЛС.")
-    except Exception as e:
-        logger.exception("backup upload error: %s", e)
-        safe_send(peer_id, f"⚠️ Бэкап создан: {fname}, но не удалось отправить в ЛС.")
-
-def export_logs_file() -> Optional[str]:
-    try:
-        os.makedirs("logs_export", exist_ok=True)
-        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        dst = os.path.join("logs_export", f"moder_bot_log_{ts}.log")
-        shutil.copyfile(LOG_PATH, dst)
-        return dst
-    except Exception as e:
-        logger.exception("export_logs_file error: %s", e)
-        return None
-
-def cmd_export_logs(peer_id: int, from_id: int, event, args: List[str]):
-    if not (has_perm(from_id, "exportlogs", peer_id) or is_owner(from_id)):
-        return safe_send(peer_id, "❌ Недостаточно прав.")
-    dst = export_logs_file()
-    if not dst:
-        return safe_send(peer_id, "❌ Ошибка экспорта логов.")
-    try:
-        doc = upload.document_message(dst, title=os.path.basename(dst), peer_id=from_id)
-        attach = f"doc{doc['doc']['owner_id']}_{doc['doc']['id']}"
-        vk.messages.send(peer_id=from_id, random_id=random.randint(1, 2**31-1), attachment=attach, message="🗒️ Экспорт логов")
-        safe_send(peer_id, "✅ Логи экспортированы и отправлены владельцу.")
-    except Exception as e:
-        logger.exception("logs upload error: %s", e)
-        safe_send(peer_id, f"⚠️ Логи экспортированы: {dst}, но не удалось отправить в ЛС.")
-
-# ----------------- Команда clear (/удалить) -----------------
-def cmd_clear(peer_id, from_id, args, event, vk):
-    role = get_role_db(from_id, peer_id)
-
-    # Проверка прав
-    allowed_roles = ["moderator", "admin", "owner"]
-    if role not in allowed_roles:
-        safe_send(peer_id, "⛔ У вас нет прав для использования этой команды.")
-        return
-
-    # Проверяем ответ на сообщение
-    if not event.get("reply_message"):
-        safe_send(peer_id, "⚠ Используйте команду ответом на сообщение, которое нужно удалить.")
-        return
-
-    target_msg_id = event["reply_message"]["id"]
-    target_user_id = event["reply_message"]["from_id"]
-
-    # Проверка по ролям
-    target_role = get_role_db(target_user_id, peer_id)
-    hierarchy = {"user": 0, "helper": 1, "moderator": 2, "admin": 3, "owner": 4}
-
-    if hierarchy.get(role, 0) <= hierarchy.get(target_role, 0):
-        safe_send(peer_id, "⛔ Вы не можете удалить сообщение этого пользователя.")
-        return
-
-    try:
-        # Удаляем сообщение жертвы
-        vk.messages.delete(peer_id=peer_id, cmids=[target_msg_id], delete_for_all=1)
-        # Удаляем команду
-        vk.messages.delete(peer_id=peer_id, cmids=[event["conversation_message_id"]], delete_for_all=1)
-
-        # Отчёт
-        report = f"""
-🗑 Сообщение удалено!
-👮 Удалил: [id{from_id}|Пользователь]
-👤 У кого: [id{target_user_id}|Пользователь]
-⏰ Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-        """
-        safe_send(peer_id, report)
-    except Exception as e:
-        safe_send(peer_id, f"⚠ Ошибка при удалении: {e}")
-
-# ----------------- Автоматические задачи -----------------
-def mute_watcher():
-    while True:
-        try:
-            rows = db_execute("SELECT id, user_id, issued_by, until, reason, peer_id FROM mutes", fetch=True) or []
-            now = datetime.datetime.now()
-            for r in rows:
-                try:
-                    mid, uid, issued_by, until_s, reason, peer_id = r
-                    until = datetime.datetime.strptime(until_s, "%Y-%m-%d %H:%M:%S")
-                    if until <= now:
-                        delete_mute_db(mid)
-                        text = f"🔔 Мут снят: {mention(uid)}\nПричина: {reason}\nВыдал: {mention(issued_by)}\nВремя: {until_s}"
-                        if peer_id and peer_id >= 2000000000:
-                            safe_send(peer_id, text)
-                        else:
-                            if OWNER_ID:
-                                safe_send(OWNER_ID, text)
-                except Exception:
-                    pass
-        except Exception as e:
-            logger.exception("mute_watcher loop error: %s", e)
-        time.sleep(10)
-
-from zoneinfo import ZoneInfo   # импорт в начале файла
-
-def wait_until_next(hour: int = 23, minute: int = 59):
-    tz = ZoneInfo("Europe/Moscow")  # московская зона
-    now = datetime.datetime.now(tz=tz)
-    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-    if now >= target:
-        target = target + datetime.timedelta(days=1)
-    delta = (target - now).total_seconds()
-    return max(0, delta)
-
-def periodic_backup_and_logs():
-    """
-    Ежедневно в 23:59 по локальному времени выполняет:
-    - бэкап БД
-    - экспорт логов
-    и отправляет результаты владельцу.
-    """
-    while True:
-        try:
-            secs = wait_until_next(23, 59)
-            logger.info("Автозадача: ожидание %s секунд до 23:59", secs)
-            time.sleep(secs + 1)  # приблизительно к 23:59:01
-            # бэкап
-            try:
-                bfile = create_backup_file()
-                if bfile and OWNER_ID:
-                    try:
-                        doc = upload.document_message(bfile, title=os.path.basename(bfile), peer_id=OWNER_ID)
-                        attach = f"doc{doc['doc']['owner_id']}_{doc['doc']['id']}"
-                        vk.messages.send(peer_id=OWNER_ID, random_id=random.randint(1,2**31-1), attachment=attach, message=f"Автобэкап базы выполнен: {os.path.basename(bfile)}")
-                    except Exception as e:
-                        logger.exception("periodic backup upload error: %s", e)
-            except Exception:
-                logger.exception("periodic backup error")
-            # экспорт логов
-            try:
-                logfile = export_logs_file()
-                if logfile and OWNER_ID:
-                    try:
-                        doc = upload.document_message(logfile, title=os.path.basename(logfile), peer_id=OWNER_ID)
-                        attach = f"doc{doc['doc']['owner_id']}_{doc['doc']['id']}"
-                        vk.messages.send(peer_id=OWNER_ID, random_id=random.randint(1,2**31-1), attachment=attach, message=f"Автоэкспорт логов: {os.path.basename(logfile)}")
-                    except Exception as e:
-                        logger.exception("periodic logs upload error: %s", e)
-            except Exception:
-                logger.exception("periodic logs error")
-            # после выполнения — ждём снова на следующий день
-        except Exception as e:
-            logger.exception("periodic backup/logs loop error: %s", e)
-            time.sleep(60)
-
-# Запускаем фоновые потоки
-threading.Thread(target=mute_watcher, daemon=True).start()
-threading.Thread(target=periodic_backup_and_logs, daemon=True).start()
-
-# ----------------- Диспетчер команд -----------------
-def handle_command(event, cmd_text: str, args: List[str]):
-    msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
-    if not msg:
-        return
-    peer_id = msg.get("peer_id") if isinstance(msg, dict) else getattr(msg, "peer_id", None)
-    from_id = msg.get("from_id") if isinstance(msg, dict) else getattr(msg, "from_id", None)
-    if peer_id and peer_id >= 2000000000:
-        add_chat(peer_id)
-    key = resolve_alias(cmd_text)
-    if not key:
-        return
-    try:
-        # map key to function
-        if key == "help":
-            return cmd_help(peer_id, from_id, event, args)
-        if key == "info":
-            return cmd_info(peer_id, from_id, event, args)
-        if key == "warn":
-            return cmd_warn(peer_id, from_id, event, args)
-        if key == "warns":
-            return cmd_warns(peer_id, from_id, event, args)
-        if key == "unwarn":
-            return cmd_unwarn(peer_id, from_id, event, args)
-        if key == "mute":
-            return cmd_mute(peer_id, from_id, event, args)
-        if key == "unmute":
-            return cmd_unmute(peer_id, from_id, event, args)
-        if key == "kick":
-            return cmd_kick(peer_id, from_id, event, args)
-        if key == "skick":
-            return cmd_skick(peer_id, from_id, event, args)
-        if key == "ban":
-            return cmd_ban(peer_id, from_id, event, args)
-        if key == "unban":
-            return cmd_unban_local(peer_id, from_id, event, args)
-        if key == "sban":
-            return cmd_sban(peer_id, from_id, event, args)
-        if key == "sunban":
-            return cmd_sunban(peer_id, from_id, event, args)
-        if key == "add":
-            return cmd_add(peer_id, from_id, event, args)
-        if key == "blacklist":
-            return cmd_blacklist(peer_id, from_id, event, args)
-        if key == "wipe":
-            return cmd_wipe(peer_id, from_id, event, args)
-        if key == "report":
-            return cmd_report(peer_id, from_id, event, args)
-        if key == "gzov":
-            return cmd_gzov(peer_id, from_id, event, args)
-        if key == "ss":
-            return cmd_ss(peer_id, from_id, event, args)
-        if key == "admins":
-            return cmd_admins(peer_id, from_id, event, args)
-        if key == "setowner":
-            return cmd_setowner_local(peer_id, from_id, event, args)
-        if key == "allowner":
-            return cmd_setowner_global(peer_id, from_id, event, args)
-        if key == "setadmin":
-            return cmd_role_local(peer_id, from_id, event, args, "admin")
-        if key == "setmoder":
-            return cmd_role_local(peer_id, from_id, event, args, "moder")
-        if key == "sethelper":
-            return cmd_role_local(peer_id, from_id, event, args, "helper")
-        if key == "alladmin":
-            return cmd_role_global(peer_id, from_id, event, args, "admin")
-        if key == "allmoder":
-            return cmd_role_global(peer_id, from_id, event, args, "moder")
-        if key == "allhelper":
-            return cmd_role_global(peer_id, from_id, event, args, "helper")
-        if key == "removerole":
-            return cmd_remove_role_local(peer_id, from_id, event, args)
-        if key == "allremoverole":
-            return cmd_remove_role_global(peer_id, from_id, event, args)
-        if key == "backup":
-            return cmd_backup(peer_id, from_id, event, args)
-        if key == "clear":
-            return cmd_clear(peer_id, from_id, event, args)
-        if key == "exportlogs":
-            return cmd_export_logs(peer_id, from_id, event, args)
-    except Exception as e:
-        logger.exception("handle_command exception: %s", e)
-        safe_send(peer_id, "❌ Ошибка при выполнении команды.")
-
-# ----------------- Обработка входящих сообщений -----------------
-def process_new_message(event):
-    try:
-        msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
-        if not msg:
-            return
-        peer_id = msg.get("peer_id") if isinstance(msg, dict) else getattr(msg, "peer_id", None)
-        from_id = msg.get("from_id") if isinstance(msg, dict) else getattr(msg, "from_id", None)
-        if peer_id and peer_id >= 2000000000:
-            add_chat(peer_id)
-        action = msg.get("action") if isinstance(msg, dict) else getattr(msg, "action", None)
-        if action:
-            handle_invite_action(event)
-        if handle_blacklist_on_message(event):
-            return
-        try:
-            mutes = get_mutes_db(from_id) or []
-            now = datetime.datetime.now()
-            for m in mutes:
-                if len(m) < 6:
-                    continue
-                try:
-                    until = datetime.datetime.strptime(m[3], "%Y-%m-%d %H:%M:%S")
-                except Exception:
-                    continue
-                m_peer = m[5]
-                if until > now and (m_peer == 0 or m_peer == peer_id):
-                    conv_id = msg.get("conversation_message_id") if isinstance(msg, dict) else getattr(msg, "conversation_message_id", None)
-                    mid = msg.get("id") if isinstance(msg, dict) else getattr(msg, "id", None)
-                    try:
-                        if conv_id:
-                            vk.messages.delete(conversation_message_ids=[conv_id], peer_id=peer_id, delete_for_all=1)
-                        elif mid:
-                            vk.messages.delete(message_ids=[mid], delete_for_all=1)
-                    except Exception:
-                        pass
-                    return
-        except Exception:
-            pass
-    except Exception as e:
-        logger.exception("process_new_message error: %s", e)
-
-# ----------------- Главный цикл -----------------
-def main():
-    logger.info("Бот запущен...")
-    try:
-        if OWNER_ID:
-            safe_send(OWNER_ID, "✅ Бот запущен и слушает события.")
-    except Exception:
-        pass
-
-    for event in longpoll.listen():
-        try:
-            if event.type == VkBotEventType.MESSAGE_NEW:
-                process_new_message(event)
-                msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
-                if not msg:
-                    continue
-                text = (msg.get("text") if isinstance(msg, dict) else getattr(msg, "text", "")) or ""
-                text = text.strip()
-                if not text:
-                    continue
-                parts = text.split()
-                cmd = parts[0].lower()
-                args = parts[1:]
-                if cmd.startswith("!") or cmd.startswith("/"):
-                    handle_command(event, cmd, args)
-                else:
-                    lw = text.lower()
-                    if lw in ("привет","hi","hello"):
-                        safe_send(msg.get("peer_id"), "Привет!")
-                    elif lw in ("пока","bye"):
-                        safe_send(msg.get("peer_id"), "До встречи 👋")
-        except Exception as e:
-            logger.exception("Main loop error: %s", e)
-            time.sleep(1)
-
-if __name__ == "__main__":
-    main()
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+vk_moder_bot.py
+Полный рабочий скрипт модератор-бота для ВК — расширенная версия с миграциями, автозадачами,
+экспортом логов, бэкапом и множеством команд (рус/англ алиасы).
+"""
+import os
+import sys
+import csv
+import json
+import gzip
+import hmac
+import time
+import atexit
+import sqlite3
+import logging
+import re
+import random
+import threading
+import datetime
+import functools
+import contextlib
+import heapq
+import itertools
+import queue
+import multiprocessing
+from typing import List, Optional, Tuple
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import vk_api
+from vk_api.bot_longpoll import VkBotLongPoll, VkBotEventType, VkBotEvent, VkBotMessageEvent
+from vk_api import VkUpload
+from dotenv import load_dotenv
+
+import migrations
+from blacklist_matcher import AhoCorasick
+from vk_batch import execute_batch, EXECUTE_MAX_CALLS
+from outbox import Outbox, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW, RETRY_CODES
+from metrics import Registry, MetricsServer, DB_BUCKETS
+from backup import create_backup, split_file, BACKUP_DIR
+from logstore import setup_queue_logging, export_logs, parse_export_args
+
+# ----------------- Загрузка .env -----------------
+load_dotenv()
+GROUP_TOKEN = os.getenv("GROUP_TOKEN", "").strip()
+GROUP_ID = int(os.getenv("GROUP_ID") or 0)
+OWNER_ID = int(os.getenv("OWNER_ID") or 0)
+DB_PATH = os.getenv("DB_PATH") or "moder_bot.db"
+LOG_PATH = os.getenv("LOG_PATH") or "moder_bot.log"
+
+# ----------------- Логирование -----------------
+logger = logging.getLogger("vk_moder_bot")
+
+def setup_logging(log_path: str = LOG_PATH, shard: Optional[int] = None):
+    """
+    Запись в лог — put в очередь; файл, ротация в сжатые сегменты и консоль — в потоке (см. logstore.py).
+    Процесс-шард пишет в свой файл moder_bot.shardN.log, /exportlogs собирает их все.
+    """
+    global LOG_PATH
+    LOG_PATH = log_path
+    if shard is not None:
+        stem, ext = os.path.splitext(log_path)
+        log_path = f"{stem}.shard{shard}{ext}"
+    setup_queue_logging(log_path)
+
+# ----------------- Метрики -----------------
+METRICS_PORT = int(os.getenv("PORT") or os.getenv("METRICS_PORT") or 0)   # PORT задаёт Render для web-сервиса; 0 — без HTTP
+LIVENESS_TIMEOUT = int(os.getenv("LIVENESS_TIMEOUT") or 120)   # секунд без ответа longpoll, после которых /health = 503
+
+registry = Registry()
+m_command_seconds = registry.histogram("vk_bot_command_seconds", "Время выполнения команды", ("command",))
+m_command_errors = registry.counter("vk_bot_command_errors_total", "Команды, завершившиеся исключением", ("command",))
+m_db_seconds = registry.histogram("vk_bot_db_query_seconds", "Время запроса SQLite", ("query",), buckets=DB_BUCKETS)
+m_vk_calls = registry.counter("vk_bot_vk_api_calls_total", "Вызовы VK API", ("method",))
+m_vk_errors = registry.counter("vk_bot_vk_api_errors_total", "Ошибки VK API", ("method", "code"))
+m_vk_seconds = registry.histogram("vk_bot_vk_api_seconds", "Время вызова VK API", ("method",))
+
+longpoll_progress = 0.0    # time.time() последнего ответа longpoll (0 — ещё не подключались)
+
+@functools.lru_cache(maxsize=1024)
+def query_label(query: str) -> str:
+    """Метка запроса для метрик: SQL в одну строку, не длиннее 100 символов."""
+    return " ".join(query.split())[:100]
+
+def observe_vk_call(method: str, fn, *a, **kw):
+    t0 = time.perf_counter()
+    try:
+        return fn(*a, **kw)
+    except Exception as e:
+        m_vk_errors.inc(method, str(getattr(e, "code", "") or type(e).__name__))
+        raise
+    finally:
+        m_vk_calls.inc(method)
+        m_vk_seconds.observe(time.perf_counter() - t0, method)
+
+class InstrumentedApi:
+    """Обёртка над vk_session.get_api(): vk.messages.send(...) считается в метриках по имени метода."""
+    __slots__ = ("_api", "_method")
+
+    def __init__(self, api, method: str = ""):
+        self._api = api
+        self._method = method
+
+    def __getattr__(self, name: str):
+        return InstrumentedApi(getattr(self._api, name), f"{self._method}.{name}" if self._method else name)
+
+    def __call__(self, **params):
+        return observe_vk_call(self._method, self._api, **params)
+
+# ----------------- Шарды -----------------
+# При SHARDS > 1 события раскладываются по процессам по peer_id (см. «Шардирование по процессам»).
+# Процесс-шард обслуживает только свои беседы и держит свои кэши; изменения, которые касаются
+# всех бесед (роли, ЧС, участники, очистка таблиц), он рассылает остальным через publish_change.
+SHARDS = int(os.getenv("SHARDS") or 1)
+SHARD_PUT_TIMEOUT = 1.0    # секунды: шаг ожидания места в очереди шарда между проверками, жив ли он
+SHARD_INDEX = 0
+SHARD_COUNT = 1
+_publish = None    # в процессе-шарде: fn(kind, args) — отправка изменения остальным шардам
+
+def shard_of(peer_id: int, shards: int) -> int:
+    # перемешиваем peer_id, чтобы соседние беседы расходились по разным шардам
+    return (((int(peer_id) * 2654435761) & 0xFFFFFFFF) >> 8) % shards
+
+def owns_peer(peer_id: int) -> bool:
+    return SHARD_COUNT == 1 or shard_of(peer_id, SHARD_COUNT) == SHARD_INDEX
+
+def publish_change(kind: str, *args):
+    """Сообщает остальным шардам об изменении, после которого им нужно поправить свои кэши (см. apply_change)."""
+    if _publish is not None:
+        _publish(kind, args)
+
+# ----------------- Инициализация VK -----------------
+# Клиент создаётся в BotApp.init_vk(), longpoll — в BotApp.run(): импорт модуля не ходит в сеть
+vk_session = None
+vk = None
+longpoll = None
+upload = None
+
+# ----------------- Роли и права -----------------
+ROLE_PRIORITY = {
+    "owner": 100,
+    "admin": 80,
+    "moder": 60,
+    "helper": 40,
+    "user": 0
+}
+
+# Роли от младшей к старшей (порядок разделов в /help)
+ROLE_TIERS = ["user", "helper", "moder", "admin", "owner"]
+
+# роль -> набор прав; заполняется из реестра команд (build_permissions)
+PERMS = {role: set() for role in ROLE_TIERS}
+
+# Синонимы ролей, встречающиеся в БД (рус/англ) -> ключ PERMS
+ROLE_ALIASES = {
+    "владелец": "owner", "owner": "owner",
+    "админ": "admin", "admin": "admin",
+    "модер": "moder", "moder": "moder",
+    "помощник": "helper", "helper": "helper",
+}
+
+# Права компилируются в битовые маски: проверка права — одно побитовое И
+PERM_BITS = {}
+ROLE_MASKS = {}
+
+def build_permissions():
+    PERM_BITS.clear()
+    PERM_BITS.update({key: 1 << i for i, key in enumerate(sorted(set().union(*PERMS.values())))})
+    ROLE_MASKS.clear()
+    ROLE_MASKS.update({role: sum(PERM_BITS[k] for k in keys) for role, keys in PERMS.items()})
+
+# ----------------- База данных -----------------
+# Каждый поток держит одно долгоживущее соединение (WAL, кэш подготовленных запросов).
+# Одиночные запросы выполняются в autocommit, составные операции — через db_transaction().
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT") or 5)   # секунды ожидания блокировки
+DB_RETRIES = int(os.getenv("DB_RETRIES") or 5)               # повторы при "database is locked"
+DB_CACHED_STATEMENTS = 256
+
+_db_local = threading.local()
+# множество SQL, выполненных через db_*: включается тестом планов запросов (tests/test_query_plans.py)
+executed_queries: Optional[set] = None
+
+def db_connect() -> sqlite3.Connection:
+    """Возвращает соединение текущего потока, при первом обращении открывает и настраивает его."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, isolation_level=None,
+                               cached_statements=DB_CACHED_STATEMENTS)
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+        _db_local.depth = 0
+    return conn
+
+def db_close():
+    """Закрывает соединение текущего потока (при остановке потока/тестах)."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None:
+        try:
+            conn.close()
+        finally:
+            _db_local.conn = None
+            _db_local.depth = 0
+
+def _db_is_busy(e: Exception) -> bool:
+    msg = str(e).lower()
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in msg or "busy" in msg)
+
+def _db_retry(fn, *a):
+    """Выполняет fn с повторами и экспоненциальной паузой, пока БД занята другим писателем."""
+    delay = 0.05
+    for attempt in range(DB_RETRIES):
+        try:
+            return fn(*a)
+        except sqlite3.OperationalError as e:
+            if not _db_is_busy(e) or attempt == DB_RETRIES - 1:
+                raise
+            logger.warning("DB busy, повтор %s/%s через %.2fс", attempt + 1, DB_RETRIES, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+def _db_in_transaction() -> bool:
+    return bool(getattr(_db_local, "depth", 0))
+
+@contextlib.contextmanager
+def db_transaction():
+    """
+    Явная транзакция: все db_execute внутри блока коммитятся один раз в конце.
+    Вложенные блоки присоединяются к внешней транзакции. При исключении — откат.
+    """
+    conn = db_connect()
+    if _db_local.depth:
+        _db_local.depth += 1
+        try:
+            yield conn
+        finally:
+            _db_local.depth -= 1
+        return
+    _db_retry(conn.execute, "BEGIN IMMEDIATE")
+    _db_local.depth = 1
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        _db_retry(conn.commit)
+    finally:
+        _db_local.depth = 0
+
+def _record_query(query: str):
+    if executed_queries is not None:
+        executed_queries.add(query)
+
+def db_execute(query: str, params: tuple = (), fetch: bool = False):
+    t0 = time.perf_counter()
+    _record_query(query)
+    try:
+        cur = _db_retry(db_connect().execute, query, params)
+        if fetch:
+            return cur.fetchall()
+        return True
+    except Exception as e:
+        logger.exception("DB error: %s | query: %s | params: %s", e, query, params)
+        if _db_in_transaction():
+            # внутри транзакции ошибка должна откатить весь блок
+            raise
+        return None
+    finally:
+        m_db_seconds.observe(time.perf_counter() - t0, query_label(query))
+
+def db_insert(query: str, params: tuple = ()) -> Optional[int]:
+    """INSERT, возвращающий id новой строки (None при ошибке)."""
+    t0 = time.perf_counter()
+    _record_query(query)
+    try:
+        cur = _db_retry(db_connect().execute, query, params)
+        return cur.lastrowid
+    except Exception as e:
+        logger.exception("DB error: %s | query: %s | params: %s", e, query, params)
+        if _db_in_transaction():
+            raise
+        return None
+    finally:
+        m_db_seconds.observe(time.perf_counter() - t0, query_label(query))
+
+def db_executemany(query: str, seq_of_params) -> Optional[bool]:
+    t0 = time.perf_counter()
+    _record_query(query)
+    try:
+        _db_retry(db_connect().executemany, query, seq_of_params)
+        return True
+    except Exception as e:
+        logger.exception("DB error: %s | query: %s", e, query)
+        if _db_in_transaction():
+            raise
+        return None
+    finally:
+        m_db_seconds.observe(time.perf_counter() - t0, query_label(query))
+
+def init_db():
+    """Приводит БД к актуальной версии схемы (см. migrations.py)."""
+    conn = db_connect()
+    version = migrations.run_migrations(conn)
+    logger.info("init_db done (schema v%s)", version)
+
+# ----------------- Утилиты VK -----------------
+# Все исходящие сообщения идут через очередь с лимитом запросов (см. outbox.py)
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE") or 15)    # messages.send в секунду (лимит группы — 20 запросов/с)
+VK_RPS = float(os.getenv("VK_RPS") or 20)              # все вызовы API в секунду на группу, делится между шардами
+
+outbox: Optional[Outbox] = None    # создаётся в BotApp.__init__, с долей лимита своего шарда
+
+def safe_send(peer_id: int, text: str, priority: int = PRIORITY_NORMAL, callback=None):
+    try:
+        outbox.send(int(peer_id), str(text), priority=priority, callback=callback)
+    except Exception as e:
+        logger.warning("safe_send failed: %s", e)
+
+def safe_send_with_attachment(peer_id: int, attachments: List[str], text: str = "", priority: int = PRIORITY_NORMAL):
+    try:
+        outbox.send(int(peer_id), str(text), attachment=",".join(attachments), priority=priority)
+    except Exception as e:
+        logger.warning("safe_send_with_attachment failed: %s", e)
+
+# ----------------- Кэш имён пользователей -----------------
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE") or 5000)
+NAME_CACHE_TTL = int(os.getenv("NAME_CACHE_TTL") or 6 * 3600)    # секунды
+NAME_NEGATIVE_TTL = int(os.getenv("NAME_NEGATIVE_TTL") or 600)   # секунды для id, которых нет в ответе users.get
+MENTION_LOOKUP = (os.getenv("MENTION_LOOKUP") or "1") != "0"     # 0 — не ходить в API за именем
+USERS_GET_MAX_IDS = 1000                                          # лимит user_ids в users.get
+
+class NameCache:
+    """LRU с TTL: user_id -> "Имя Фамилия" ("" — имя получить не удалось)."""
+    def __init__(self, maxsize: int = NAME_CACHE_SIZE, ttl: int = NAME_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: int) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(uid)
+            if item is None or item[1] < time.time():
+                if item is not None:
+                    del self._data[uid]
+                self.misses += 1
+                return None
+            self._data.move_to_end(uid)
+            self.hits += 1
+            return item[0]
+
+    def put(self, uid: int, name: str, ttl: Optional[int] = None):
+        with self._lock:
+            self._data[uid] = (name, time.time() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(uid)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+name_cache = NameCache()
+
+def resolve_names(uids) -> dict:
+    """
+    Имена для всех uids: из кэша, а недостающие — одним users.get на каждые USERS_GET_MAX_IDS id.
+    Возвращает {uid: имя} ("" — имя неизвестно).
+    """
+    result = {}
+    missing = []
+    for uid in dict.fromkeys(int(u) for u in uids if u):
+        name = name_cache.get(uid)
+        if name is None:
+            missing.append(uid)
+        else:
+            result[uid] = name
+    result.update(_fetch_names(missing))
+    return result
+
+def _fetch_names(uids: List[int]) -> dict:
+    """
+    users.get для id, которых нет в кэше. "" кэшируется на NAME_NEGATIVE_TTL только для id,
+    которых нет в успешном ответе; при ошибке запроса кэш не трогается (повторим в следующий раз).
+    """
+    result = {}
+    users = [u for u in uids if u > 0]   # отрицательные id — сообщества, users.get их не знает
+    answered = set(uids) - set(users)
+    for i in range(0, len(users), USERS_GET_MAX_IDS):
+        chunk = users[i:i + USERS_GET_MAX_IDS]
+        try:
+            res = vk.users.get(user_ids=",".join(str(u) for u in chunk)) or []
+        except Exception as e:
+            logger.debug("users.get failed: %s", e)
+            continue
+        answered.update(chunk)
+        for n in res:
+            name = f"{n.get('first_name','')} {n.get('last_name','')}".strip()
+            name_cache.put(int(n["id"]), name)
+            result[int(n["id"])] = name
+    for uid in uids:
+        if uid not in result:
+            if uid in answered:
+                name_cache.put(uid, "", NAME_NEGATIVE_TTL)
+            result[uid] = ""
+    return result
+
+def prefetch_names(uids):
+    """Заранее подгружает имена всех, кого упомянет ответ, — дальше mention() берёт их из кэша."""
+    if MENTION_LOOKUP:
+        resolve_names(uids)
+
+def mention(uid: int, lookup: Optional[bool] = None) -> str:
+    """[id|Имя]; при lookup=False (или MENTION_LOOKUP=0) имя не из кэша не запрашивается."""
+    name = name_cache.get(int(uid))
+    if name is None:
+        if lookup is None:
+            lookup = MENTION_LOOKUP
+        if lookup:
+            name = _fetch_names([int(uid)]).get(int(uid))
+    return f"[id{uid}|{name or uid}]"
+
+# чаты, уже записанные в БД: add_chat вызывается на каждое сообщение и не должен писать в файл
+_known_chats = set()
+
+# ----------------- Пакетные вызовы (execute) -----------------
+def vk_execute(code: str) -> dict:
+    return observe_vk_call("execute", vk_session.method, "execute", {"code": code}, raw=True)
+
+def vk_batch_call(calls: List[Tuple[str, dict]], priority: int = PRIORITY_NORMAL) -> List[Tuple[bool, object]]:
+    """До 25 вызовов на HTTP-запрос; каждый запрос берёт токен общего лимитера outbox в своей полосе."""
+    if not calls:
+        return []
+    return execute_batch(vk_execute, calls, before_request=functools.partial(outbox.acquire, priority))
+
+def add_chat(peer_id: int):
+    try:
+        peer_id = int(peer_id)
+        if peer_id in _known_chats:
+            return
+        if db_execute("INSERT OR IGNORE INTO chats (peer_id) VALUES (?)", (peer_id,)):
+            _known_chats.add(peer_id)
+    except Exception:
+        pass
+
+def get_chats() -> List[int]:
+    rows = db_execute("SELECT peer_id FROM chats", fetch=True) or []
+    return [r[0] for r in rows]
+
+# ----------------- Парсинг user id (reply / id / vk.com / @screenname) -----------------
+def parse_user_id(event, args: List[str], fresh: bool = False) -> Optional[int]:
+    """
+    Возвращает user_id:
+    - reply (если ответ)
+    - [id123|..]
+    - просто число
+    - vk.com/id...
+    - @screenname
+    """
+    msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
+    if msg:
+        try:
+            reply = msg.get("reply_message") if isinstance(msg, dict) else getattr(msg, "reply_message", None)
+            if reply:
+                rid = reply.get("from_id") if isinstance(reply, dict) else getattr(reply, "from_id", None)
+                if not rid:
+                    rid = reply.get("user_id") if isinstance(reply, dict) else getattr(reply, "user_id", None)
+                if rid:
+                    return int(rid)
+        except Exception:
+            pass
+    # args
+    if not args:
+        return None
+    uid, screen = parse_user_ref(args[0])
+    if uid is not None:
+        return uid
+    if screen:
+        return resolve_screen_name(screen, fresh=fresh)
+    return None
+
+def parse_user_ids(event, args: List[str], limit: Optional[int] = None) -> List[int]:
+    """Все пользователи команды: reply и каждый аргумент (как в parse_user_id), без повторов."""
+    uids = []
+    first = parse_user_id(event, [])
+    if first:
+        uids.append(first)
+    for a in args:
+        uid, screen = parse_user_ref(a)
+        if uid is None and screen:
+            uid = resolve_screen_name(screen)
+        if uid and uid not in uids:
+            uids.append(uid)
+    return uids[:limit] if limit else uids
+
+_SCREEN_RE = re.compile(r"^[a-z0-9_.]{2,64}$")
+
+def parse_user_ref(ref: str) -> Tuple[Optional[int], Optional[str]]:
+    """
+    Разбор ссылки на пользователя без обращения к API.
+    (user_id, None) — id известен сразу: [id123|..], 123, id123, @id123, vk.com/id123;
+    (None, screen_name) — нужно разрешить короткое имя; (None, None) — не похоже на пользователя.
+    """
+    a = (ref or "").strip()
+    if a.startswith("[id") and "|" in a:
+        try:
+            return int(a[3:a.index("|")]), None
+        except ValueError:
+            pass
+    if a.isdigit():
+        return int(a), None
+    if "vk.com/" in a:
+        a = a.rstrip("/").split("/")[-1].split("?")[0]
+    elif a.startswith("@"):
+        a = a[1:]
+    a = a.lower()
+    if a.startswith("id") and a[2:].isdigit():
+        return int(a[2:]), None
+    if _SCREEN_RE.match(a):
+        return None, a
+    return None, None
+
+# ----------------- Кэш коротких имён (screen name -> id) -----------------
+SCREEN_CACHE_SIZE = int(os.getenv("SCREEN_CACHE_SIZE") or 2000)
+SCREEN_CACHE_TTL = int(os.getenv("SCREEN_CACHE_TTL") or 86400)             # найденные имена
+SCREEN_NEGATIVE_TTL = int(os.getenv("SCREEN_NEGATIVE_TTL") or 3600)        # несуществующие имена
+SCREEN_PURGE_INTERVAL = float(os.getenv("SCREEN_PURGE_INTERVAL") or 3600)  # чистка истёкших строк, секунды
+
+class ScreenNameCache:
+    """
+    Двухуровневый кэш: LRU в памяти + таблица screen_names с TTL (переживает рестарт).
+    Значение None — отрицательный кэш: имя не существует или принадлежит не пользователю.
+    Короткое имя может перейти к другому пользователю, поэтому наказания (fresh=True
+    в resolve_screen_name) кэш не читают, а истёкшие строки таблицы удаляет purge().
+    """
+    _MISS = object()
+
+    def __init__(self, maxsize: int = SCREEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()    # name -> (user_id | None, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _remember(self, name: str, user_id: Optional[int], expires_at: int):
+        with self._lock:
+            self._data[name] = (user_id, expires_at)
+            self._data.move_to_end(name)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get(self, name: str):
+        """user_id, None (известно, что нет) или ScreenNameCache._MISS."""
+        now = int(time.time())
+        with self._lock:
+            item = self._data.get(name)
+            if item is not None and item[1] > now:
+                self._data.move_to_end(name)
+                self.hits += 1
+                return item[0]
+        rows = db_execute("SELECT user_id, expires_at FROM screen_names WHERE name=?", (name,), fetch=True)
+        if rows and rows[0][1] > now:
+            self.db_hits += 1
+            self._remember(name, rows[0][0], rows[0][1])
+            return rows[0][0]
+        self.misses += 1
+        return self._MISS
+
+    def put(self, name: str, user_id: Optional[int]):
+        ttl = SCREEN_CACHE_TTL if user_id is not None else SCREEN_NEGATIVE_TTL
+        expires_at = int(time.time()) + ttl
+        self._remember(name, user_id, expires_at)
+        db_execute("INSERT OR REPLACE INTO screen_names (name, user_id, expires_at) VALUES (?,?,?)", (name, user_id, expires_at))
+
+    def purge(self) -> int:
+        """Удаляет истёкшие строки screen_names; возвращает их число."""
+        now = int(time.time())
+        with self._lock:
+            for name in [n for n, (_, exp) in self._data.items() if exp <= now]:
+                del self._data[name]
+        with db_transaction():
+            db_execute("DELETE FROM screen_names WHERE expires_at<=?", (now,))
+            rows = db_execute("SELECT changes()", fetch=True)
+        return rows[0][0] if rows else 0
+
+screen_cache = ScreenNameCache()
+
+def purge_screen_names(payloads=None) -> int:
+    """Обработчик планировщика: чистка screen_names, затем повтор через SCREEN_PURGE_INTERVAL."""
+    try:
+        removed = screen_cache.purge()
+        if removed:
+            logger.info("Удалено истёкших коротких имён: %s", removed)
+        return removed
+    finally:
+        if payloads is not None:
+            expiry_scheduler.schedule(time.time() + SCREEN_PURGE_INTERVAL, "screen_names_purge", None)
+
+def resolve_screen_name(name: str, fresh: bool = False) -> Optional[int]:
+    """
+    Короткое имя -> id пользователя. fresh=True — для наказаний: кэш не читается,
+    имя разрешается заново (ответ кэшируется); при ошибке API — None, а не старое значение.
+    """
+    name = name.lower()
+    if not fresh:
+        cached = screen_cache.get(name)
+        if cached is not ScreenNameCache._MISS:
+            return cached
+    try:
+        res = vk.utils.resolveScreenName(screen_name=name)
+    except Exception as e:
+        # сетевые/временные ошибки не кэшируем
+        logger.debug("resolveScreenName %s failed: %s", name, e)
+        return None
+    uid = None
+    if isinstance(res, dict) and res.get("type") == "user" and res.get("object_id"):
+        uid = int(res["object_id"])
+    screen_cache.put(name, uid)
+    return uid
+
+# ----------------- Кэш ролей -----------------
+ROLE_RELOAD_BACKOFF = 5.0    # секунды между попытками загрузить кэш после ошибки БД
+class RoleCache:
+    """
+    Все роли в памяти: (user_id, peer_id) -> роль, peer_id=0 — глобальная роль.
+    Загружается при старте и обновляется на запись (set_role_db / remove_roles_db / wipe),
+    поэтому проверка прав не обращается к БД: отсутствие записи — тоже ответ кэша (роль "user").
+    Промах — проверка, когда кэш не загружен; повторная загрузка после ошибки — не чаще
+    раза в ROLE_RELOAD_BACKOFF секунд, до неё действует роль по умолчанию.
+    """
+    def __init__(self):
+        self._roles = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+        self._retry_at = 0.0
+        self.hits = 0      # ответ из загруженного кэша
+        self.misses = 0    # кэш не загружен: загрузка из БД или роль по умолчанию
+
+    def load(self) -> bool:
+        rows = db_execute("SELECT user_id, peer_id, role FROM roles ORDER BY id ASC", fetch=True)
+        if rows is None:
+            self._retry_at = time.monotonic() + ROLE_RELOAD_BACKOFF
+            return False
+        roles = {}
+        for uid, peer, role in rows:
+            roles[(int(uid), int(peer or 0))] = role  # последняя запись побеждает, как ORDER BY id DESC LIMIT 1
+        with self._lock:
+            self._roles = roles
+            self.loaded = True
+        logger.info("Кэш ролей загружен: %s записей", len(roles))
+        return True
+
+    def get(self, user_id: int, peer_id: int) -> Optional[str]:
+        if not self.loaded:
+            self.misses += 1
+            if time.monotonic() < self._retry_at or not self.load():
+                return None
+        else:
+            self.hits += 1
+        roles = self._roles
+        role = roles.get((user_id, peer_id))
+        if role is None and peer_id != 0:
+            role = roles.get((user_id, 0))
+        return role
+
+    def set(self, user_id: int, peer_id: int, role: str):
+        with self._lock:
+            self._roles[(int(user_id), int(peer_id))] = role
+
+    def remove(self, user_id: int, peer_id: Optional[int] = None):
+        user_id = int(user_id)
+        with self._lock:
+            if peer_id is None:
+                for key in [k for k in self._roles if k[0] == user_id]:
+                    del self._roles[key]
+            else:
+                self._roles.pop((user_id, int(peer_id)), None)
+
+    def clear(self):
+        with self._lock:
+            self._roles = {}
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._roles), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": (self.hits / total) if total else 0.0}
+
+role_cache = RoleCache()
+
+# ----------------- Роли — запись, чтение, удаление -----------------
+def set_role_db(user_id: int, role: str, peer_id: Optional[int] = None):
+    if peer_id is None:
+        peer_id = 0
+    try:
+        with db_transaction():
+            db_execute("DELETE FROM roles WHERE user_id=? AND peer_id=?", (user_id, peer_id))
+            db_execute("INSERT INTO roles (user_id, role, peer_id) VALUES (?,?,?)", (user_id, role, peer_id))
+    except Exception:
+        return None
+    role_cache.set(user_id, peer_id, role)
+    publish_change("role_set", int(user_id), int(peer_id), role)
+    return True
+
+def remove_roles_db(user_id: int, peer_id: Optional[int] = None):
+    if peer_id is None:
+        res = db_execute("DELETE FROM roles WHERE user_id=?", (user_id,))
+    else:
+        res = db_execute("DELETE FROM roles WHERE user_id=? AND peer_id=?", (user_id, peer_id))
+    if res:
+        role_cache.remove(user_id, peer_id)
+        publish_change("roles_removed", int(user_id), peer_id)
+    return res
+
+def get_role_db(user_id: int, peer_id: Optional[int] = None) -> str:
+    if OWNER_ID and int(user_id) == int(OWNER_ID):
+        return "owner"
+    if peer_id is None:
+        peer_id = 0
+    return role_cache.get(int(user_id), int(peer_id)) or "user"
+
+# ----------------- Счётчики наказаний -----------------
+# punishment_counts: (user_id, peer_id, kind) -> выдано / действует / истекло (снято вручную = остаток).
+# Кроме строк по беседам есть итоги: peer_id = COUNT_ALL — по всем беседам пользователя,
+# user_id = peer_id = COUNT_ALL — по всем пользователям. Счётчики меняются в той же транзакции,
+# что и строки warns/mutes/bans, поэтому проверка порога и /info не перечитывают историю.
+COUNT_ALL = -1
+PUNISHMENT_KINDS = ("warn", "mute", "ban")
+PunishmentCount = namedtuple("PunishmentCount", "issued active expired")
+NO_PUNISHMENTS = PunishmentCount(0, 0, 0)
+
+_COUNT_UPSERT = ("INSERT INTO punishment_counts (user_id, peer_id, kind, issued, active, expired) VALUES (?,?,?,?,?,?) "
+                 "ON CONFLICT(user_id, peer_id, kind) DO UPDATE SET issued=issued+excluded.issued, "
+                 "active=active+excluded.active, expired=expired+excluded.expired")
+
+def bump_counts(kind: str, changes):
+    """changes: [(user_id, peer_id, +выдано, +действует, +истекло)]; вызывается внутри db_transaction."""
+    agg = {}
+    for uid, peer, d_issued, d_active, d_expired in changes:
+        for key in ((int(uid), int(peer or 0)), (int(uid), COUNT_ALL), (COUNT_ALL, COUNT_ALL)):
+            i, a, e = agg.get(key, (0, 0, 0))
+            agg[key] = (i + d_issued, a + d_active, e + d_expired)
+    if agg:
+        db_executemany(_COUNT_UPSERT, [(u, p, kind, i, a, e) for (u, p), (i, a, e) in agg.items()])
+
+def get_counts(user_id: int, peer_id: int = COUNT_ALL) -> dict:
+    """kind -> PunishmentCount для пользователя в беседе (по умолчанию — по всем беседам); один поиск по ключу."""
+    rows = db_execute("SELECT kind, issued, active, expired FROM punishment_counts WHERE user_id=? AND peer_id=?",
+                      (int(user_id), int(peer_id)), fetch=True) or []
+    counts = dict.fromkeys(PUNISHMENT_KINDS, NO_PUNISHMENTS)
+    counts.update({r[0]: PunishmentCount(*r[1:]) for r in rows})
+    return counts
+
+def _removed_by_peer(table: str, where: str, params: tuple) -> list:
+    """[(user_id, peer_id, 0, -n, 0)] для строк, которые сейчас будут удалены (снятие вручную)."""
+    rows = db_execute(f"SELECT user_id, peer_id, COUNT(*) FROM {table} WHERE {where} GROUP BY user_id, peer_id",
+                      params, fetch=True) or []
+    return [(uid, peer, 0, -n, 0) for uid, peer, n in rows]
+
+# ----------------- Warns / Mutes / Bans -----------------
+def add_warn_db(user_id: int, issued_by: int, reason: str, peer_id: int):
+    ts = datetime.datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") if False else None  # placeholder (overwritten)
+def add_warn_db(user_id: int, issued_by: int, reason: str, peer_id: int):
+    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        with db_transaction():
+            db_execute("INSERT INTO warns (user_id, issued_by, reason, timestamp, peer_id) VALUES (?,?,?,?,?)", (user_id, issued_by, reason, ts, peer_id))
+            bump_counts("warn", [(user_id, peer_id, 1, 1, 0)])
+        return True
+    except Exception:
+        return None
+
+def get_warns_db(user_id: int):
+    rows = db_execute("SELECT id, issued_by, reason, timestamp, peer_id FROM warns WHERE user_id=? ORDER BY id ASC", (user_id,), fetch=True) or []
+    return rows
+
+def remove_last_warn_db(user_id: int):
+    try:
+        with db_transaction():
+            rows = db_execute("SELECT id, peer_id FROM warns WHERE user_id=? ORDER BY id DESC LIMIT 1", (user_id,), fetch=True) or []
+            if not rows:
+                return None
+            wid, peer_id = rows[0]
+            bump_counts("warn", [(user_id, peer_id, 0, -1, 0)])
+            return db_execute("DELETE FROM warns WHERE id=?", (wid,))
+    except Exception:
+        return None
+
+def add_mute_db(user_id: int, issued_by: int, minutes: int, reason: str, peer_id: int):
+    until_dt = datetime.datetime.now().replace(microsecond=0) + datetime.timedelta(minutes=minutes)
+    until = until_dt.strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        with db_transaction():
+            mute_id = db_insert("INSERT INTO mutes (user_id, issued_by, until, reason, peer_id) VALUES (?,?,?,?,?)", (user_id, issued_by, until, reason, peer_id))
+            bump_counts("mute", [(user_id, peer_id, 1, 1, 0)])
+    except Exception:
+        return None
+    mute_index.add(user_id, peer_id, int(until_dt.timestamp()))
+    expiry_scheduler.schedule(until_dt.timestamp(), "mute", mute_id)
+    return True
+
+def get_mutes_db(user_id: int):
+    rows = db_execute("SELECT id, user_id, issued_by, until, reason, peer_id FROM mutes WHERE user_id=?", (user_id,), fetch=True) or []
+    return rows
+
+def delete_mute_db(mute_id: int):
+    try:
+        with db_transaction():
+            bump_counts("mute", _removed_by_peer("mutes", "id=?", (mute_id,)))
+            return db_execute("DELETE FROM mutes WHERE id=?", (mute_id,))
+    except Exception:
+        return None
+
+def delete_mutes_for_user_in_peer_db(user_id: int, peer_id: int):
+    try:
+        with db_transaction():
+            bump_counts("mute", _removed_by_peer("mutes", "user_id=? AND peer_id=?", (user_id, peer_id)))
+            res = db_execute("DELETE FROM mutes WHERE user_id=? AND peer_id=?", (user_id, peer_id))
+    except Exception:
+        return None
+    if res:
+        mute_index.remove(user_id, peer_id)
+    return res
+
+# ----------------- Журнал модерации -----------------
+AUDIT_BATCH = int(os.getenv("AUDIT_BATCH") or 100)                          # записей в одной транзакции
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL") or 1.0)      # секунды
+AUDIT_COLUMNS = ("id", "ts", "action", "actor_id", "target_id", "peer_id", "reason", "details")
+
+class AuditLog:
+    """
+    Единый журнал действий модерации (таблица audit_log, только дописывается).
+    record() кладёт запись в буфер; фоновый поток пишет буфер пачкой в одной транзакции
+    раз в AUDIT_FLUSH_INTERVAL или сразу при AUDIT_BATCH записях.
+    """
+    def __init__(self, batch: int = AUDIT_BATCH, interval: float = AUDIT_FLUSH_INTERVAL):
+        self.batch = batch
+        self.interval = interval
+        self._buf = []
+        self._writing = []                     # пачка, которая сейчас пишется в БД
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()    # одна запись пачки за раз
+        self._wake = threading.Event()
+        self.running = False
+        self.written = 0
+        self.batches = 0
+
+    def record(self, action: str, actor: Optional[int] = None, target: Optional[int] = None, peer_id: int = 0,
+               reason: Optional[str] = None, **details):
+        row = (int(time.time()), action, actor, target, int(peer_id or 0), reason,
+               json.dumps(details, ensure_ascii=False) if details else None)
+        with self._lock:
+            self._buf.append(row)
+            full = len(self._buf) >= self.batch
+        if full:
+            if self.running:
+                self._wake.set()
+            else:
+                self.flush()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buf = self._buf, []
+                self._writing = rows
+            if not rows:
+                return 0
+            try:
+                with db_transaction():
+                    db_executemany("INSERT INTO audit_log (ts, action, actor_id, target_id, peer_id, reason, details) "
+                                   "VALUES (?,?,?,?,?,?,?)", rows)
+            except Exception as e:
+                logger.warning("audit flush failed (%s записей вернутся в буфер): %s", len(rows), e)
+                with self._lock:
+                    self._buf[:0] = rows
+                    self._writing = []
+                return 0
+            with self._lock:
+                self._writing = []
+            self.written += len(rows)
+            self.batches += 1
+            return len(rows)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._buf)
+
+    def buffered(self, targets) -> list:
+        """
+        Записи о пользователях targets, которые ещё не точно в БД (буфер и пишущаяся пачка),
+        от старых к новым: (ts, action, actor, target, peer, reason, details).
+        """
+        targets = set(targets)
+        with self._lock:
+            return [r for r in self._writing + self._buf if r[3] in targets]
+
+    def run(self):
+        self.running = True
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+audit_log = AuditLog()
+audit = audit_log.record
+
+def audit_rows(actor: Optional[int] = None, target: Optional[int] = None, peer_id: Optional[int] = None,
+               action: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+               chunk: int = 500):
+    """Записи журнала по фильтру, от новых к старым; курсор читается порциями, в память всё не грузится."""
+    audit_log.flush()
+    where, params = [], []
+    for col, value in (("actor_id", actor), ("target_id", target), ("peer_id", peer_id), ("action", action)):
+        if value is not None:
+            where.append(f"{col}=?")
+            params.append(value)
+    if since is not None:
+        where.append("ts>=?")
+        params.append(int(since))
+    if until is not None:
+        where.append("ts<=?")
+        params.append(int(until))
+    sql = f"SELECT {', '.join(AUDIT_COLUMNS)} FROM audit_log"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    # отдельное соединение: экспорт не держит курсор на соединении потока, где идут записи
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+    try:
+        cur = conn.execute(sql + " ORDER BY ts DESC, id DESC", params)
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+def export_audit(dest_dir: str = "audit_export", fmt: str = "csv", **filters) -> Tuple[Optional[str], int]:
+    """Потоковая выгрузка журнала в .csv.gz / .jsonl.gz. Возвращает (файл или None, если пусто; число записей)."""
+    os.makedirs(dest_dir, exist_ok=True)
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    dst = os.path.join(dest_dir, f"moder_bot_audit_{ts}.{fmt}.gz")
+    n = 1
+    while os.path.exists(dst):
+        n += 1
+        dst = os.path.join(dest_dir, f"moder_bot_audit_{ts}_{n}.{fmt}.gz")
+    count = 0
+    with gzip.open(dst, "wt", encoding="utf-8", newline="") as f:
+        writer = None
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(AUDIT_COLUMNS + ("time",))
+        for row in audit_rows(**filters):
+            when = datetime.datetime.fromtimestamp(row[1]).strftime("%Y-%m-%d %H:%M:%S")
+            if writer:
+                writer.writerow(row + (when,))
+            else:
+                item = dict(zip(AUDIT_COLUMNS, row), time=when)
+                item["details"] = json.loads(item["details"]) if item["details"] else None
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            count += 1
+    if not count:
+        os.remove(dst)
+        return None, 0
+    return dst, count
+
+# ----------------- Индекс активных мутов -----------------
+def parse_db_ts(s: str) -> Optional[int]:
+    """'%Y-%m-%d %H:%M:%S' (локальное время, как пишет бот) -> epoch-секунды."""
+    try:
+        return int(datetime.datetime.strptime(s, "%Y-%m-%d %H:%M:%S").timestamp())
+    except Exception:
+        return None
+
+class MuteIndex:
+    """
+    Активные муты в памяти: user_id -> {peer_id: окончание (epoch)}; peer_id=0 — мут во всех беседах.
+    Для пользователя без мута проверка — один поиск в словаре, без БД и разбора дат.
+    """
+    def __init__(self):
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        rows = db_execute("SELECT user_id, peer_id, until FROM mutes", fetch=True)
+        if rows is None:
+            return
+        now = time.time()
+        by_user = {}
+        for uid, peer, until_s in rows:
+            until = parse_db_ts(until_s)
+            if until is None or until <= now:
+                continue
+            peers = by_user.setdefault(int(uid), {})
+            key = int(peer or 0)
+            peers[key] = max(until, peers.get(key, 0))
+        with self._lock:
+            self._by_user = by_user
+        logger.info("Индекс мутов загружен: %s пользователей с активным мутом", len(by_user))
+
+    def add(self, user_id: int, peer_id: int, until: int):
+        with self._lock:
+            peers = self._by_user.setdefault(int(user_id), {})
+            key = int(peer_id or 0)
+            peers[key] = max(until, peers.get(key, 0))
+
+    def remove(self, user_id: int, peer_id: int):
+        with self._lock:
+            peers = self._by_user.get(int(user_id))
+            if peers is not None:
+                peers.pop(int(peer_id or 0), None)
+                if not peers:
+                    del self._by_user[int(user_id)]
+
+    def expire(self, user_id: int, peer_id: int, until: int):
+        """Снимает запись, только если за это время не выдали более длинный мут."""
+        with self._lock:
+            peers = self._by_user.get(int(user_id))
+            key = int(peer_id or 0)
+            if peers is not None and peers.get(key, 0) <= until:
+                peers.pop(key, None)
+                if not peers:
+                    del self._by_user[int(user_id)]
+
+    def is_muted(self, user_id: int, peer_id: int) -> bool:
+        peers = self._by_user.get(user_id)
+        if not peers:
+            return False
+        now = time.time()
+        until = max(peers.get(peer_id, 0), peers.get(0, 0))
+        return until > now
+
+    def clear(self):
+        with self._lock:
+            self._by_user = {}
+
+mute_index = MuteIndex()
+
+def add_blacklist_db(word: str):
+    res = db_execute("INSERT OR IGNORE INTO blacklist (word) VALUES (?)", (word.lower(),))
+    invalidate_blacklist_matcher()
+    publish_change("blacklist")
+    return res
+
+def remove_blacklist_db(word: str):
+    res = db_execute("DELETE FROM blacklist WHERE word=?", (word.lower(),))
+    invalidate_blacklist_matcher()
+    publish_change("blacklist")
+    return res
+
+def get_blacklist_db() -> List[str]:
+    rows = db_execute("SELECT word FROM blacklist", fetch=True) or []
+    return [r[0] for r in rows]
+
+# Скомпилированный ЧС: строится один раз и пересобирается только после изменения списка.
+# Поколение растёт при каждом изменении: сборка, во время которой список поменялся,
+# не сохраняется (она могла прочитать старый список) и повторяется.
+_blacklist_matcher: Optional[AhoCorasick] = None
+_blacklist_generation = 0
+_blacklist_lock = threading.Lock()        # одна сборка за раз
+_blacklist_gen_lock = threading.Lock()    # поколение и сохранение результата
+
+def invalidate_blacklist_matcher():
+    global _blacklist_matcher, _blacklist_generation
+    with _blacklist_gen_lock:
+        _blacklist_generation += 1
+        _blacklist_matcher = None
+
+def get_blacklist_matcher() -> AhoCorasick:
+    global _blacklist_matcher
+    matcher = _blacklist_matcher
+    if matcher is not None:
+        return matcher
+    with _blacklist_lock:
+        while True:
+            with _blacklist_gen_lock:
+                if _blacklist_matcher is not None:
+                    return _blacklist_matcher
+                generation = _blacklist_generation
+            t0 = time.perf_counter()
+            matcher = AhoCorasick(get_blacklist_db())
+            with _blacklist_gen_lock:
+                if generation == _blacklist_generation:
+                    _blacklist_matcher = matcher
+                    logger.info("ЧС скомпилирован: %s слов за %.1f мс", len(matcher), (time.perf_counter() - t0) * 1000)
+                    return matcher
+
+def add_ban_db(user_id: int, issued_by: int, reason: str, peer_id: int = 0):
+    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        with db_transaction():
+            db_execute("INSERT INTO bans (user_id, issued_by, until, reason, peer_id) VALUES (?,?,?,?,?)", (user_id, issued_by, ts, reason, peer_id))
+            bump_counts("ban", [(user_id, peer_id, 1, 1, 0)])
+        return True
+    except Exception:
+        return None
+
+def remove_bans_db(user_id: int, peer_id: Optional[int] = None):
+    where, params = ("user_id=?", (user_id,)) if peer_id is None else ("user_id=? AND peer_id=?", (user_id, peer_id))
+    try:
+        with db_transaction():
+            bump_counts("ban", _removed_by_peer("bans", where, params))
+            return db_execute(f"DELETE FROM bans WHERE {where}", params)
+    except Exception:
+        return None
+
+def get_bans_db(user_id: int):
+    rows = db_execute("SELECT id, issued_by, until, reason, peer_id FROM bans WHERE user_id=?", (user_id,), fetch=True) or []
+    return rows
+
+# ----------------- Утилиты чата (кик/добавление) -----------------
+# ----------------- Кэш участников бесед -----------------
+MEMBERS_PAGE = 200    # максимум count в messages.getConversationMembers
+
+class MembershipCache:
+    """
+    Участники бесед: peer_id -> set(user_id). Беседа попадает в кэш после полной синхронизации
+    через messages.getConversationMembers и дальше поддерживается событиями
+    (приглашение, кик, выход, сообщения участников). Для несинхронизированных бесед
+    (бот без прав администратора и т.п.) состав неизвестен — туда кик пробуем как раньше.
+    Пока беседа синхронизируется, входы и выходы пишутся в журнал и применяются поверх
+    загруженного состава — иначе вошедший во время sync выпал бы из кэша и бан его пропустил бы.
+    """
+    def __init__(self):
+        self._members = {}
+        self._journal = {}      # peer_id -> [(вошёл?, user_id)] событий во время синхронизации
+        self._lock = threading.Lock()
+        self.kicks_saved = 0    # вызовов removeChatUser, которых удалось избежать
+
+    def is_synced(self, peer_id: int) -> bool:
+        return int(peer_id) in self._members
+
+    def begin_sync(self, peers: List[int]):
+        with self._lock:
+            for p in peers:
+                self._journal[int(p)] = []
+
+    def set_members(self, peer_id: int, members):
+        peer_id = int(peer_id)
+        members = set(int(m) for m in members)
+        with self._lock:
+            for joined, user_id in self._journal.pop(peer_id, ()):
+                if joined:
+                    members.add(user_id)
+                else:
+                    members.discard(user_id)
+            self._members[peer_id] = members
+
+    def add(self, peer_id: int, user_id: int) -> bool:
+        """True — пользователя в кэше беседы не было (или беседа сейчас синхронизируется)."""
+        peer_id, user_id = int(peer_id), int(user_id)
+        with self._lock:
+            journal = self._journal.get(peer_id)
+            if journal is not None:
+                journal.append((True, user_id))
+            members = self._members.get(peer_id)
+            if members is None:
+                return journal is not None
+            if user_id in members:
+                return False
+            members.add(user_id)
+        return True
+
+    def remove(self, peer_id: int, user_id: int) -> bool:
+        """True — пользователь был в кэше беседы (или беседа сейчас синхронизируется)."""
+        peer_id, user_id = int(peer_id), int(user_id)
+        with self._lock:
+            journal = self._journal.get(peer_id)
+            if journal is not None:
+                journal.append((False, user_id))
+            members = self._members.get(peer_id)
+            if members is None:
+                return journal is not None
+            if user_id not in members:
+                return False
+            members.discard(user_id)
+        return True
+
+    def forget(self, peer_id: Optional[int] = None):
+        with self._lock:
+            if peer_id is None:
+                self._members = {}
+                self._journal = {}
+            else:
+                self._members.pop(int(peer_id), None)
+                self._journal.pop(int(peer_id), None)
+
+    def kick_targets(self, user_id: int, peers: List[int]) -> List[int]:
+        """Беседы, где пользователь есть (или состав неизвестен)."""
+        user_id = int(user_id)
+        targets = []
+        for p in peers:
+            members = self._members.get(int(p))
+            if members is None or user_id in members:
+                targets.append(p)
+        return targets
+
+    def sync(self, peers: Optional[List[int]] = None) -> Tuple[int, int]:
+        """Полная синхронизация: первая страница всех бесед пачками через execute, дальше — дозагрузка."""
+        peers = [int(p) for p in (peers if peers is not None else get_chats()) if int(p) >= 2000000000]
+        calls = [("messages.getConversationMembers", {"peer_id": p, "count": MEMBERS_PAGE}) for p in peers]
+        synced = failed = 0
+        self.begin_sync(peers)
+        for p, (ok, res) in zip(peers, vk_batch_call(calls)):
+            if not ok or not isinstance(res, dict):
+                failed += 1
+                self.forget(p)
+                continue
+            members = [it.get("member_id") for it in res.get("items", [])]
+            total = int(res.get("count") or 0)
+            offset = MEMBERS_PAGE
+            try:
+                while offset < total:
+                    page = vk.messages.getConversationMembers(peer_id=p, count=MEMBERS_PAGE, offset=offset)
+                    members.extend(it.get("member_id") for it in page.get("items", []))
+                    offset += MEMBERS_PAGE
+            except Exception as e:
+                logger.debug("getConversationMembers %s offset %s failed: %s", p, offset, e)
+                failed += 1
+                self.forget(p)
+                continue
+            self.set_members(p, [m for m in members if m])
+            synced += 1
+        logger.info("Синхронизация участников: %s бесед, ошибок: %s", synced, failed)
+        return synced, failed
+
+membership = MembershipCache()
+
+def member_joined(peer_id: int, user_id: int):
+    if membership.add(peer_id, user_id):
+        publish_change("member_joined", int(peer_id), int(user_id))
+
+def member_left(peer_id: int, user_id: int):
+    if membership.remove(peer_id, user_id):
+        publish_change("member_left", int(peer_id), int(user_id))
+
+def kick_from_chat_peer(peer_peer_id: int, user_id: int) -> bool:
+    try:
+        if int(peer_peer_id) < 2000000000:
+            return False
+        chat_id = int(peer_peer_id) - 2000000000
+        vk.messages.removeChatUser(chat_id=chat_id, user_id=user_id)
+        member_left(peer_peer_id, user_id)
+        return True
+    except Exception as e:
+        logger.debug("kick_from_chat_peer failed: %s", e)
+        return False
+
+def add_user_to_chat(peer_peer_id: int, user_id: int) -> bool:
+    try:
+        if int(peer_peer_id) < 2000000000:
+            return False
+        chat_id = int(peer_peer_id) - 2000000000
+        try:
+            vk.messages.addChatUser(chat_id=chat_id, user_id=user_id)
+            return True
+        except Exception:
+            return False
+    except Exception as e:
+        logger.debug("add_user_to_chat failed: %s", e)
+        return False
+
+def global_kick_user(user_id: int) -> Tuple[List[Tuple[int, bool]], int]:
+    """
+    Кикает пользователя из всех бесед, где он состоит (по кэшу участников).
+    Возвращает ([(peer_id, ok)] по бесед, где пробовали, сколько бесед пропущено).
+    """
+    chats = [p for p in get_chats() if int(p) >= 2000000000]
+    targets = membership.kick_targets(user_id, chats)
+    skipped = len(chats) - len(targets)
+    membership.kicks_saved += skipped
+    calls = [("messages.removeChatUser", {"chat_id": int(p) - 2000000000, "user_id": int(user_id)}) for p in targets]
+    results = []
+    for p, (ok, err) in zip(targets, vk_batch_call(calls)):
+        if ok or getattr(err, "code", None) == 935:   # 935 — пользователя нет в беседе
+            member_left(p, user_id)
+        results.append((p, ok))
+    return results, skipped
+
+# ----------------- Рассылки (/gzov) -----------------
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY") or 2)   # одновременных execute-пачек
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_PROGRESS_EVERY = 30    # секунд между отчётами о прогрессе
+BROADCAST_DB_ATTEMPTS = 5        # попыток записать итог пачки в БД
+BROADCAST_RESUME_DELAY = 60.0    # через сколько секунд перезапустить упавшее задание
+BROADCAST_MAX_RESUMES = 5        # после стольких падений подряд задание помечается failed
+
+class BroadcastEngine:
+    """
+    Рассылка — задание в broadcast_jobs с состоянием доставки по каждой беседе
+    в broadcast_deliveries. Доставка идёт пачками execute (по 25 бесед) с ограниченной
+    параллельностью под общим лимитером API. После рестарта незавершённые задания
+    продолжаются с недоставленных бесед; random_id детерминирован (задание+беседа),
+    поэтому повторная отправка уже ушедшего сообщения VK отбросит.
+    Если поток задания упал (например, БД недоступна), задание остаётся running
+    и перезапускается через BROADCAST_RESUME_DELAY; после BROADCAST_MAX_RESUMES
+    падений подряд — помечается failed.
+    """
+    def __init__(self, concurrency: int = BROADCAST_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="broadcast")
+        self._running = set()
+        self._crashes = {}      # job_id -> падений подряд
+        self._lock = threading.Lock()
+
+    def create(self, author_id: int, origin_peer: int, message: str, peers: List[int]) -> Optional[int]:
+        ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            with db_transaction():
+                job_id = db_insert("INSERT INTO broadcast_jobs (author_id, origin_peer, message, status, created_at) VALUES (?,?,?,'running',?)",
+                                   (author_id, origin_peer, message, ts))
+                db_executemany("INSERT OR IGNORE INTO broadcast_deliveries (job_id, peer_id) VALUES (?,?)",
+                               [(job_id, int(p)) for p in peers])
+        except Exception:
+            return None
+        self.start(job_id)
+        return job_id
+
+    def start(self, job_id: int):
+        with self._lock:
+            if job_id in self._running:
+                return
+            self._running.add(job_id)
+        threading.Thread(target=self._run, args=(job_id,), name=f"broadcast-{job_id}", daemon=True).start()
+
+    def resume_all(self):
+        rows = db_execute("SELECT id FROM broadcast_jobs WHERE status='running'", fetch=True) or []
+        for (job_id,) in rows:
+            logger.info("Рассылка #%s: продолжаем после перезапуска", job_id)
+            self.start(job_id)
+
+    def status(self, job_id: int) -> Optional[dict]:
+        job = db_execute("SELECT id, author_id, origin_peer, status, created_at, finished_at FROM broadcast_jobs WHERE id=?", (job_id,), fetch=True)
+        if not job:
+            return None
+        counts = dict(db_execute("SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id=? GROUP BY status", (job_id,), fetch=True) or [])
+        jid, author, origin, status, created, finished = job[0]
+        return {"id": jid, "author_id": author, "origin_peer": origin, "status": status, "created_at": created,
+                "finished_at": finished, "pending": counts.get("pending", 0), "sent": counts.get("sent", 0),
+                "failed": counts.get("failed", 0)}
+
+    def running_jobs(self) -> List[int]:
+        rows = db_execute("SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id", fetch=True) or []
+        return [r[0] for r in rows]
+
+    @staticmethod
+    def _random_id(job_id: int, peer_id: int) -> int:
+        return (job_id * 1000003 + peer_id) % (2**31 - 1) + 1
+
+    def _deliver_chunk(self, job_id: int, message: str, chunk: List[Tuple[int, int]]) -> List[tuple]:
+        calls = [("messages.send", {"peer_id": p, "message": message, "random_id": self._random_id(job_id, p)}) for p, _ in chunk]
+        updates = []
+        for (p, attempts), (ok, res) in zip(chunk, vk_batch_call(calls, PRIORITY_LOW)):
+            if ok:
+                updates.append(("sent", attempts + 1, None, job_id, p))
+                continue
+            code = getattr(res, "code", None)
+            retry = (code is None or code in RETRY_CODES) and attempts + 1 < BROADCAST_MAX_ATTEMPTS
+            updates.append(("pending" if retry else "failed", attempts + 1, str(res)[:200], job_id, p))
+        return updates
+
+    def _save(self, updates: List[tuple]):
+        """Итог пачки — в БД; при ошибке повторяем с паузой, сообщения уже ушли."""
+        for attempt in range(BROADCAST_DB_ATTEMPTS):
+            try:
+                with db_transaction():
+                    db_executemany("UPDATE broadcast_deliveries SET status=?, attempts=?, error=? WHERE job_id=? AND peer_id=?", updates)
+                return
+            except Exception as e:
+                if attempt + 1 == BROADCAST_DB_ATTEMPTS:
+                    raise
+                logger.warning("broadcast: не удалось сохранить доставку (%s), повтор %s", e, attempt + 1)
+                time.sleep(min(2 ** attempt, 30))
+
+    def _crashed(self, job_id: int):
+        """Поток задания упал: перезапуск позже или, если падает постоянно, — статус failed."""
+        with self._lock:
+            crashes = self._crashes[job_id] = self._crashes.get(job_id, 0) + 1
+        if crashes < BROADCAST_MAX_RESUMES:
+            logger.warning("Рассылка #%s: перезапуск через %.0fс (падение %s)", job_id, BROADCAST_RESUME_DELAY, crashes)
+            timer = threading.Timer(BROADCAST_RESUME_DELAY, self.start, (job_id,))
+            timer.daemon = True
+            timer.start()
+            return
+        with self._lock:
+            self._crashes.pop(job_id, None)
+        ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        db_execute("UPDATE broadcast_jobs SET status='failed', finished_at=? WHERE id=? AND status='running'", (ts, job_id))
+        job = db_execute("SELECT origin_peer FROM broadcast_jobs WHERE id=?", (job_id,), fetch=True)
+        if job and job[0][0]:
+            safe_send(job[0][0], f"❌ Рассылка #{job_id} остановлена после {crashes} ошибок подряд, см. лог.")
+
+    def _run(self, job_id: int):
+        crashed = False
+        try:
+            job = db_execute("SELECT message, origin_peer FROM broadcast_jobs WHERE id=?", (job_id,), fetch=True)
+            if not job:
+                return
+            message, origin = job[0]
+            last_report = time.time()
+            while True:
+                batch = db_execute("SELECT peer_id, attempts FROM broadcast_deliveries WHERE job_id=? AND status='pending' LIMIT ?",
+                                   (job_id, EXECUTE_MAX_CALLS * self.concurrency), fetch=True)
+                if batch is None:
+                    time.sleep(5)
+                    continue
+                if not batch:
+                    break
+                chunks = [batch[i:i + EXECUTE_MAX_CALLS] for i in range(0, len(batch), EXECUTE_MAX_CALLS)]
+                updates = []
+                for res in self._pool.map(lambda c: self._deliver_chunk(job_id, message, c), chunks):
+                    updates.extend(res)
+                self._save(updates)
+                with self._lock:
+                    self._crashes.pop(job_id, None)
+                if any(u[0] == "pending" for u in updates):
+                    time.sleep(1)   # временные ошибки — даём API передохнуть перед повтором
+                if origin and time.time() - last_report >= BROADCAST_PROGRESS_EVERY:
+                    last_report = time.time()
+                    st = self.status(job_id)
+                    safe_send(origin, f"📨 Рассылка #{job_id}: доставлено {st['sent']}, ошибок {st['failed']}, осталось {st['pending']}.")
+            st = self.status(job_id)
+            ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            db_execute("UPDATE broadcast_jobs SET status='done', finished_at=? WHERE id=?", (ts, job_id))
+            failed_rows = db_execute("SELECT peer_id, error FROM broadcast_deliveries WHERE job_id=? AND status='failed' LIMIT 10", (job_id,), fetch=True) or []
+            text = f"✅ Рассылка #{job_id} завершена: доставлено {st['sent']}/{st['sent'] + st['failed']}."
+            if failed_rows:
+                text += "\nНе доставлено:\n" + "\n".join(f"- {p}: {err}" for p, err in failed_rows)
+                if st["failed"] > len(failed_rows):
+                    text += f"\n…и ещё {st['failed'] - len(failed_rows)}"
+            if origin:
+                safe_send(origin, text)
+        except Exception as e:
+            logger.exception("broadcast #%s error: %s", job_id, e)
+            crashed = True
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+        if crashed:
+            self._crashed(job_id)
+
+broadcasts: Optional[BroadcastEngine] = None    # создаётся в BotApp.__init__
+
+# ----------------- Blacklist enforcement -----------------
+def handle_blacklist_on_message(event):
+    try:
+        msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
+        if not msg:
+            return False
+        peer_id = msg.get("peer_id") if isinstance(msg, dict) else getattr(msg, "peer_id", None)
+        from_id = msg.get("from_id") if isinstance(msg, dict) else getattr(msg, "from_id", None)
+        text = (msg.get("text") if isinstance(msg, dict) else getattr(msg, "text", "")) or ""
+        matcher = get_blacklist_matcher()
+        if not len(matcher):
+            return False
+        match = matcher.search(text.lower())
+        if not match:
+            return False
+        w = match[1]
+        conv_id = msg.get("conversation_message_id") if isinstance(msg, dict) else getattr(msg, "conversation_message_id", None)
+        mid = msg.get("id") if isinstance(msg, dict) else getattr(msg, "id", None)
+        try:
+            if conv_id:
+                vk.messages.delete(conversation_message_ids=[conv_id], peer_id=peer_id, delete_for_all=1)
+            elif mid:
+                vk.messages.delete(message_ids=[mid], delete_for_all=1)
+        except Exception:
+            pass
+        try:
+            remove_roles_db(from_id, None)
+        except Exception:
+            pass
+        res, skipped = global_kick_user(from_id)
+        ok = sum(1 for _, v in res if v)
+        add_ban_db(from_id, OWNER_ID or 0, f"Blacklisted word: {w}", 0)
+        audit("blacklist_trigger", None, from_id, peer_id, f"Blacklisted word: {w}", kicked=ok, chats=len(res))
+        ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        notify = f"🚨 BLACKLIST TRIGGER\nUser: {mention(from_id)}\nWord: «{w}»\nDate: {ts}\nRoles removed and attempted kicks: {ok} successful, {skipped} chats skipped (not a member)."
+        if OWNER_ID:
+            safe_send(OWNER_ID, notify, PRIORITY_HIGH)
+        safe_send(peer_id, f"🚫 Сообщение удалено: запрещённое слово «{w}». Пользователь {mention(from_id)} кикнут/заблокирован.", PRIORITY_HIGH)
+        return True
+    except Exception as e:
+        logger.exception("handle_blacklist_on_message error: %s", e)
+    return False
+
+# ----------------- Invite handling -----------------
+def handle_invite_action(event):
+    try:
+        msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
+        if not msg:
+            return
+        action = msg.get("action") if isinstance(msg, dict) else getattr(msg, "action", None)
+        if not action:
+            return
+        act_type = action.get("type") if isinstance(action, dict) else getattr(action, "type", None)
+        actor = msg.get("from_id") if isinstance(msg, dict) else getattr(msg, "from_id", None)
+        peer_id = msg.get("peer_id") if isinstance(msg, dict) else getattr(msg, "peer_id", None)
+        member = action.get("member_id") if isinstance(action, dict) else getattr(action, "member_id", None)
+        # поддерживаем кэш участников: кик и выход (chat_kick_user), вход по ссылке
+        if act_type == "chat_kick_user" and member:
+            member_left(peer_id, member)
+            return
+        if act_type == "chat_invite_user_by_link" and actor:
+            member_joined(peer_id, actor)
+        if act_type not in ("chat_invite_user", "chat_invite_user_by_link"):
+            return
+        invited = None
+        if isinstance(action, dict):
+            invited = action.get("member_id") or (action.get("users") and action.get("users")[0])
+        if not invited:
+            return
+        invited = int(invited)
+        member_joined(peer_id, invited)
+        if peer_id and peer_id >= 2000000000:
+            add_chat(peer_id)
+        bans = get_bans_db(invited) or []
+        if bans:
+            reason = bans[-1][3] if len(bans[-1])>3 else "Ban"
+            kick_from_chat_peer(peer_id, invited)
+            audit("kick", None, invited, peer_id, reason, auto="banned_invite", inviter=actor)
+            safe_send(peer_id, f"❌ {mention(invited)} приглашён — но он в бане. Кикнут. Причина: {reason}", PRIORITY_HIGH)
+            return
+        actor_role = get_role_db(actor, peer_id)
+        rank = ROLE_PRIORITY.get(actor_role, 0)
+        if rank < ROLE_PRIORITY.get("helper", 40):
+            add_ban_db(actor, OWNER_ID or 0, "Unauthorized invite", peer_id)
+            kick_from_chat_peer(peer_id, invited)
+            audit("ban", None, actor, peer_id, "Unauthorized invite", auto="invite")
+            audit("kick", None, invited, peer_id, "Unauthorized invite", auto="invite", inviter=actor)
+            prefetch_names([actor, invited])
+            safe_send(peer_id, f"🚨 {mention(actor)} пытался добавить {mention(invited)}. Пригласивший локально забанен, добавленный кикнут.", PRIORITY_HIGH)
+            return
+    except Exception as e:
+        logger.exception("handle_invite_action error: %s", e)
+
+def handle_new_member(event, vk):
+    peer_id = event["peer_id"]
+    inviter_id = event["action"]["member_id"]
+    adder_id = event["from_id"]
+
+    role_adder = get_role_db(adder_id, peer_id)
+
+    if role_adder in ["helper", "moderator", "admin", "owner"]:
+        safe_send(peer_id, f"✅ [id{inviter_id}|Пользователь] добавлен в чат.")
+    else:
+        # Кикаем того, кого добавили
+        try:
+            vk.messages.removeChatUser(chat_id=peer_id-2000000000, member_id=inviter_id)
+            safe_send(peer_id, f"❌ [id{inviter_id}|Пользователь] не может быть добавлен.")
+        except:
+            pass
+
+        # Баним того, кто добавил
+        ban_user(adder_id, peer_id, reason="Нарушение: попытка добавить в чат без прав")
+
+# ----------------- Лестница наказаний за варны -----------------
+# Правило: «порог[/окно d]:действие[:минуты]», например "2:mute:30 3:kick 5/30d:sban" —
+# 2 варна в беседе -> мут на 30 минут, 3 -> исключение, 5 за 30 дней -> глобальный бан.
+# Правила беседы из warn_rules, иначе общие (peer_id = 0), иначе WARN_LADDER из окружения.
+# Варны считаются по беседе; если задан WARN_TTL_DAYS — только моложе него, а более старые
+# раз в WARN_COMPACT_INTERVAL удаляются фоновой задачей пачками (необратимо, поэтому по умолчанию выключено).
+WARN_LADDER = os.getenv("WARN_LADDER") or "3:kick"
+WARN_TTL_DAYS = int(os.getenv("WARN_TTL_DAYS") or 0)                           # 0 — варны не сгорают
+WARN_COMPACT_INTERVAL = float(os.getenv("WARN_COMPACT_INTERVAL") or 3600)     # секунды
+WARN_COMPACT_BATCH = 500
+DEFAULT_MUTE_MINUTES = 30
+LADDER_ACTIONS = ("mute", "kick", "ban", "sban")    # по возрастанию строгости
+LADDER_TITLES = {"mute": "мут", "kick": "исключение", "ban": "бан в беседе", "sban": "глобальный бан"}
+
+WarnRule = namedtuple("WarnRule", "threshold window_days action minutes")
+
+def parse_ladder(spec) -> List[WarnRule]:
+    """Разбирает правила из строки или списка слов; ValueError с понятным текстом при ошибке."""
+    items = spec.replace(",", " ").split() if isinstance(spec, str) else list(spec)
+    rules = {}
+    for item in items:
+        parts = item.lower().split(":")
+        head, action = parts[0], parts[1] if len(parts) > 1 else ""
+        threshold, _, window = head.partition("/")
+        window = window[:-1] if window.endswith(("d", "д")) else window
+        if not threshold.isdigit() or int(threshold) < 1 or (window and not window.isdigit()):
+            raise ValueError(f"неверный порог в «{item}»: нужно N или N/Dd")
+        if action not in LADDER_ACTIONS:
+            raise ValueError(f"неизвестное действие в «{item}»: {', '.join(LADDER_ACTIONS)}")
+        minutes = 0
+        if action == "mute":
+            minutes = parts[2] if len(parts) > 2 else str(DEFAULT_MUTE_MINUTES)
+            if not minutes.isdigit() or int(minutes) < 1:
+                raise ValueError(f"неверная длительность мута в «{item}»")
+            minutes = int(minutes)
+        elif len(parts) > 2:
+            raise ValueError(f"длительность указывается только для mute: «{item}»")
+        rule = WarnRule(int(threshold), int(window or 0), action, minutes)
+        rules[(rule.threshold, rule.window_days)] = rule
+    if not rules:
+        raise ValueError("пустой список правил")
+    return sorted(rules.values())
+
+def format_ladder(rules: List[WarnRule]) -> str:
+    out = []
+    for r in rules:
+        head = f"{r.threshold}/{r.window_days}d" if r.window_days else str(r.threshold)
+        out.append(f"{head}:{r.action}" + (f":{r.minutes}" if r.action == "mute" else ""))
+    return " ".join(out)
+
+class WarnLadder:
+    """
+    Правила эскалации в памяти: peer_id -> [WarnRule]. Загружаются один раз,
+    меняются через set/reset (и apply_change в других шардах), поэтому /warn не читает warn_rules.
+    """
+    def __init__(self, default_spec: str = WARN_LADDER):
+        try:
+            self.default = parse_ladder(default_spec)
+        except ValueError as e:
+            logger.error("WARN_LADDER=%r: %s; используется 3:kick", default_spec, e)
+            self.default = parse_ladder("3:kick")
+        self._rules = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        rows = db_execute("SELECT peer_id, threshold, window_days, action, minutes FROM warn_rules", fetch=True)
+        if rows is None:
+            return
+        rules = {}
+        for peer, *rule in rows:
+            rules.setdefault(int(peer), []).append(WarnRule(*rule))
+        with self._lock:
+            self._rules = {p: sorted(r) for p, r in rules.items()}
+        logger.info("Правила варнов загружены: %s бесед", len(rules))
+
+    def rules_for(self, peer_id: int) -> Tuple[List[WarnRule], str]:
+        """(правила, откуда: "chat" | "global" | "env")."""
+        if self._rules is None:
+            self.load()
+        rules = self._rules or {}
+        if int(peer_id) in rules:
+            return rules[int(peer_id)], "chat"
+        if 0 in rules:
+            return rules[0], "global"
+        return self.default, "env"
+
+    def set(self, peer_id: int, rules: List[WarnRule]) -> bool:
+        try:
+            with db_transaction():
+                db_execute("DELETE FROM warn_rules WHERE peer_id=?", (peer_id,))
+                db_executemany("INSERT INTO warn_rules (peer_id, threshold, window_days, action, minutes) VALUES (?,?,?,?,?)",
+                               [(peer_id,) + tuple(r) for r in rules])
+        except Exception:
+            return False
+        self.invalidate()
+        publish_change("warn_rules")
+        return True
+
+    def reset(self, peer_id: int) -> bool:
+        if db_execute("DELETE FROM warn_rules WHERE peer_id=?", (peer_id,)) is None:
+            return False
+        self.invalidate()
+        publish_change("warn_rules")
+        return True
+
+    def invalidate(self):
+        with self._lock:
+            self._rules = None
+
+warn_ladder = WarnLadder()
+
+def warn_cutoff(window_days: int = 0, now: Optional[datetime.datetime] = None) -> str:
+    """Самая ранняя отметка времени варна, который ещё учитывается (окно правила и срок жизни)."""
+    now = now or datetime.datetime.now()
+    days = [d for d in (window_days, WARN_TTL_DAYS) if d]
+    if not days:
+        return ""
+    return (now - datetime.timedelta(days=min(days))).strftime("%Y-%m-%d %H:%M:%S")
+
+def count_warns(user_id: int, peer_id: int, windows=(0,)) -> dict:
+    """window_days -> число действующих варнов в беседе; один проход по idx_warns_user_peer_ts."""
+    windows = sorted(set(windows))
+    now = datetime.datetime.now()
+    cutoffs = [warn_cutoff(w, now) for w in windows]
+    sums = ", ".join("SUM(timestamp>=?)" for _ in windows)
+    rows = db_execute(f"SELECT {sums} FROM warns WHERE user_id=? AND peer_id=? AND timestamp>=?",
+                      tuple(cutoffs) + (user_id, peer_id, min(cutoffs)), fetch=True) or [()]
+    return {w: int(n or 0) for w, n in zip(windows, rows[0] or [0] * len(windows))}
+
+def pick_rule(rules: List[WarnRule], counts: dict) -> Optional[WarnRule]:
+    """Из сработавших правил — с наибольшим порогом, при равных — самое строгое."""
+    hit = [r for r in rules if counts.get(r.window_days, 0) >= r.threshold]
+    if not hit:
+        return None
+    return max(hit, key=lambda r: (r.threshold, LADDER_ACTIONS.index(r.action)))
+
+def escalate(peer_id: int, target: int, actor: int) -> Tuple[int, Optional[str]]:
+    """
+    Проверяет лестницу после нового варна и применяет ступень.
+    Возвращает (варнов в беседе, текст о применённом наказании или None).
+    """
+    rules, _ = warn_ladder.rules_for(peer_id)
+    counts = count_warns(target, peer_id, {0} | {r.window_days for r in rules})
+    warns = counts[0]
+    rule = pick_rule(rules, counts)
+    if rule is None:
+        return warns, None
+    step = f"{rule.threshold} варн." + (f" за {rule.window_days} дн." if rule.window_days else "")
+    reason = f"Лестница варнов: {step}"
+    failed = f"⚠️ Лестница варнов ({step}): наказание не применено — ошибка базы данных."
+    if rule.action == "mute":
+        if not add_mute_db(target, actor, rule.minutes, reason, peer_id):
+            return warns, failed
+        audit("mute", actor, target, peer_id, reason, minutes=rule.minutes, auto="ladder")
+        return warns, f"🔇 {mention(target)} получает мут на {rule.minutes} мин. ({step})"
+    if rule.action == "kick":
+        if not kick_from_chat_peer(peer_id, target):
+            return warns, f"⚠️ Лестница варнов ({step}): не удалось исключить {mention(target)} (возможно, у бота нет прав)."
+        audit("kick", actor, target, peer_id, reason, auto="ladder")
+        return warns, f"❌ {mention(target)} исключён из беседы ({step})"
+    if rule.action == "ban":
+        if not add_ban_db(target, actor, reason, peer_id):
+            return warns, failed
+        remove_roles_db(target, peer_id)
+        kick_from_chat_peer(peer_id, target)
+        audit("ban", actor, target, peer_id, reason, auto="ladder")
+        return warns, f"🔒 {mention(target)} забанен в этой беседе ({step})"
+    if not add_ban_db(target, actor, reason, 0):
+        return warns, failed
+    remove_roles_db(target, None)
+    res, _ = global_kick_user(target)
+    ok = sum(1 for _, v in res if v)
+    audit("global_ban", actor, target, peer_id, reason, kicked=ok, chats=len(res), auto="ladder")
+    return warns, f"🚫 {mention(target)} глобально забанен ({step}). Удалён из {ok}/{len(res)} бесед"
+
+def compact_expired_warns(payloads=None) -> int:
+    """
+    Удаляет варны старше WARN_TTL_DAYS пачками по WARN_COMPACT_BATCH (транзакция на пачку,
+    писатели не ждут долго) и переводит их в «истекло» в punishment_counts.
+    Обработчик планировщика: после прохода ставит себя снова через WARN_COMPACT_INTERVAL.
+    """
+    removed = 0
+    try:
+        cutoff = warn_cutoff()
+        while cutoff:
+            with db_transaction():
+                rows = db_execute("SELECT id, user_id, peer_id FROM warns WHERE timestamp<? LIMIT ?",
+                                  (cutoff, WARN_COMPACT_BATCH), fetch=True) or []
+                if not rows:
+                    break
+                ids = tuple(r[0] for r in rows)
+                db_execute(f"DELETE FROM warns WHERE id IN ({','.join('?' * len(ids))})", ids)
+                by_peer = {}
+                for _, uid, peer in rows:
+                    by_peer[(uid, peer)] = by_peer.get((uid, peer), 0) + 1
+                bump_counts("warn", [(uid, peer, 0, -n, n) for (uid, peer), n in by_peer.items()])
+            removed += len(rows)
+        if removed:
+            logger.info("Сгорело варнов старше %s дн.: %s", WARN_TTL_DAYS, removed)
+    finally:
+        if payloads is not None:
+            expiry_scheduler.schedule(time.time() + WARN_COMPACT_INTERVAL, "warn_compaction", None)
+    return removed
+
+# ----------------- Профиль пользователя (/info) -----------------
+# Счётчики, действующие муты/баны и последние действия журнала по нескольким пользователям
+# читаются одним запросом (UNION ALL по индексам user_id / target_id), роль — из кэша ролей.
+# Последние действия — подзапрос с LIMIT на каждого пользователя: индекс (target_id, ts) отдаёт
+# их сразу, без чтения всей истории пользователя.
+INFO_MAX_USERS = 10
+INFO_LAST_ACTIONS = 3
+
+UserProfile = namedtuple("UserProfile", "user_id role counts here mutes bans actions")
+
+def _profile_sql(n: int) -> str:
+    ids = ",".join("?" * n)
+    return f"""
+        SELECT 'count', user_id, peer_id, kind, issued, active, expired, NULL
+          FROM punishment_counts WHERE user_id IN ({ids}) AND peer_id IN (?, ?)
+        UNION ALL
+        SELECT 'mute', user_id, peer_id, MAX(until), issued_by, NULL, NULL, reason
+          FROM mutes WHERE user_id IN ({ids}) AND peer_id IN (0, ?) AND until > ? GROUP BY user_id, peer_id
+        UNION ALL
+        SELECT 'ban', user_id, peer_id, MAX(until), issued_by, NULL, NULL, reason
+          FROM bans WHERE user_id IN ({ids}) AND peer_id IN (0, ?) GROUP BY user_id, peer_id
+""" + "".join(f"""
+        UNION ALL
+        SELECT * FROM (SELECT 'action', target_id, peer_id, action, actor_id, ts, NULL, reason
+          FROM audit_log WHERE target_id=? ORDER BY ts DESC, id DESC LIMIT {INFO_LAST_ACTIONS})""" for _ in range(n))
+
+def get_profiles(user_ids: List[int], peer_id: int) -> List[UserProfile]:
+    """
+    Профили в порядке user_ids: счётчики по всем беседам и по этой, действующие здесь мут и бан
+    (самые поздние из глобальных и локальных), последние действия журнала.
+    """
+    uids = list(dict.fromkeys(int(u) for u in user_ids))
+    if not uids:
+        return []
+    ids = tuple(uids)
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    params = ids + (COUNT_ALL, peer_id) + ids + (peer_id, now) + ids + (peer_id,) + ids
+    # буфер журнала — до запроса: запись, сброшенная в БД между ними, попадёт в оба (дубль уберём ниже),
+    # а не потеряется
+    pending = audit_log.buffered(uids)
+    rows = db_execute(_profile_sql(len(uids)), params, fetch=True) or []
+    data = {u: {"counts": dict.fromkeys(PUNISHMENT_KINDS, NO_PUNISHMENTS), "here": dict.fromkeys(PUNISHMENT_KINDS, NO_PUNISHMENTS),
+                "mute": [], "ban": [], "action": []} for u in uids}
+    for src, uid, peer, label, a, b, c, reason in rows:
+        d = data[int(uid)]
+        if src == "count":
+            d["counts" if peer == COUNT_ALL else "here"][label] = PunishmentCount(a, b, c)
+        elif src == "action":
+            d["action"].append((b, label, a, peer, reason))
+        else:
+            d[src].append((peer, label, a, reason))
+    # записи из буфера новее любых записанных в БД: ставим их первыми, от новых к старым;
+    # при равном ts порядок списка (буфер, затем БД по id DESC) — тай-брейк сортировки
+    for u in uids:
+        fresh = [(ts, action, actor, peer, reason) for ts, action, actor, target, peer, reason, _ in reversed(pending) if target == u]
+        if not fresh:
+            continue
+        flushed = Counter(fresh)
+        stored = []
+        for a in data[u]["action"]:
+            if flushed[a] > 0:
+                flushed[a] -= 1    # уже и в БД, и в снимке буфера
+            else:
+                stored.append(a)
+        data[u]["action"] = fresh + stored
+    profiles = []
+    for u in uids:
+        d = data[u]
+        ranked = sorted(enumerate(d["action"]), key=lambda x: (-x[1][0], x[0]))
+        actions = [a for _, a in ranked[:INFO_LAST_ACTIONS]]
+        profiles.append(UserProfile(u, get_role_db(u, peer_id), d["counts"], d["here"], d["mute"], d["ban"], actions))
+    return profiles
+
+def format_profile(p: UserProfile) -> str:
+    c, here = p.counts, p.here
+    lines = [f"📌 Инфо: {mention(p.user_id)}",
+             f"Роль (локально): {p.role}",
+             f"Всего варнов: {c['warn'].active} (в этой беседе: {here['warn'].active}, выдано за всё время: {c['warn'].issued})",
+             f"Активных мутов: {c['mute'].active} (всего было: {c['mute'].issued})",
+             f"Записей о банах: {c['ban'].active}"]
+    for peer, until, by, reason in p.mutes:
+        lines.append(f"🔇 Мут{' во всех беседах' if not peer else ''} до {until} от {mention(by)}: {reason}")
+    for peer, _, by, reason in p.bans:
+        lines.append(f"🔒 {'Глобальный бан' if not peer else 'Бан в этой беседе'} от {mention(by)}: {reason}")
+    if p.actions:
+        lines.append("Последние действия:")
+        for ts, action, actor, _, reason in p.actions:
+            when = datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+            who = f" от {mention(actor)}" if actor else ""
+            lines.append(f"- {when} {action}{who}" + (f": {reason}" if reason else ""))
+    return "\n".join(lines)
+
+# ----------------- Helpers: проверки -----------------
+def is_owner(uid: int) -> bool:
+    return OWNER_ID and int(uid) == int(OWNER_ID)
+
+def role_key(uid: int, peer_id: Optional[int] = None) -> str:
+    """Роль пользователя, приведённая к ключу PERMS (русские названия из БД -> англ.)."""
+    role = get_role_db(uid, peer_id)
+    key_role = role.lower() if role else "user"
+    key_role = ROLE_ALIASES.get(key_role, key_role)
+    return key_role if key_role in ROLE_MASKS else "user"
+
+def has_perm(uid: int, cmd_key: str, peer_id: Optional[int] = None) -> bool:
+    if is_owner(uid):
+        return True
+    bit = PERM_BITS.get(cmd_key)
+    if not bit:
+        return False
+    return bool(ROLE_MASKS[role_key(uid, peer_id)] & bit)
+
+# ----------------- Реестр команд -----------------
+class Command:
+    """
+    Описание команды: обработчик, алиасы, право, справка и разбор аргументов.
+    perm — ключ права (None — команда доступна всем), roles — роли, которым оно выдано;
+    owner_only — только владелец бота (OWNER_ID); min_args — без стольких аргументов
+    вместо вызова обработчика показывается usage.
+    """
+    _stats_lock = threading.Lock()
+
+    def __init__(self, key: str, handler, aliases: List[str], help_text: str, usage: str = "",
+                 perm: Optional[str] = None, roles=(), owner_only: bool = False, min_args: int = 0):
+        self.key = key
+        self.handler = handler
+        self.aliases = aliases
+        self.help_text = help_text
+        self.usage = usage or aliases[0]
+        self.perm = perm
+        self.roles = tuple(roles)
+        self.owner_only = owner_only
+        self.min_args = min_args
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def tier(self) -> str:
+        """Младшая роль, которой доступна команда (раздел в /help)."""
+        if self.owner_only:
+            return "owner"
+        if not self.perm:
+            return "user"
+        return next(r for r in ROLE_TIERS if r in self.roles)
+
+    def record(self, elapsed: float, failed: bool):
+        with self._stats_lock:
+            self.calls += 1
+            self.errors += failed
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+        m_command_seconds.observe(elapsed, self.key)
+        if failed:
+            m_command_errors.inc(self.key)
+
+COMMANDS = {}        # ключ -> Command, в порядке регистрации
+ALIAS_INDEX = {}     # алиас в нижнем регистре -> Command
+
+def register_command(key: str, handler, aliases: List[str], help_text: str, **opts) -> Command:
+    cmd = Command(key, handler, aliases, help_text, **opts)
+    for a in aliases:
+        a = a.lower()
+        if a in ALIAS_INDEX:
+            raise ValueError(f"алиас {a} уже занят командой {ALIAS_INDEX[a].key}")
+        ALIAS_INDEX[a] = cmd
+    COMMANDS[key] = cmd
+    if cmd.perm:
+        for role in cmd.roles:
+            PERMS[role].add(cmd.perm)
+    return cmd
+
+def resolve_command(cmd_text: str) -> Optional[Command]:
+    return ALIAS_INDEX.get(cmd_text.lower())
+
+def command_stats() -> dict:
+    """Счётчики вызовов по командам: calls, errors, avg_ms, max_ms."""
+    with Command._stats_lock:
+        return {c.key: {"calls": c.calls, "errors": c.errors,
+                        "avg_ms": c.total_time / c.calls * 1000 if c.calls else 0.0,
+                        "max_ms": c.max_time * 1000}
+                for c in COMMANDS.values() if c.calls}
+
+# ----------------- Реализация команд -----------------
+TIER_TITLES = {"user": "👤 Пользователь", "helper": "🤝 Помощник", "moder": "🔨 Модератор",
+               "admin": "🛡 Админ", "owner": "👑 Владелец"}
+
+def cmd_help(peer_id: int, from_id: int, event, args: List[str]):
+    owner = is_owner(from_id)
+    mask = ROLE_MASKS[role_key(from_id, peer_id)]
+    sections = {tier: [] for tier in ROLE_TIERS}
+    for cmd in COMMANDS.values():
+        if cmd.owner_only and not owner:
+            continue
+        if cmd.perm and not (owner or mask & PERM_BITS[cmd.perm]):
+            continue
+        name = cmd.usage.split()[0]
+        alt = [a for a in cmd.aliases if a.startswith("/") and a != name][:2]
+        sections[cmd.tier()].append(f"{cmd.usage}" + (f" ({', '.join(alt)})" if alt else "") + f" — {cmd.help_text}")
+
+    help_text = "📖 Доступные команды для вашей роли:\n\n"
+    for tier in ROLE_TIERS:
+        if sections[tier]:
+            help_text += f"{TIER_TITLES[tier]}:\n" + "\n".join(sections[tier]) + "\n\n"
+    safe_send(peer_id, help_text.strip())
+
+def cmd_info(peer_id: int, from_id: int, event, args: List[str]):
+    targets = parse_user_ids(event, args, INFO_MAX_USERS) or [from_id]
+    profiles = get_profiles(targets, peer_id)
+    # все, кого упомянут профили, — одним users.get
+    prefetch_names(targets + [a[2] for p in profiles for a in p.actions] + [m[2] for p in profiles for m in p.mutes + p.bans])
+    for p in profiles:
+        safe_send(peer_id, format_profile(p))
+
+def cmd_warn(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args, fresh=True)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя (reply или id).")
+    reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
+    if not add_warn_db(target, from_id, reason, peer_id):
+        return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    audit("warn", from_id, target, peer_id, reason)
+    prefetch_names([target, from_id])
+    warns, punished = escalate(peer_id, target, from_id)
+    safe_send(peer_id, (f"⚠️ Варн выдан {mention(target)}.\nПричина: {reason}\nВыдал: {mention(from_id)}\n"
+                        f"Дата: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\nВарнов в этой беседе: {warns}"))
+    if punished:
+        safe_send(peer_id, punished)
+
+def cmd_warns(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args) or from_id
+    warns = get_warns_db(target) or []
+    if not warns:
+        return safe_send(peer_id, f"✅ У {mention(target)} нет варнов.")
+    prefetch_names([target] + [w[1] for w in warns])
+    text = f"📜 Варны {mention(target)} ({len(warns)}):\n"
+    for w in warns:
+        text += f"- {w[3]} | от {mention(w[1])} | причина: {w[2]}\n"
+    safe_send(peer_id, text)
+
+def cmd_unwarn(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    res = remove_last_warn_db(target)
+    if res is None:
+        return safe_send(peer_id, "❌ У пользователя нет варнов.")
+    audit("unwarn", from_id, target, peer_id)
+    safe_send(peer_id, f"✅ Последний варн снят у {mention(target)}")
+
+def cmd_warn_rules(peer_id: int, from_id: int, event, args: List[str]):
+    scope = peer_id
+    if args and args[0].lower() in ("global", "глоб", "общие"):
+        if not is_owner(from_id):
+            return safe_send(peer_id, "⛔ Общие правила меняет только владелец бота.")
+        scope, args = 0, args[1:]
+    if not args:
+        rules, source = warn_ladder.rules_for(scope)
+        where = {"chat": "правила беседы", "global": "общие правила", "env": "по умолчанию (WARN_LADDER)"}[source]
+        lines = []
+        for r in rules:
+            when = f"{r.threshold} варн." + (f" за {r.window_days} дн." if r.window_days else "")
+            what = LADDER_TITLES[r.action] + (f" на {r.minutes} мин." if r.action == "mute" else "")
+            lines.append(f"- {when} → {what}")
+        ttl = f"{WARN_TTL_DAYS} дн." if WARN_TTL_DAYS else "не сгорают"
+        return safe_send(peer_id, f"📶 Лестница варнов ({where}):\n" + "\n".join(lines) +
+                         f"\nСрок жизни варна: {ttl}\nЗапись: {format_ladder(rules)}")
+    if args[0].lower() in ("reset", "сброс"):
+        if not warn_ladder.reset(scope):
+            return safe_send(peer_id, "❌ Ошибка при сбросе правил.")
+        audit("warn_rules_reset", from_id, None, peer_id, scope=scope)
+        return safe_send(peer_id, "✅ Правила сброшены: действуют " + ("правила по умолчанию." if scope == 0 else "общие правила."))
+    try:
+        rules = parse_ladder(args)
+    except ValueError as e:
+        return safe_send(peer_id, f"❌ {e}\nПример: /warnrules 2:mute:30 3:kick 5/30d:sban")
+    if not warn_ladder.set(scope, rules):
+        return safe_send(peer_id, "❌ Ошибка при сохранении правил.")
+    audit("warn_rules_set", from_id, None, peer_id, format_ladder(rules), scope=scope)
+    safe_send(peer_id, ("✅ Общие правила" if scope == 0 else "✅ Правила беседы") + f" сохранены: {format_ladder(rules)}")
+
+def cmd_mute(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args, fresh=True)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    minutes = 10
+    reason = "Не указана"
+    if len(args) >= 2 and args[1].isdigit():
+        minutes = int(args[1])
+        reason = " ".join(args[2:]) if len(args) > 2 else "Не указана"
+    else:
+        reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
+    if not add_mute_db(target, from_id, minutes, reason, peer_id):
+        return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    audit("mute", from_id, target, peer_id, reason, minutes=minutes)
+    until = (datetime.datetime.now() + datetime.timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M:%S")
+    safe_send(peer_id, f"🔇 Мут выдан {mention(target)} на {minutes} минут.\nПричина: {reason}\nДо: {until}")
+
+def cmd_unmute(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    if delete_mutes_for_user_in_peer_db(target, peer_id) is None:
+        return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    audit("unmute", from_id, target, peer_id)
+    safe_send(peer_id, f"🔔 Мут снят с {mention(target)}")
+
+def cmd_kick(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args, fresh=True)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
+    ok = kick_from_chat_peer(peer_id, target)
+    if ok:
+        audit("kick", from_id, target, peer_id, reason)
+        prefetch_names([target, from_id])
+        safe_send(peer_id, f"👢 {mention(target)} кикнут.\nПричина: {reason}\nВыдал: {mention(from_id)}")
+    else:
+        safe_send(peer_id, "❌ Не удалось кикнуть (возможно у бота нет прав).")
+
+def cmd_skick(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args, fresh=True)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    res, skipped = global_kick_user(target)
+    ok = sum(1 for _, v in res if v)
+    audit("global_kick", from_id, target, peer_id, kicked=ok, chats=len(res))
+    safe_send(peer_id, f"👢 Попытка исключить {mention(target)} из всех бесед. Успешно: {ok}/{len(res)}"
+                       f" (пропущено бесед без пользователя: {skipped})")
+
+def cmd_ban(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args, fresh=True)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
+    if not add_ban_db(target, from_id, reason, peer_id):
+        return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    remove_roles_db(target, peer_id)
+    kick_from_chat_peer(peer_id, target)
+    audit("ban", from_id, target, peer_id, reason)
+    safe_send(peer_id, f"🔒 {mention(target)} забанен в этой беседе. Причина: {reason}")
+
+def cmd_unban_local(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    if remove_bans_db(target, peer_id) is None:
+        return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    audit("unban", from_id, target, peer_id)
+    safe_send(peer_id, f"🔓 Бан снят с {mention(target)} в этой беседе.")
+
+def cmd_sban(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args, fresh=True)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    reason = " ".join(args[1:]) if len(args) > 1 else "Не указана"
+    if not add_ban_db(target, from_id, reason, 0):
+        return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    remove_roles_db(target, None)
+    res, skipped = global_kick_user(target)
+    ok = sum(1 for _, v in res if v)
+    audit("global_ban", from_id, target, peer_id, reason, kicked=ok, chats=len(res))
+    safe_send(peer_id, f"🚫 {mention(target)} глобально забанен. Удалён из {ok}/{len(res)} бесед"
+                       f" (пропущено бесед без пользователя: {skipped}). Причина: {reason}")
+
+def cmd_sunban(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    if remove_bans_db(target, None) is None:
+        return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    audit("global_unban", from_id, target, peer_id)
+    safe_send(peer_id, f"🔓 Глобальный бан снят с {mention(target)}")
+
+def cmd_add(peer_id: int, from_id: int, event, args: List[str]):
+    target_id = parse_user_id(event, args, fresh=True)
+    if not target_id:
+        return safe_send(peer_id, "⚠ Укажите пользователя через @id или ответом на сообщение.")
+    try:
+        vk.messages.addChatUser(chat_id=peer_id - 2000000000, user_id=target_id)
+    except Exception as e:
+        return safe_send(peer_id, f"⚠ Ошибка: {e}")
+    audit("add_user", from_id, target_id, peer_id)
+    safe_send(peer_id, f"✅ {mention(target_id)} добавлен в чат.")
+
+def cmd_role_local(peer_id: int, from_id: int, event, args: List[str], role_name: str):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    set_role_db(target, role_name, peer_id)
+    audit("role_set", from_id, target, peer_id, role=role_name, scope="local")
+    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    prefetch_names([target, from_id])
+    safe_send(peer_id, f"✅ {mention(target)} назначен(а) {role_name} в этой беседе.\nВыдал: {mention(from_id)}\nДата: {ts}")
+
+def cmd_role_global(peer_id: int, from_id: int, event, args: List[str], role_name: str):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    set_role_db(target, role_name, 0)
+    audit("role_set", from_id, target, peer_id, role=role_name, scope="global")
+    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    prefetch_names([target, from_id])
+    safe_send(peer_id, f"🌍 {mention(target)} назначен(а) {role_name} глобально.\nВыдал: {mention(from_id)}\nДата: {ts}")
+
+def cmd_remove_role_local(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    remove_roles_db(target, peer_id)
+    audit("role_removed", from_id, target, peer_id, scope="local")
+    safe_send(peer_id, f"✅ С {mention(target)} сняты роли в этой беседе.")
+
+def cmd_remove_role_global(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    remove_roles_db(target, None)
+    audit("role_removed", from_id, target, peer_id, scope="global")
+    safe_send(peer_id, f"🌍 С {mention(target)} сняты все роли глобально.")
+
+def cmd_blacklist(peer_id: int, from_id: int, event, args: List[str]):
+    action = args[0].lower()
+    if action in ("add","добавить"):
+        if len(args) < 2:
+            return safe_send(peer_id, "❌ Укажите слово.")
+        add_blacklist_db(args[1])
+        audit("blacklist_add", from_id, None, peer_id, word=args[1].lower())
+        safe_send(peer_id, f"✅ Слово '{args[1]}' добавлено в список запретных слов.")
+    elif action in ("remove","удалить","rm"):
+        if len(args) < 2:
+            return safe_send(peer_id, "❌ Укажите слово.")
+        remove_blacklist_db(args[1])
+        audit("blacklist_remove", from_id, None, peer_id, word=args[1].lower())
+        safe_send(peer_id, f"✅ Слово '{args[1]}' удалено из списка запретных слов.")
+    elif action in ("list","список"):
+        bl = get_blacklist_db()
+        safe_send(peer_id, "📜 ЧС слов:\n" + (", ".join(bl) if bl else "ЧС пуст."))
+    else:
+        safe_send(peer_id, "❌ Неизвестное действие.")
+
+def cmd_wipe(peer_id: int, from_id: int, event, args: List[str]):
+    t = args[0].lower()
+    if t in ("warns", "bans"):
+        try:
+            with db_transaction():
+                db_execute(f"DELETE FROM {t}")
+                db_execute("DELETE FROM punishment_counts WHERE kind=?", (t[:-1],))
+        except Exception:
+            return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    elif t in ("roles", "blacklist", "chats"):
+        if not db_execute(f"DELETE FROM {t}"):
+            return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    else:
+        return safe_send(peer_id, "❌ Неверный параметр.")
+    audit("wipe", from_id, None, peer_id, table=t)
+    if t == "warns":
+        safe_send(peer_id, "🧹 Все варны очищены.")
+    elif t == "bans":
+        safe_send(peer_id, "🧹 Все баны очищены.")
+    elif t == "roles":
+        role_cache.clear()
+        publish_change("roles_cleared")
+        safe_send(peer_id, "🧹 Все роли очищены.")
+    elif t == "blacklist":
+        invalidate_blacklist_matcher()
+        publish_change("blacklist")
+        safe_send(peer_id, "🧹 ЧС очищен.")
+    else:
+        _known_chats.clear()
+        membership.forget()
+        publish_change("chats_cleared")
+        safe_send(peer_id, "🧹 Список чатов очищен.")
+
+def cmd_report(peer_id: int, from_id: int, event, args: List[str]):
+    text = " ".join(args)
+    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    payload = f"📣 Репорт от {mention(from_id)}\n{text}\n{ts}"
+    if OWNER_ID:
+        safe_send(OWNER_ID, payload)
+    audit("report", from_id, None, peer_id, text)
+    safe_send(peer_id, "✅ Репорт отправлен владельцу.")
+
+def cmd_gzov(peer_id: int, from_id: int, event, args: List[str]):
+    name = resolve_names([from_id]).get(int(from_id)) or str(from_id)
+    msg = f"@all Внимание! Информация от {name}!\n\n" + " ".join(args) + "\n\nСпасибо за внимание!"
+    chats = get_chats()
+    if not chats:
+        return safe_send(peer_id, "❌ Бот не состоит ни в одной беседе.")
+    job_id = broadcasts.create(from_id, peer_id, msg, chats)
+    if not job_id:
+        return safe_send(peer_id, "❌ Не удалось создать рассылку.")
+    audit("broadcast", from_id, None, peer_id, job_id=job_id, chats=len(chats))
+    safe_send(peer_id, f"📨 Рассылка #{job_id} запущена: {len(chats)} бесед(ы). Статус: /gzovstatus {job_id}")
+
+def cmd_gzov_status(peer_id: int, from_id: int, event, args: List[str]):
+    if args and args[0].isdigit():
+        job_ids = [int(args[0])]
+    else:
+        job_ids = broadcasts.running_jobs()
+        if not job_ids:
+            return safe_send(peer_id, "📭 Активных рассылок нет.")
+    lines = []
+    for jid in job_ids:
+        st = broadcasts.status(jid)
+        if not st:
+            lines.append(f"#{jid}: не найдена")
+            continue
+        total = st["sent"] + st["failed"] + st["pending"]
+        lines.append(f"#{jid} [{st['status']}] доставлено {st['sent']}/{total}, ошибок {st['failed']}, "
+                     f"осталось {st['pending']} (создана {st['created_at']})")
+    safe_send(peer_id, "📨 Рассылки:\n" + "\n".join(lines))
+
+def cmd_ss(peer_id: int, from_id: int, event, args: List[str]):
+    safe_send(peer_id, "@all Старший состав в игру! Даю 5 минут.")
+
+def cmd_admins(peer_id: int, from_id: int, event, args: List[str]):
+    # глобальные роли действуют во всех беседах; роль в беседе их перекрывает (как в RoleCache.get)
+    rows = db_execute("SELECT user_id, peer_id, role FROM roles WHERE peer_id IN (?, 0)", (peer_id,), fetch=True)
+    if rows is None:
+        return safe_send(peer_id, "❌ Ошибка базы данных, попробуйте позже.")
+    roles = {}
+    for uid, peer, role in sorted(rows, key=lambda r: r[1] != 0):
+        roles[int(uid)] = ROLE_ALIASES.get((role or "").lower(), role)
+    grouped = {"owner": [], "admin": [], "moder": [], "helper": []}
+    for uid, role in roles.items():
+        if role in grouped:
+            grouped[role].append(uid)
+    if not any(grouped.values()):
+        return safe_send(peer_id, "⚠ В этом чате пока нет администраторов.")
+
+    prefetch_names([uid for uids in grouped.values() for uid in uids])
+    titles = {"owner": "👑 Владельцы", "admin": "🛡 Админы", "moder": "🔨 Модераторы", "helper": "🤝 Помощники"}
+    msg = "👑 Список администрации чата:\n\n"
+    for role, uids in grouped.items():
+        if uids:
+            msg += f"{titles[role]}:\n" + "\n".join(mention(uid) for uid in sorted(uids)) + "\n\n"
+    safe_send(peer_id, msg.strip())
+
+# ----------------- Команды владельца (лок/глоб) -----------------
+def cmd_setowner_local(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    set_role_db(target, "owner", peer_id)
+    audit("role_set", from_id, target, peer_id, role="owner", scope="local")
+    safe_send(peer_id, f"✅ {mention(target)} назначен(а) владельцем в этой беседе.")
+
+def cmd_setowner_global(peer_id: int, from_id: int, event, args: List[str]):
+    target = parse_user_id(event, args)
+    if not target:
+        return safe_send(peer_id, "❌ Укажите пользователя.")
+    set_role_db(target, "owner", 0)
+    audit("role_set", from_id, target, peer_id, role="owner", scope="global")
+    safe_send(peer_id, f"🌍 {mention(target)} назначен(а) владельцем глобально.")
+
+def cmd_sync_members(peer_id: int, from_id: int, event, args: List[str]):
+    synced, failed = membership.sync()
+    safe_send(peer_id, f"🔄 Участники синхронизированы: {synced} бесед, без доступа: {failed}.\n"
+                       f"Сэкономлено вызовов кика с момента запуска: {membership.kicks_saved}")
+
+# ----------------- Бэкап и экспорт логов -----------------
+MAX_ATTACHMENTS = 10    # лимит вложений в одном сообщении VK
+LOGS_EXPORT_DIR = "logs_export"
+AUDIT_EXPORT_DIR = "audit_export"
+EXPORT_KEEP = int(os.getenv("EXPORT_KEEP") or 5)    # неотправленных выгрузок, оставляемых на диске
+
+def remove_files(files: List[str]):
+    """Выгрузка отправлена — локальная копия не нужна."""
+    for f in files:
+        try:
+            os.remove(f)
+        except OSError as e:
+            logger.warning("Не удалось удалить %s: %s", f, e)
+
+def prune_exports(dest_dir: str, keep: int = EXPORT_KEEP) -> int:
+    """
+    В каталоге выгрузок остаются только keep последних (по времени изменения) — это те,
+    что не удалось отправить. Части одной выгрузки (.001, .002, ...) считаются вместе.
+    """
+    if not os.path.isdir(dest_dir):
+        return 0
+    groups = {}
+    for f in os.listdir(dest_dir):
+        path = os.path.join(dest_dir, f)
+        groups.setdefault(f.split(".", 1)[0], []).append(path)
+    by_age = sorted(groups.values(), key=lambda paths: max(os.path.getmtime(p) for p in paths), reverse=True)
+    for paths in by_age[keep:]:
+        remove_files(paths)
+    return max(0, len(by_age) - keep)
+
+def create_backup_files() -> List[str]:
+    """Сжатый проверенный бэкап БД (см. backup.py): один файл или части, если он больше лимита документа VK."""
+    try:
+        return create_backup(DB_PATH, BACKUP_DIR)
+    except Exception as e:
+        logger.exception("create_backup_files error: %s", e)
+        return []
+
+def send_documents(peer_id: int, files: List[str], message: str):
+    """Загружает файлы документами и отправляет их в peer_id (по MAX_ATTACHMENTS вложений на сообщение)."""
+    attachments = []
+    for fname in files:
+        doc = upload.document_message(fname, title=os.path.basename(fname), peer_id=peer_id)
+        attachments.append(f"doc{doc['doc']['owner_id']}_{doc['doc']['id']}")
+    for i in range(0, len(attachments), MAX_ATTACHMENTS):
+        text = message if len(files) <= MAX_ATTACHMENTS else f"{message} ({i // MAX_ATTACHMENTS + 1})"
+        vk.messages.send(peer_id=peer_id, random_id=random.randint(1, 2**31-1),
+                         attachment=",".join(attachments[i:i + MAX_ATTACHMENTS]), message=text)
+
+def backup_caption(files: List[str], title: str) -> str:
+    if len(files) == 1:
+        return title
+    whole = os.path.basename(files[0])[:-4]    # имя без суффикса части .001
+    return f"{title}: {len(files)} частей, склеить: cat {whole}.0* > {whole}"
+
+def cmd_backup(peer_id: int, from_id: int, event, args: List[str]):
+    files = create_backup_files()
+    if not files:
+        return safe_send(peer_id, "❌ Ошибка при создании бэкапа.")
+    try:
+        audit("backup", from_id, None, peer_id, files=len(files))
+        send_documents(from_id, files, backup_caption(files, "✅ Бэкап базы"))
+        safe_send(peer_id, "✅ Бэкап создан и отправлен владельцу в ЛС.")
+    except Exception as e:
+        logger.exception("backup upload error: %s", e)
+        safe_send(peer_id, f"⚠️ Бэкап создан: {', '.join(files)}, но не удалось отправить в ЛС.")
+
+def export_logs_file(start: Optional[float] = None, end: Optional[float] = None,
+                     min_level: int = logging.DEBUG) -> Tuple[List[str], dict]:
+    """Сжатая выборка логов за интервал (только подходящие сегменты), порезанная под лимит документа VK."""
+    prune_exports(LOGS_EXPORT_DIR)
+    dst, stats = export_logs(LOG_PATH, LOGS_EXPORT_DIR, start, end, min_level)
+    return (split_file(dst) if dst else []), stats
+
+def cmd_export_logs(peer_id: int, from_id: int, event, args: List[str]):
+    try:
+        start, end, min_level = parse_export_args(args)
+    except ValueError as e:
+        return safe_send(peer_id, f"❌ {str(e)[:1].upper()}{str(e)[1:]}.\n"
+                                  "Пример: /exportlogs 2h error, /exportlogs 2026-10-17 10:00 2026-10-17 12:00")
+    try:
+        files, stats = export_logs_file(start, end, min_level)
+    except Exception as e:
+        logger.exception("export_logs_file error: %s", e)
+        return safe_send(peer_id, "❌ Ошибка экспорта логов.")
+    if not files:
+        return safe_send(peer_id, f"🗒️ Нет записей за этот период (сегментов пропущено по индексу: {stats['skipped']}).")
+    try:
+        audit("export_logs", from_id, None, peer_id, lines=stats["lines"])
+        send_documents(from_id, files, backup_caption(files, f"🗒️ Экспорт логов: {stats['lines']} строк"))
+        remove_files(files)
+        safe_send(peer_id, "✅ Логи экспортированы и отправлены владельцу.")
+    except Exception as e:
+        logger.exception("logs upload error: %s", e)
+        safe_send(peer_id, f"⚠️ Логи экспортированы: {', '.join(files)}, но не удалось отправить в ЛС.")
+
+def cmd_audit(peer_id: int, from_id: int, event, args: List[str]):
+    """
+    /audit [id|@имя|reply] [кто <id>] [здесь] [тип <действие>] [7d | дата [дата]] [csv|jsonl]
+    id — история пользователя, «кто» — действия модератора, «здесь» — только эта беседа.
+    """
+    filters, fmt, when = {}, "csv", []
+    i = 0
+    while i < len(args):
+        a = args[i].lower()
+        nxt = args[i + 1] if i + 1 < len(args) else None
+        if a in ("csv", "jsonl", "json"):
+            fmt = "jsonl" if a == "json" else a
+        elif a in ("здесь", "here", "чат", "chat"):
+            filters["peer_id"] = peer_id
+        elif a in ("кто", "by", "от") and nxt:
+            filters["actor"] = parse_user_id(None, [nxt])
+            i += 1
+        elif a in ("тип", "type") and nxt:
+            filters["action"] = nxt.lower()
+            i += 1
+        else:
+            uid, screen = parse_user_ref(args[i])
+            # короткое имя — только явное (@имя, vk.com/имя), иначе «7d» ушло бы в utils.resolveScreenName
+            if uid is None and screen and (args[i].startswith("@") or "vk.com/" in args[i]):
+                uid = resolve_screen_name(screen)
+            if uid is not None:
+                filters["target"] = uid
+            else:
+                when.append(args[i])
+        i += 1
+    if "target" not in filters:
+        reply_uid = parse_user_id(event, [])
+        if reply_uid:
+            filters["target"] = reply_uid
+    if filters.get("actor", 0) is None:
+        return safe_send(peer_id, "❌ Не удалось определить модератора.")
+    try:
+        since, until, _ = parse_export_args(when)
+    except ValueError as e:
+        return safe_send(peer_id, f"❌ {str(e)[:1].upper()}{str(e)[1:]}.")
+    prune_exports(AUDIT_EXPORT_DIR)
+    dst, count = export_audit(AUDIT_EXPORT_DIR, fmt=fmt, since=since, until=until, **filters)
+    if not dst:
+        return safe_send(peer_id, "📒 В журнале нет записей по этому фильтру.")
+    audit("audit_export", from_id, filters.get("target"), peer_id, records=count, fmt=fmt)
+    try:
+        files = split_file(dst)
+        send_documents(from_id, files, backup_caption(files, f"📒 Журнал модерации: {count} записей"))
+        remove_files(files)
+        safe_send(peer_id, f"✅ Журнал ({count} записей) отправлен в ЛС.")
+    except Exception as e:
+        logger.exception("audit upload error: %s", e)
+        safe_send(peer_id, f"⚠️ Журнал выгружен: {dst}, но не удалось отправить в ЛС.")
+
+# ----------------- Команда clear (/удалить) -----------------
+def cmd_clear(peer_id: int, from_id: int, event, args: List[str]):
+    # Проверяем ответ на сообщение
+    msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
+    reply = msg.get("reply_message") if isinstance(msg, dict) else getattr(msg, "reply_message", None)
+    if not reply:
+        safe_send(peer_id, "⚠ Используйте команду ответом на сообщение, которое нужно удалить.")
+        return
+
+    target_msg_id = reply.get("conversation_message_id")
+    target_user_id = reply.get("from_id")
+
+    # Право на команду проверил handle_command; здесь — только старшинство над автором сообщения
+    if not is_owner(from_id) and (is_owner(target_user_id) or
+                                  ROLE_PRIORITY[role_key(from_id, peer_id)] <= ROLE_PRIORITY[role_key(target_user_id, peer_id)]):
+        safe_send(peer_id, "⛔ Вы не можете удалить сообщение этого пользователя.")
+        return
+
+    try:
+        # Удаляем сообщение жертвы и команду
+        cmids = [target_msg_id]
+        if msg.get("conversation_message_id"):
+            cmids.append(msg["conversation_message_id"])
+        vk.messages.delete(peer_id=peer_id, conversation_message_ids=cmids, delete_for_all=1)
+        audit("message_delete", from_id, target_user_id, peer_id)
+
+        # Отчёт
+        report = f"""
+🗑 Сообщение удалено!
+👮 Удалил: [id{from_id}|Пользователь]
+👤 У кого: [id{target_user_id}|Пользователь]
+⏰ Время: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        """
+        safe_send(peer_id, report)
+    except Exception as e:
+        safe_send(peer_id, f"⚠ Ошибка при удалении: {e}")
+
+# ----------------- Регистрация команд -----------------
+STAFF = ("owner", "admin", "moder", "helper")
+SENIOR = ("owner", "admin", "moder")
+ADMINS = ("owner", "admin")
+
+register_command("help", cmd_help, ["/help", "!help", "/помощь", "!помощь"],
+                 "список доступных вам команд.")
+register_command("info", cmd_info, ["/info", "!info", "/инфо", "!инфо", "/я", "!я", "/q", "!q"],
+                 "информация о пользователях.", usage="/info [id|reply] [id ...]")
+register_command("warns", cmd_warns, ["/warns", "!warns", "/варны", "!варны", "/предупреждения", "!предупреждения"],
+                 "варны пользователя.", usage="/warns [id|reply]")
+register_command("report", cmd_report, ["/report", "!report", "/репорт", "!репорт"],
+                 "пожаловаться владельцу.", usage="/report <текст>", min_args=1)
+register_command("admins", cmd_admins, ["/admins", "!admins", "/админы", "!админы"],
+                 "владельцы, админы, модераторы и помощники беседы.")
+
+register_command("warn", cmd_warn, ["/warn", "!warn", "/варн", "!варн", "/пред", "!пред"],
+                 "выдать варн (наказание — по лестнице /warnrules).", usage="/warn [id|reply] [причина]",
+                 perm="warn", roles=STAFF)
+register_command("mute", cmd_mute, ["/mute", "!mute", "/мут", "!мут", "/заткнуть", "!заткнуть"],
+                 "мут на X минут, сообщения удаляются.", usage="/mute [id|reply] <минуты> [причина]",
+                 perm="mute", roles=STAFF)
+register_command("add", cmd_add, ["/add", "!add", "/добавить", "!добавить", "/добавитьвгруппу", "!добавитьвгруппу"],
+                 "добавить пользователя в беседу.", usage="/add [id|reply]", perm="add", roles=STAFF)
+register_command("ss", cmd_ss, ["/ss", "!ss", "/сс", "!сс"],
+                 "вызвать старший состав в игру.", perm="ss", roles=("owner", "admin", "helper"))
+
+register_command("unwarn", cmd_unwarn, ["/unwarn", "!unwarn", "/унварн", "!унварн", "/снятьварн", "!снятьварн"],
+                 "снять последний варн.", usage="/unwarn [id|reply]", perm="unwarn", roles=SENIOR)
+register_command("unmute", cmd_unmute, ["/unmute", "!unmute", "/анмут", "!анмут", "/размут", "!размут"],
+                 "снять мут.", usage="/unmute [id|reply]", perm="unmute", roles=SENIOR)
+register_command("kick", cmd_kick, ["/kick", "!kick", "/кик", "!кик", "/исключить", "!исключить"],
+                 "исключить из беседы.", usage="/kick [id|reply] [причина]", perm="kick", roles=SENIOR)
+
+register_command("ban", cmd_ban, ["/ban", "!ban", "/бан", "!бан"],
+                 "бан в текущей беседе.", usage="/ban [id|reply] [причина]", perm="ban", roles=ADMINS)
+register_command("unban", cmd_unban_local, ["/unban", "!unban", "/унбан", "!унбан"],
+                 "снять бан в текущей беседе.", usage="/unban [id|reply]", perm="unban", roles=ADMINS)
+register_command("warnrules", cmd_warn_rules, ["/warnrules", "!warnrules", "/лестница", "!лестница", "/правилаварнов"],
+                 "лестница наказаний за варны в беседе.", usage="/warnrules [global] [2:mute:30 3:kick 5/30d:sban|reset]",
+                 perm="warnrules", roles=ADMINS)
+register_command("skick", cmd_skick, ["/skick", "!skick", "/скик", "!скик"],
+                 "исключить из всех бесед, где состоит пользователь.", usage="/skick [id|reply]",
+                 perm="skick", roles=ADMINS)
+register_command("setmoder", functools.partial(cmd_role_local, role_name="moder"),
+                 ["/setmoder", "/moder", "!moder", "/назначитьмодератором", "!назначитьмодератором"],
+                 "роль модератора в беседе.", usage="/setmoder [id|reply]", perm="role", roles=ADMINS)
+register_command("sethelper", functools.partial(cmd_role_local, role_name="helper"),
+                 ["/sethelper", "/helper", "!helper", "/назначитьпомощником", "!назначитьпомощником"],
+                 "роль помощника в беседе.", usage="/sethelper [id|reply]", perm="role", roles=ADMINS)
+register_command("setadmin", functools.partial(cmd_role_local, role_name="admin"),
+                 ["/setadmin", "/admin", "!admin", "/назначитьадминистратором", "!назначитьадминистратором"],
+                 "роль администратора в беседе.", usage="/setadmin [id|reply]", perm="role", roles=ADMINS)
+register_command("removerole", cmd_remove_role_local, ["/removerole", "/снять", "/разжаловать", "/ремувроль"],
+                 "снять роли в беседе.", usage="/removerole [id|reply]", perm="removerole", roles=ADMINS)
+register_command("gzov", cmd_gzov, ["/gzov", "!gzov", "/гзов", "!гзов"],
+                 "рассылка по всем беседам бота.", usage="/gzov <текст>", perm="gzov", roles=ADMINS, min_args=1)
+register_command("gzovstatus", cmd_gzov_status, ["/gzovstatus", "!gzovstatus", "/статусрассылки", "!статусрассылки"],
+                 "статус активных рассылок или одной по номеру.", usage="/gzovstatus [номер]",
+                 perm="gzov", roles=ADMINS)
+
+register_command("sban", cmd_sban, ["/sban", "!sban", "/сбан", "!сбан"],
+                 "бан во всех беседах.", usage="/sban [id|reply] [причина]", owner_only=True)
+register_command("sunban", cmd_sunban, ["/sunban", "!sunban", "/сунбан", "!сунбан"],
+                 "снять глобальный бан.", usage="/sunban [id|reply]", owner_only=True)
+register_command("setowner", cmd_setowner_local,
+                 ["/setowner", "/owner", "!owner", "/назначитьвладельцем", "!назначитьвладельцем"],
+                 "роль владельца в беседе.", usage="/setowner [id|reply]", owner_only=True)
+register_command("allowner", cmd_setowner_global, ["/allowner", "!allowner", "/всемвладельцем"],
+                 "роль владельца во всех беседах.", usage="/allowner [id|reply]", owner_only=True)
+register_command("alladmin", functools.partial(cmd_role_global, role_name="admin"), ["/alladmin", "!alladmin"],
+                 "роль администратора во всех беседах.", usage="/alladmin [id|reply]", owner_only=True)
+register_command("allmoder", functools.partial(cmd_role_global, role_name="moder"), ["/allmoder", "!allmoder"],
+                 "роль модератора во всех беседах.", usage="/allmoder [id|reply]", owner_only=True)
+register_command("allhelper", functools.partial(cmd_role_global, role_name="helper"), ["/allhelper", "!allhelper"],
+                 "роль помощника во всех беседах.", usage="/allhelper [id|reply]", owner_only=True)
+register_command("allremoverole", cmd_remove_role_global, ["/allremoverole", "/аллснять", "/аллразжаловать", "/аллремувроль"],
+                 "снять роли во всех беседах.", usage="/allremoverole [id|reply]", owner_only=True)
+register_command("blacklist", cmd_blacklist, ["/blacklist", "!blacklist", "/чс", "!чс", "/блэклист", "!блэклист"],
+                 "запрещённые слова.", usage="/blacklist add/remove/list [слово]", owner_only=True, min_args=1)
+register_command("wipe", cmd_wipe, ["/wipe", "!wipe", "/вайп", "!вайп"],
+                 "очистить таблицу.", usage="/wipe warns/bans/roles/blacklist/chats", owner_only=True, min_args=1)
+register_command("backup", cmd_backup, ["/backup", "!backup", "/бэкап", "!бэкап"],
+                 "бэкап БД владельцу в ЛС.", owner_only=True)
+register_command("exportlogs", cmd_export_logs, ["/exportlogs", "/экспортлогов", "/export_logs", "/экспорт_логов"],
+                 "экспорт логов владельцу в ЛС.", usage="/exportlogs [2h|дата [дата]] [error|warning]",
+                 perm="exportlogs", roles=("owner",))
+register_command("audit", cmd_audit, ["/audit", "!audit", "/журнал", "!журнал"],
+                 "журнал действий модерации в ЛС (CSV/JSONL).",
+                 usage="/audit [id|кто id|здесь|тип действие] [7d|дата [дата]] [csv|jsonl]", perm="audit", roles=ADMINS)
+register_command("syncmembers", cmd_sync_members, ["/syncmembers", "!syncmembers", "/синхронизация"],
+                 "пересинхронизировать участников бесед.", owner_only=True)
+register_command("clear", cmd_clear, ["/clear", "!clear", "/удалить", "!удалить"],
+                 "удалить сообщение, на которое дан reply.", usage="/clear (reply)", perm="clear", roles=SENIOR)
+build_permissions()
+
+# ----------------- Автоматические задачи -----------------
+class ExpiryScheduler:
+    """
+    Планировщик истечения наказаний на min-heap дедлайнов.
+    Поток спит ровно до ближайшего срока и просыпается раньше, если добавлен более ранний.
+    Все наступившие сроки одного вида передаются обработчику одной пачкой.
+    """
+    def __init__(self):
+        self._heap = []   # (deadline epoch, seq, kind, payload)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._handlers = {}
+
+    def register(self, kind: str, handler):
+        """handler(payloads: list) — обрабатывает все истёкшие записи вида kind."""
+        self._handlers[kind] = handler
+
+    def schedule(self, deadline: float, kind: str, payload):
+        with self._cond:
+            seq = next(self._seq)
+            heapq.heappush(self._heap, (deadline, seq, kind, payload))
+            if self._heap[0][1] == seq:
+                # новый дедлайн раньше текущего — будим поток, чтобы он пересчитал сон
+                self._cond.notify()
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def _pop_due(self) -> dict:
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(timeout=delay)
+                    continue
+                due = {}
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, kind, payload = heapq.heappop(self._heap)
+                    due.setdefault(kind, []).append(payload)
+                return due
+
+    def run(self):
+        while True:
+            due = self._pop_due()
+            for kind, payloads in due.items():
+                handler = self._handlers.get(kind)
+                if not handler:
+                    logger.warning("ExpiryScheduler: нет обработчика для %s", kind)
+                    continue
+                try:
+                    handler(payloads)
+                except Exception as e:
+                    logger.exception("ExpiryScheduler %s error: %s", kind, e)
+
+expiry_scheduler = ExpiryScheduler()
+
+EXPIRE_RETRY_DELAY = 5.0     # секунды до повтора снятия мутов после ошибки БД, дальше удваивается
+EXPIRE_RETRY_MAX = 300.0
+_expire_failures = {}        # mute id -> неудачных попыток подряд
+
+def expire_mutes(mute_ids: List[int]):
+    """
+    Удаляет истёкшие муты одной транзакцией и уведомляет беседы (снятые вручную пропускаются).
+    Планировщик уже снял эти id с очереди, поэтому при ошибке БД они ставятся снова с паузой.
+    """
+    expired = []
+    try:
+        with db_transaction():
+            for i in range(0, len(mute_ids), 500):
+                chunk = tuple(mute_ids[i:i + 500])
+                q = ",".join("?" * len(chunk))
+                rows = db_execute(f"SELECT id, user_id, issued_by, until, reason, peer_id FROM mutes WHERE id IN ({q})", chunk, fetch=True) or []
+                if rows:
+                    db_execute(f"DELETE FROM mutes WHERE id IN ({q})", chunk)
+                expired.extend(rows)
+            bump_counts("mute", [(r[1], r[5], 0, -1, 1) for r in expired])
+    except Exception as e:
+        attempt = max(_expire_failures.get(mid, 0) for mid in mute_ids) + 1
+        delay = min(EXPIRE_RETRY_DELAY * 2 ** (attempt - 1), EXPIRE_RETRY_MAX)
+        logger.warning("Снятие %s мутов не удалось (попытка %s), повтор через %.0f с: %s", len(mute_ids), attempt, delay, e)
+        for mid in mute_ids:
+            _expire_failures[mid] = attempt
+            expiry_scheduler.schedule(time.time() + delay, "mute", mid)
+        return
+    for mid in mute_ids:
+        _expire_failures.pop(mid, None)
+    prefetch_names([r[1] for r in expired] + [r[2] for r in expired])
+    for mid, uid, issued_by, until_s, reason, peer_id in expired:
+        mute_index.expire(uid, peer_id, parse_db_ts(until_s) or 0)
+        audit("mute_expired", None, uid, peer_id, reason, mute_id=mid, issued_by=issued_by)
+        text = f"🔔 Мут снят: {mention(uid)}\nПричина: {reason}\nВыдал: {mention(issued_by)}\nВремя: {until_s}"
+        if peer_id and peer_id >= 2000000000:
+            safe_send(peer_id, text, PRIORITY_HIGH)
+        else:
+            if OWNER_ID:
+                safe_send(OWNER_ID, text, PRIORITY_HIGH)
+
+def schedule_pending_mutes():
+    """После рестарта ставит в планировщик все муты из БД (уже истёкшие сработают сразу)."""
+    rows = db_execute("SELECT id, until, peer_id FROM mutes", fetch=True) or []
+    rows = [r for r in rows if owns_peer(r[2] or 0)]    # муты чужих бесед снимает их шард
+    for mid, until_s, _ in rows:
+        expiry_scheduler.schedule(parse_db_ts(until_s) or 0, "mute", mid)
+    logger.info("Планировщик: восстановлено %s мутов", len(rows))
+
+expiry_scheduler.register("mute", expire_mutes)
+expiry_scheduler.register("warn_compaction", compact_expired_warns)
+expiry_scheduler.register("screen_names_purge", purge_screen_names)
+
+from zoneinfo import ZoneInfo   # импорт в начале файла
+
+def wait_until_next(hour: int = 23, minute: int = 59):
+    tz = ZoneInfo("Europe/Moscow")  # московская зона
+    now = datetime.datetime.now(tz=tz)
+    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if now >= target:
+        target = target + datetime.timedelta(days=1)
+    delta = (target - now).total_seconds()
+    return max(0, delta)
+
+def periodic_backup_and_logs():
+    """
+    Ежедневно в 23:59 по локальному времени выполняет:
+    - бэкап БД
+    - экспорт логов
+    и отправляет результаты владельцу.
+    """
+    while True:
+        try:
+            secs = wait_until_next(23, 59)
+            logger.info("Автозадача: ожидание %s секунд до 23:59", secs)
+            time.sleep(secs + 1)  # приблизительно к 23:59:01
+            # бэкап
+            try:
+                bfiles = create_backup_files()
+                if bfiles and OWNER_ID:
+                    try:
+                        send_documents(OWNER_ID, bfiles, backup_caption(
+                            bfiles, f"Автобэкап базы выполнен: {os.path.basename(bfiles[0])}"))
+                    except Exception as e:
+                        logger.exception("periodic backup upload error: %s", e)
+            except Exception:
+                logger.exception("periodic backup error")
+            # экспорт логов
+            try:
+                # только последние сутки: полный лог уже лежит в сжатых сегментах
+                logfiles, _ = export_logs_file(start=time.time() - 86400)
+                if logfiles and OWNER_ID:
+                    try:
+                        send_documents(OWNER_ID, logfiles, backup_caption(
+                            logfiles, f"Автоэкспорт логов: {os.path.basename(logfiles[0])}"))
+                        remove_files(logfiles)
+                    except Exception as e:
+                        logger.exception("periodic logs upload error: %s", e)
+            except Exception:
+                logger.exception("periodic logs error")
+            # после выполнения — ждём снова на следующий день
+        except Exception as e:
+            logger.exception("periodic backup/logs loop error: %s", e)
+            time.sleep(60)
+
+# ----------------- Диспетчер команд -----------------
+def handle_command(event, cmd_text: str, args: List[str]):
+    msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
+    if not msg:
+        return
+    peer_id = msg.get("peer_id") if isinstance(msg, dict) else getattr(msg, "peer_id", None)
+    from_id = msg.get("from_id") if isinstance(msg, dict) else getattr(msg, "from_id", None)
+    if peer_id and peer_id >= 2000000000:
+        add_chat(peer_id)
+    cmd = resolve_command(cmd_text)
+    if not cmd:
+        return
+    t0 = time.perf_counter()
+    failed = False
+    try:
+        if cmd.owner_only and not is_owner(from_id):
+            return safe_send(peer_id, "❌ Только владелец.")
+        if cmd.perm and not has_perm(from_id, cmd.perm, peer_id):
+            return safe_send(peer_id, "❌ Недостаточно прав.")
+        if len(args) < cmd.min_args:
+            return safe_send(peer_id, f"Использование: {cmd.usage}")
+        cmd.handler(peer_id, from_id, event, args)
+    except Exception as e:
+        failed = True
+        logger.exception("handle_command %s exception: %s", cmd.key, e)
+        safe_send(peer_id, "❌ Ошибка при выполнении команды.")
+    finally:
+        cmd.record(time.perf_counter() - t0, failed)
+
+# ----------------- Обработка входящих сообщений -----------------
+def process_new_message(event):
+    try:
+        msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
+        if not msg:
+            return
+        peer_id = msg.get("peer_id") if isinstance(msg, dict) else getattr(msg, "peer_id", None)
+        from_id = msg.get("from_id") if isinstance(msg, dict) else getattr(msg, "from_id", None)
+        if peer_id and peer_id >= 2000000000:
+            add_chat(peer_id)
+            if from_id:
+                member_joined(peer_id, from_id)   # написал в беседу — значит участник
+        action = msg.get("action") if isinstance(msg, dict) else getattr(msg, "action", None)
+        if action:
+            handle_invite_action(event)
+        if handle_blacklist_on_message(event):
+            return
+        try:
+            if mute_index.is_muted(from_id, peer_id):
+                audit("muted_message_deleted", None, from_id, peer_id)
+                conv_id = msg.get("conversation_message_id") if isinstance(msg, dict) else getattr(msg, "conversation_message_id", None)
+                mid = msg.get("id") if isinstance(msg, dict) else getattr(msg, "id", None)
+                try:
+                    if conv_id:
+                        vk.messages.delete(conversation_message_ids=[conv_id], peer_id=peer_id, delete_for_all=1)
+                    elif mid:
+                        vk.messages.delete(message_ids=[mid], delete_for_all=1)
+                except Exception:
+                    pass
+                return
+        except Exception:
+            pass
+    except Exception as e:
+        logger.exception("process_new_message error: %s", e)
+
+# ----------------- Конвейер событий -----------------
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS") or 4)
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE") or 1000)     # суммарно на всех воркеров
+EVENT_BATCH = 16                                                   # событий одной беседы за один заход воркера
+EVENT_STATS_INTERVAL = int(os.getenv("EVENT_STATS_INTERVAL") or 300)
+
+def event_peer_id(event) -> int:
+    msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
+    if not msg:
+        return 0
+    peer_id = msg.get("peer_id") if isinstance(msg, dict) else getattr(msg, "peer_id", None)
+    return int(peer_id or 0)
+
+class EventPipeline:
+    """
+    Читатель longpoll кладёт события в очереди бесед; общий пул воркеров берёт беседы по очереди.
+    Беседа в каждый момент у одного воркера, поэтому её события обрабатываются строго по порядку,
+    а медленный обработчик (большой /sban, задержка users.get) держит только свою беседу.
+    Воркер берёт у беседы не больше EVENT_BATCH событий и ставит её в конец очереди готовых — беседы
+    с длинной очередью не вытесняют остальные. Больше maxsize событий в ожидании — читатель ждёт (backpressure).
+    """
+    def __init__(self, handler, workers: int = EVENT_WORKERS, maxsize: int = EVENT_QUEUE_SIZE):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.maxsize = max(1, maxsize)
+        self._pending = {}                # peer_id -> deque[(время постановки, событие)]; есть ключ — беседа в работе
+        self._ready = queue.Queue()       # беседы, готовые к обработке (каждая не больше одного раза)
+        self._size = 0
+        self._threads = []
+        self._lock = threading.Condition()
+        self._latencies = deque(maxlen=2048)   # секунды от постановки в очередь до конца обработки
+        self.submitted = 0
+        self.processed = 0
+        self.errors = 0
+        self.backpressure_waits = 0
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"event-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, event):
+        peer_id = event_peer_id(event)
+        item = (time.perf_counter(), event)
+        with self._lock:
+            if self._size >= self.maxsize:
+                self.backpressure_waits += 1
+                while self._size >= self.maxsize:
+                    self._lock.wait()
+            self._size += 1
+            self.submitted += 1
+            pending = self._pending.get(peer_id)
+            if pending is None:
+                self._pending[peer_id] = deque((item,))
+                self._ready.put(peer_id)
+            else:
+                pending.append(item)
+
+    def stop(self):
+        """Дожидается обработки всех принятых событий и останавливает воркеров."""
+        with self._lock:
+            while self._pending:
+                self._lock.wait()
+        for _ in self._threads:
+            self._ready.put(None)
+        for t in self._threads:
+            t.join()
+
+    def _worker(self):
+        while True:
+            peer_id = self._ready.get()
+            if peer_id is None:
+                return
+            with self._lock:
+                pending = self._pending[peer_id]
+                batch = [pending.popleft() for _ in range(min(len(pending), EVENT_BATCH))]
+                self._size -= len(batch)
+                self._lock.notify_all()
+            failed = 0
+            done = []
+            for enqueued, event in batch:
+                try:
+                    self.handler(event)
+                except Exception as e:
+                    failed += 1
+                    logger.exception("Event worker error: %s", e)
+                done.append(time.perf_counter() - enqueued)
+            with self._lock:
+                self.processed += len(batch)
+                self.errors += failed
+                self._latencies.extend(done)
+                if pending:
+                    self._ready.put(peer_id)
+                else:
+                    del self._pending[peer_id]
+                    if not self._pending:
+                        self._lock.notify_all()
+
+    def depth(self) -> int:
+        return self._size
+
+    def stats(self) -> dict:
+        with self._lock:
+            lat = sorted(self._latencies)
+        pct = lambda p: lat[min(len(lat) - 1, int(len(lat) * p))] * 1000 if lat else 0.0
+        return {"depth": self.depth(), "submitted": self.submitted, "processed": self.processed,
+                "errors": self.errors, "backpressure_waits": self.backpressure_waits,
+                "latency_ms_p50": pct(0.50), "latency_ms_p95": pct(0.95), "latency_ms_p99": pct(0.99)}
+
+def pipeline_stats_reporter(pipeline: EventPipeline):
+    while True:
+        time.sleep(EVENT_STATS_INTERVAL)
+        s = pipeline.stats()
+        logger.info("Конвейер: очередь=%s обработано=%s ошибок=%s ожиданий=%s p50=%.1fмс p95=%.1fмс p99=%.1fмс",
+                    s["depth"], s["processed"], s["errors"], s["backpressure_waits"],
+                    s["latency_ms_p50"], s["latency_ms_p95"], s["latency_ms_p99"])
+        top = sorted(command_stats().items(), key=lambda kv: -kv[1]["calls"])[:5]
+        if top:
+            logger.info("Команды: %s", ", ".join(f"{k}={v['calls']} ({v['avg_ms']:.0f}мс ср., ошибок {v['errors']})"
+                                                 for k, v in top))
+
+# ----------------- Главный цикл -----------------
+def handle_event(event):
+    if event.type != VkBotEventType.MESSAGE_NEW:
+        return
+    process_new_message(event)
+    msg = getattr(event, "message", None) or (event.obj.get("message") if hasattr(event, "obj") and isinstance(event.obj, dict) else None)
+    if not msg:
+        return
+    text = (msg.get("text") if isinstance(msg, dict) else getattr(msg, "text", "")) or ""
+    text = text.strip()
+    if not text:
+        return
+    parts = text.split()
+    cmd = parts[0].lower()
+    args = parts[1:]
+    if cmd.startswith("!") or cmd.startswith("/"):
+        handle_command(event, cmd, args)
+    else:
+        lw = text.lower()
+        if lw in ("привет","hi","hello"):
+            safe_send(msg.get("peer_id"), "Привет!")
+        elif lw in ("пока","bye"):
+            safe_send(msg.get("peer_id"), "До встречи 👋")
+
+# ----------------- Callback API -----------------
+BOT_MODE = (os.getenv("BOT_MODE") or "longpoll").strip().lower()          # longpoll | callback
+CALLBACK_PATH = os.getenv("CALLBACK_PATH") or "/callback"
+CALLBACK_CONFIRMATION = os.getenv("CALLBACK_CONFIRMATION", "").strip()    # строка из настроек Callback API группы
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET", "").strip()                # «секретный ключ» там же
+CALLBACK_REMEMBER = 5000    # последних event_id для отсева повторов
+
+MESSAGE_EVENT_TYPES = ("message_new", "message_reply", "message_edit")
+
+def make_event(raw: dict):
+    """Событие Callback API -> тот же объект, что отдаёт VkBotLongPoll (тело события у них одинаковое)."""
+    if "group_id" not in raw:
+        raw = dict(raw, group_id=GROUP_ID)    # VkBotEvent требует group_id; в записанных событиях его может не быть
+    return VkBotMessageEvent(raw) if raw.get("type") in MESSAGE_EVENT_TYPES else VkBotEvent(raw)
+
+class CallbackReceiver:
+    """
+    Приём событий Callback API. "ok" отдаётся сразу после проверок, обработка идёт
+    в конвейере воркеров. VK повторяет событие, если не дождался "ok",
+    поэтому недавние event_id запоминаются и повторы отбрасываются.
+    """
+    def __init__(self, submit, confirmation: str = CALLBACK_CONFIRMATION, secret: str = CALLBACK_SECRET,
+                 group_id: int = GROUP_ID, remember: int = CALLBACK_REMEMBER):
+        self.submit = submit
+        self.confirmation = confirmation
+        self.secret = secret
+        self.group_id = group_id
+        self.remember = remember
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.last_event_at = 0.0
+
+    def _is_duplicate(self, event_id: str) -> bool:
+        with self._lock:
+            if event_id in self._seen:
+                return True
+            self._seen[event_id] = True
+            while len(self._seen) > self.remember:
+                self._seen.popitem(last=False)
+            return False
+
+    def handle(self, body: bytes) -> Tuple[int, str]:
+        try:
+            raw = json.loads(body.decode("utf-8"))
+        except (UnicodeDecodeError, ValueError):
+            return 400, "bad request"
+        if not isinstance(raw, dict) or not raw.get("type"):
+            return 400, "bad request"
+        if self.group_id and int(raw.get("group_id") or 0) != self.group_id:
+            self.rejected += 1
+            return 403, "forbidden"
+        if raw["type"] == "confirmation":
+            if not self.confirmation:
+                logger.error("Callback API: пришёл запрос подтверждения, но CALLBACK_CONFIRMATION не задан")
+            return 200, self.confirmation
+        if self.secret and not hmac.compare_digest(str(raw.get("secret") or "").encode(), self.secret.encode()):
+            self.rejected += 1
+            logger.warning("Callback API: неверный secret, событие %s отклонено", raw.get("event_id"))
+            return 403, "forbidden"
+        event_id = raw.get("event_id")
+        if event_id and self._is_duplicate(str(event_id)):
+            self.duplicates += 1
+            return 200, "ok"
+        self.received += 1
+        self.last_event_at = time.time()
+        try:
+            event = make_event(raw)
+        except Exception as e:
+            # тип события, неизвестный vk_api: подтверждаем, иначе VK будет повторять
+            logger.warning("Callback API: событие %s не разобрано: %s", raw.get("type"), e)
+            return 200, "ok"
+        self.submit(event)
+        return 200, "ok"
+
+# ----------------- Шардирование по процессам -----------------
+def apply_change(kind: str, args: tuple):
+    """Изменение, сделанное другим шардом: правим только свои кэши, в БД оно уже записано."""
+    if kind == "role_set":
+        role_cache.set(*args)
+    elif kind == "roles_removed":
+        role_cache.remove(*args)
+    elif kind == "roles_cleared":
+        role_cache.clear()
+    elif kind == "blacklist":
+        invalidate_blacklist_matcher()
+    elif kind == "warn_rules":
+        warn_ladder.invalidate()
+    elif kind == "member_joined":
+        membership.add(*args)
+    elif kind == "member_left":
+        membership.remove(*args)
+    elif kind == "chats_cleared":
+        _known_chats.clear()
+        membership.forget()
+    else:
+        logger.warning("Шард %s: неизвестное изменение %s", SHARD_INDEX, kind)
+
+def shard_main(index: int, events, changes, ready, app_factory=None):
+    """
+    Точка входа процесса-шарда: свой BotApp (HTTP не поднимает) и свой конвейер воркеров.
+    events — события своих бесед от роутера; changes[i] — изменения для шарда i
+    (неограниченные очереди, чтобы рассылка изменений не могла заблокировать воркеров).
+    """
+    global _publish
+    app = (app_factory or BotApp)(shard=(index, len(changes)), serve_http=False)
+
+    def publish(kind: str, args: tuple):
+        for i, q in enumerate(changes):
+            if i != index:
+                q.put((kind, args))
+
+    def apply_changes():
+        while True:
+            kind, args = changes[index].get()
+            apply_change(kind, args)
+
+    _publish = publish
+    app.start()
+    app.pipeline.start()
+    threading.Thread(target=apply_changes, name="shard-changes", daemon=True).start()
+    ready.put(index)
+    while True:
+        raw = events.get()
+        if raw is None:
+            break
+        try:
+            event = make_event(raw)
+        except Exception as e:
+            logger.exception("Шард %s: событие не разобрано: %s", index, e)
+            continue
+        app.pipeline.submit(event)
+    app.pipeline.stop()
+    audit_log.flush()    # atexit в дочернем процессе multiprocessing не вызывается
+    app.outbox.flush(timeout=30)
+    ready.put((index, app.pipeline.processed))
+
+class ShardError(RuntimeError):
+    """Процесс-шард умер: его беседы не обрабатываются."""
+
+class ShardRouter:
+    """
+    Источник событий при SHARDS > 1: раскладывает события по процессам-шардам по peer_id,
+    события одной беседы всегда попадают в один процесс и идут по порядку.
+    Интерфейс как у EventPipeline (start / submit / stop / depth).
+    Умерший шард не должен подвесить роутер: очереди ждём порциями по SHARD_PUT_TIMEOUT
+    и между ними проверяем процесс; если он умер — ShardError.
+    """
+    def __init__(self, shards: int = SHARDS, app_factory=None, maxsize: int = EVENT_QUEUE_SIZE):
+        ctx = multiprocessing.get_context("spawn")    # fork после запуска потоков небезопасен
+        self.shards = shards
+        self._events = [ctx.Queue(maxsize=maxsize) for _ in range(shards)]
+        self._changes = [ctx.Queue() for _ in range(shards)]
+        self._ready = ctx.Queue()
+        self._procs = [ctx.Process(target=shard_main, name=f"shard-{i}", daemon=True,
+                                   args=(i, self._events[i], self._changes, self._ready, app_factory))
+                       for i in range(shards)]
+        self.routed = [0] * shards
+        self.processed = [None] * shards    # после stop(): сколько событий обработал каждый шард
+        self.submitted = 0
+        self.backpressure_waits = 0
+
+    def _check_alive(self, i: int):
+        p = self._procs[i]
+        if not p.is_alive():
+            raise ShardError(f"шард {i} завершился (exitcode={p.exitcode})")
+
+    def _wait_ready(self, deadline: Optional[float]):
+        """Следующее сообщение шардов из очереди ready; пока ждём — проверяем, что все живы."""
+        while True:
+            try:
+                return self._ready.get(timeout=SHARD_PUT_TIMEOUT)
+            except queue.Empty:
+                for i in range(self.shards):
+                    if self.processed[i] is None:
+                        self._check_alive(i)
+                if deadline is not None and time.monotonic() > deadline:
+                    raise ShardError("шарды не ответили вовремя")
+
+    def _put(self, i: int, item):
+        while True:
+            try:
+                self._events[i].put(item, timeout=SHARD_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                self._check_alive(i)
+
+    def start(self, timeout: float = 120):
+        for p in self._procs:
+            p.start()
+        deadline = time.monotonic() + timeout
+        for _ in self._procs:
+            self._wait_ready(deadline)
+        logger.info("Шарды запущены: %s процессов", self.shards)
+
+    def submit(self, event):
+        i = shard_of(event_peer_id(event), self.shards)
+        try:
+            self._events[i].put_nowait(event.raw)
+        except queue.Full:
+            self.backpressure_waits += 1
+            self._put(i, event.raw)
+        self.routed[i] += 1
+        self.submitted += 1
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Дожидается, пока шарды обработают всё из своих очередей, и завершает их.
+        processed — отчёты шардов; ShardError, если шард умер или не уложился в timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            for i in range(self.shards):
+                self._put(i, None)
+            for _ in range(self.shards):
+                i, processed = self._wait_ready(deadline)
+                self.processed[i] = processed
+            for p in self._procs:
+                p.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        finally:
+            for p in self._procs:
+                if p.is_alive() and any(n is None for n in self.processed):
+                    p.terminate()
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._events)
+
+# ----------------- Приложение -----------------
+class BotApp:
+    """
+    Сборка бота без побочных эффектов импорта: VK-клиент, БД с кэшами и фоновые задачи
+    поднимаются в start(), longpoll — в run(). Готовую зависимость можно передать
+    (например, сессию фейкового VK API), тогда она не создаётся.
+    Длительность этапов старта пишется в timings и в лог.
+
+    При SHARDS > 1 экземпляр без shard становится роутером: держит longpoll/Callback API и HTTP,
+    а события обрабатывают процессы-шарды — BotApp(shard=(номер, всего)), см. ShardRouter.
+    """
+    def __init__(self, vk_session=None, upload=None, longpoll_factory=None, db_path: Optional[str] = None,
+                 log_path: Optional[str] = LOG_PATH, background: bool = True,
+                 shard: Optional[Tuple[int, int]] = None, serve_http: bool = True):
+        self.vk_session = vk_session
+        self.upload = upload
+        self.longpoll_factory = longpoll_factory or (lambda session: VkBotLongPoll(session, GROUP_ID))
+        self.db_path = db_path
+        self.log_path = log_path
+        self.background = background
+        self.shard = shard
+        self.serve_http = serve_http
+        global outbox, broadcasts
+        # одни на процесс, как vk и upload: обработчики команд берут их из модуля
+        self.outbox = outbox = Outbox(lambda params: vk.messages.send(**params),
+                                      rate=OUTBOX_RATE / (shard[1] if shard else 1))
+        self.broadcasts = broadcasts = BroadcastEngine()
+        self.is_router = shard is None and SHARDS > 1
+        self.timings = {}    # этап -> секунды
+        self.started = False
+        self.pipeline = ShardRouter(SHARDS) if self.is_router else EventPipeline(handle_event)
+        self.callback = CallbackReceiver(self.pipeline.submit) if BOT_MODE == "callback" else None
+        self.metrics_server = None
+        self._t0 = time.perf_counter()
+        self._started_at = time.time()
+
+    def _timed(self, stage: str, fn):
+        t0 = time.perf_counter()
+        fn()
+        self.timings[stage] = time.perf_counter() - t0
+
+    def init_vk(self):
+        global vk_session, vk, upload
+        if self.vk_session is None:
+            if not GROUP_TOKEN:
+                print("Ошибка: GROUP_TOKEN не задан в .env", file=sys.stderr)
+                sys.exit(1)
+            self.vk_session = vk_api.VkApi(token=GROUP_TOKEN)
+            # VkApi.method держит lock на время паузы и запроса, а пауза по умолчанию 0.34 с (лимит
+            # пользовательского токена) — без этого весь процесс упирается в ~3 запроса/с, ниже OUTBOX_RATE.
+            # Пауза не длиннее шага корзины outbox, чтобы лимит задавала корзина, а не vk_api
+            self.vk_session.RPS_DELAY = SHARD_COUNT / max(VK_RPS, OUTBOX_RATE)
+        vk_session = self.vk_session
+        vk = InstrumentedApi(vk_session.get_api())
+        upload = self.upload or VkUpload(vk_session)
+
+    def init_db(self):
+        global DB_PATH
+        if self.db_path:
+            DB_PATH = self.db_path
+        init_db()
+
+    def preload_caches(self):
+        role_cache.load()
+        mute_index.load()
+        get_blacklist_matcher()
+        warn_ladder.load()
+        schedule_pending_mutes()
+
+    def init_shard(self):
+        """Номер шарда (долю общего лимита messages.send очередь получила в __init__)."""
+        global SHARD_INDEX, SHARD_COUNT
+        SHARD_INDEX, SHARD_COUNT = self.shard
+
+    def start_workers(self):
+        # у каждого шарда: своя очередь отправки, свой кэш участников, истечение мутов своих бесед
+        self.outbox.start()
+        threading.Thread(target=membership.sync, daemon=True).start()
+        threading.Thread(target=expiry_scheduler.run, daemon=True).start()
+        threading.Thread(target=audit_log.run, name="audit-writer", daemon=True).start()
+        atexit.register(audit_log.flush)
+        # задачи, которые должны идти в одном экземпляре
+        if SHARD_INDEX == 0:
+            self.broadcasts.resume_all()
+            threading.Thread(target=periodic_backup_and_logs, daemon=True).start()
+            expiry_scheduler.schedule(time.time(), "warn_compaction", None)
+            expiry_scheduler.schedule(time.time(), "screen_names_purge", None)
+
+    def health(self) -> Tuple[bool, dict]:
+        """
+        Liveness: longpoll отвечал не позже LIVENESS_TIMEOUT секунд назад (или бот только стартует).
+        В режиме Callback API события приходят сами, и тишина в группе — не сбой.
+        """
+        now = time.time()
+        if self.callback:
+            last = self.callback.last_event_at
+            return True, {"mode": "callback", "events": self.callback.received,
+                          "seconds_since_event": round(now - last, 1) if last else None,
+                          "uptime": round(now - self._started_at, 1)}
+        last = longpoll_progress or self._started_at
+        age = now - last
+        return age <= LIVENESS_TIMEOUT, {"longpoll_connected": bool(longpoll_progress),
+                                         "seconds_since_progress": round(age, 1),
+                                         "uptime": round(now - self._started_at, 1)}
+
+    def start_metrics(self):
+        p = self.pipeline
+        registry.collect("vk_bot_events_received_total", "События, принятые в конвейер", lambda: p.submitted, "counter")
+        registry.collect("vk_bot_event_backpressure_total", "Ожидания читателя на полной очереди",
+                         lambda: p.backpressure_waits, "counter")
+        registry.collect("vk_bot_event_queue_depth", "Событий в очередях воркеров", p.depth)
+        if self.is_router:
+            registry.collect("vk_bot_shard_events_routed_total", "События, отправленные шарду",
+                             lambda: {str(i): n for i, n in enumerate(p.routed)}, "counter", labels=("shard",))
+        else:
+            registry.collect("vk_bot_events_processed_total", "События, обработанные воркерами",
+                             lambda: p.processed, "counter")
+            registry.collect("vk_bot_event_errors_total", "Исключения в обработчиках событий", lambda: p.errors, "counter")
+            registry.collect("vk_bot_event_latency_seconds", "Задержка события от приёма до конца обработки (скользящее окно)",
+                             lambda: {q: p.stats()[f"latency_ms_p{int(q * 100)}"] / 1000 for q in (0.5, 0.95, 0.99)},
+                             labels=("quantile",))
+        registry.collect("vk_bot_outbox_depth", "Исходящих сообщений в очереди", self.outbox.depth)
+        registry.collect("vk_bot_outbox_sent_total", "Успешных messages.send из очереди", lambda: self.outbox.sent, "counter")
+        registry.collect("vk_bot_outbox_failed_total", "Сообщений, не доставленных после повторов",
+                         lambda: self.outbox.failed, "counter")
+        registry.collect("vk_bot_audit_written_total", "Записей журнала модерации, записанных в БД",
+                         lambda: audit_log.written, "counter")
+        registry.collect("vk_bot_audit_pending", "Записей журнала в буфере", audit_log.pending)
+        registry.collect("vk_bot_scheduled_deadlines", "Сроков в планировщике истечения", expiry_scheduler.pending)
+        registry.collect("vk_bot_cache_hits_total", "Попадания в кэши", lambda: {
+            "names": name_cache.hits, "screen_names": screen_cache.hits + screen_cache.db_hits,
+            "roles": role_cache.hits}, "counter", labels=("cache",))
+        registry.collect("vk_bot_cache_misses_total", "Промахи кэшей", lambda: {
+            "names": name_cache.misses, "screen_names": screen_cache.misses,
+            "roles": role_cache.misses}, "counter", labels=("cache",))
+        registry.collect("vk_bot_cache_hit_ratio", "Доля попаданий в кэш", self._hit_ratios, labels=("cache",))
+        registry.collect("vk_bot_kicks_saved_total", "removeChatUser, пропущенные по кэшу участников",
+                         lambda: membership.kicks_saved, "counter")
+        registry.collect("vk_bot_longpoll_last_progress_seconds", "time() последнего ответа longpoll",
+                         lambda: longpoll_progress)
+        if self.callback:
+            cb = self.callback
+            registry.collect("vk_bot_callback_events_total", "Запросы Callback API по результату", lambda: {
+                "accepted": cb.received, "duplicate": cb.duplicates, "rejected": cb.rejected},
+                "counter", labels=("result",))
+        if METRICS_PORT and self.serve_http:
+            self.metrics_server = MetricsServer(registry, METRICS_PORT, self.health)
+            if self.callback:
+                self.metrics_server.add_post(CALLBACK_PATH, self.callback.handle)
+            self.metrics_server.start()
+
+    @staticmethod
+    def _hit_ratios() -> dict:
+        pairs = {"names": (name_cache.hits, name_cache.misses),
+                 "screen_names": (screen_cache.hits + screen_cache.db_hits, screen_cache.misses),
+                 "roles": (role_cache.hits, role_cache.misses)}
+        return {k: h / (h + m) if h + m else 0.0 for k, (h, m) in pairs.items()}
+
+    def start(self) -> "BotApp":
+        if self.started:
+            return self
+        if self.log_path:
+            setup_logging(self.log_path, self.shard[0] if self.shard else None)
+        if self.shard:
+            self.init_shard()
+        if self.background:
+            # HTTP поднимается первым: Render ждёт открытый порт, пока идут миграции и прогрев кэшей
+            self._timed("metrics", self.start_metrics)
+        self._timed("vk", self.init_vk)
+        # миграции применяет роутер до запуска шардов, чтобы они не гонялись за схемой
+        self._timed("db", self.init_db)
+        if self.is_router:
+            # кэши роутеру не нужны; очередь отправки — только для уведомления о запуске
+            self.outbox.start()
+        else:
+            self._timed("caches", self.preload_caches)
+            if self.background:
+                self._timed("workers", self.start_workers)
+        self.started = True
+        logger.info("Старт за %.0f мс: %s", (time.perf_counter() - self._t0) * 1000,
+                    ", ".join(f"{k}={v * 1000:.0f}мс" for k, v in self.timings.items()))
+        return self
+
+    def connect_longpoll(self):
+        global longpoll
+        if GROUP_ID == 0:
+            print("Ошибка: GROUP_ID не задан в .env", file=sys.stderr)
+            sys.exit(1)
+        t0 = time.perf_counter()
+        longpoll = self.longpoll_factory(self.vk_session)
+        self.timings["longpoll"] = time.perf_counter() - t0
+        return longpoll
+
+    def run(self):
+        """Главный цикл: события longpoll (или Callback API при BOT_MODE=callback) уходят в конвейер воркеров."""
+        if self.callback and not METRICS_PORT:
+            print("Ошибка: для BOT_MODE=callback нужен PORT (или METRICS_PORT)", file=sys.stderr)
+            sys.exit(1)
+        self.start()
+        logger.info("Бот запущен...")
+        try:
+            if OWNER_ID:
+                safe_send(OWNER_ID, "✅ Бот запущен и слушает события.")
+        except Exception:
+            pass
+
+        global longpoll_progress
+        pipeline = self.pipeline
+        pipeline.start()
+        if not self.is_router:
+            threading.Thread(target=pipeline_stats_reporter, args=(pipeline,), daemon=True).start()
+        if self.callback:
+            logger.info("Режим Callback API: POST http://0.0.0.0:%s%s", METRICS_PORT, CALLBACK_PATH)
+            threading.Event().wait()
+        self.connect_longpoll()
+        first = True
+        while True:
+            try:
+                # check() — один запрос к серверу longpoll (то же, что внутри listen()); ответ без событий
+                # тоже считается прогрессом для /health
+                events = longpoll.check()
+                longpoll_progress = time.time()
+                for event in events:
+                    if first:
+                        first = False
+                        logger.info("Первое событие longpoll через %.0f мс после старта (подключение %.0f мс)",
+                                    (time.perf_counter() - self._t0) * 1000, self.timings["longpoll"] * 1000)
+                    pipeline.submit(event)
+            except ShardError as e:
+                # беседы умершего шарда больше не обрабатываются — выходим, платформа перезапустит сервис
+                logger.critical("Шард упал, завершаем работу: %s", e)
+                sys.exit(1)
+            except Exception as e:
+                logger.exception("Main loop error: %s", e)
+                time.sleep(1)
+
+def create_app(**deps) -> BotApp:
+    """Собирает и запускает бота (без longpoll). deps — см. BotApp."""
+    return BotApp(**deps).start()
+
+def main():
+    BotApp().run()
+
+if __name__ == "__main__":
+    main()